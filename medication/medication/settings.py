@@ -50,11 +50,14 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'medicine.middleware.PerformanceMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'medicine.middleware.ReadReplicaMiddleware',
+    'medicine.middleware.ShardMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -63,7 +66,8 @@ ROOT_URLCONF = 'medication.urls'
 
 TEMPLATES = [
     {
-        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        # DjangoTemplates, který navíc měří čas vykreslení pro medicine.instrumentation
+        'BACKEND': 'medicine.instrumentation.TimedDjangoTemplates',
         'DIRS': [os.path.join(BASE_DIR, 'users/templates')],
         'APP_DIRS': True,
         'OPTIONS': {
@@ -83,13 +87,110 @@ WSGI_APPLICATION = 'medication.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/5.1/ref/settings/#databases
 
+# Zápis bere zámek hned na začátku transakce (BEGIN IMMEDIATE): čtení-pak-zápis pak
+# nepadá okamžitě na "database is locked", ale čeká až `timeout` sekund na uvolnění.
+# Čekání na zámek určuje jen `timeout`, pragma busy_timeout se nenastavuje.
+SQLITE_OPTIONS = {
+    'transaction_mode': 'IMMEDIATE',
+    'timeout': 20,
+}
+
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        'OPTIONS': dict(SQLITE_OPTIONS),
+        # Testy souběhu potřebují skutečný soubor, sdílená paměťová DB zamyká celé tabulky.
+        'TEST': {'NAME': BASE_DIR / 'test_db.sqlite3'},
     }
 }
 
+# Produkční profil SQLite: MEDICATION_DB_PROFILE=production
+# WAL dovolí čtení souběžně se zápisem, pragmy se nastaví při otevření každého spojení,
+# spojení zůstávají otevřená mezi požadavky.
+DATABASE_PROFILE = os.environ.get('MEDICATION_DB_PROFILE', 'development')
+
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'cache_size': -64000,  # 64 MB
+    'mmap_size': 256 * 1024 * 1024,
+    'temp_store': 'MEMORY',
+}
+SQLITE_INIT_COMMAND = ';'.join(f'PRAGMA {name}={value}' for name, value in SQLITE_PRAGMAS.items())
+
+# Zápisy v rámci jednoho procesu se řadí za sebe aplikačním zámkem, čtení běží dál souběžně
+SERIALIZE_DB_WRITES = DATABASE_PROFILE == 'production'
+
+if DATABASE_PROFILE == 'production':
+    DATABASES['default'].update({
+        'CONN_MAX_AGE': 600,
+        'CONN_HEALTH_CHECKS': True,
+        'OPTIONS': {
+            **SQLITE_OPTIONS,
+            'init_command': SQLITE_INIT_COMMAND,
+        },
+    })
+
+# Repliky pro čtení: MEDICATION_READ_REPLICAS=/cesta/replika1.sqlite3,/cesta/replika2.sqlite3
+# Místně stačí kopie hlavní databáze, obnoví ji `manage.py sync_replicas`.
+# Bezpečné požadavky (GET, HEAD) čtou z repliky, zápisy jdou vždy na hlavní databázi.
+READ_REPLICAS = []
+for index, path in enumerate(filter(None, os.environ.get('MEDICATION_READ_REPLICAS', '').split(','))):
+    alias = f'replica_{index + 1}'
+    replica_options = {'init_command': 'PRAGMA query_only=1'}
+    if DATABASE_PROFILE == 'production':
+        replica_options = {
+            'init_command': SQLITE_INIT_COMMAND + ';PRAGMA query_only=1',
+            'timeout': SQLITE_OPTIONS['timeout'],
+        }
+    DATABASES[alias] = {
+        **DATABASES['default'],
+        'NAME': path.strip(),
+        'OPTIONS': replica_options,
+        # V testech replika čte přímo testovací databázi
+        'TEST': {'MIRROR': 'default'},
+    }
+    READ_REPLICAS.append(alias)
+
+# Jak dlouho po vlastním zápisu uživatel čte z hlavní databáze (repliky se mohou opožďovat)
+READ_AFTER_WRITE_WINDOW = int(os.environ.get('MEDICATION_READ_AFTER_WRITE_SECONDS', 10))
+
+# Sharding dat léků podle uživatele: MEDICATION_SHARDS=/cesta/shard1.sqlite3,/cesta/shard2.sqlite3
+# Uživatelé, session a adresář shardů (UserShard) zůstávají v default, data aplikace medicine
+# jsou ve shardu uživatele. Schéma se zakládá `manage.py migrate --database shard_N`,
+# přesun uživatele `manage.py move_user_shard`.
+SHARDS = []
+for index, path in enumerate(filter(None, os.environ.get('MEDICATION_SHARDS', '').split(','))):
+    alias = f'shard_{index + 1}'
+    DATABASES[alias] = {
+        **DATABASES['default'],
+        'NAME': path.strip(),
+        'TEST': {'NAME': BASE_DIR / f'test_{alias}.sqlite3'},
+    }
+    SHARDS.append(alias)
+
+DATABASE_ROUTERS = ['medicine.routers.ShardRouter', 'medicine.routers.ReadReplicaRouter']
+
+# Cache sdílená všemi procesy: verze v medicine.caching a karty léků musí platit napříč workery,
+# jinak by zápis v jednom procesu nezneplatnil data ve druhém. Místně soubory v MEDICATION_CACHE_DIR,
+# s MEDICATION_REDIS_URL=redis://... Redis (vyžaduje balík redis). Testy mají vlastní dočasný adresář.
+CACHE_DIR = Path(os.environ.get('MEDICATION_CACHE_DIR', BASE_DIR / 'cache'))
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': CACHE_DIR,
+        'OPTIONS': {'MAX_ENTRIES': 10000},
+    }
+}
+if os.environ.get('MEDICATION_REDIS_URL'):
+    CACHES['default'] = {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': os.environ['MEDICATION_REDIS_URL'],
+    }
+
+TEST_RUNNER = 'medicine.testing.TestRunner'
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.1/ref/settings/#auth-password-validators
@@ -135,3 +236,44 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 LOGIN_URL = '/users/login/'
 LOGIN_REDIRECT_URL = '/users/profile/'
 LOGOUT_REDIRECT_URL = '/'
+
+# Odesílač připomínek pro `manage.py run_reminders` (místně výpis na konzoli)
+MEDICINE_REMINDER_SENDER = 'medicine.reminders.ConsoleSender'
+MEDICINE_REMINDER_SENDER_OPTIONS = {}
+
+# Příjemce upozornění na doplnění pro `manage.py send_refill_alerts` (místně výpis na konzoli)
+MEDICINE_REFILL_SINK = 'medicine.refills.ConsoleSink'
+MEDICINE_REFILL_SINK_OPTIONS = {}
+
+# Měření dotazů a času požadavků: MEDICATION_PERF=1
+# Výsledek je v hlavičce Server-Timing a v loggeru medicine.perf, požadavky nad rozpočtem jako varování.
+MEDICINE_PERF_INSTRUMENTATION = os.environ.get('MEDICATION_PERF') == '1'
+MEDICINE_PERF_QUERY_BUDGET = int(os.environ.get('MEDICATION_PERF_QUERY_BUDGET', 20))
+MEDICINE_PERF_TIME_BUDGET_MS = int(os.environ.get('MEDICATION_PERF_TIME_BUDGET_MS', 500))
+
+# Léky, které podle nočního odhadu (`manage.py forecast_run_out`) dojdou do tolika dní, se zvýrazní ve statistikách
+MEDICINE_RUN_OUT_WARNING_DAYS = 14
+
+# Dodržování plánu: dávka do tolika minut od plánovaného času je včas, později až do druhé hodnoty je pozdě
+MEDICINE_ADHERENCE_ON_TIME_MINUTES = 30
+MEDICINE_ADHERENCE_LATE_MINUTES = 180
+
+# Přehled pacientů pro lékaře: počet změn léků se sčítá za tolik posledních dní
+MEDICINE_DASHBOARD_CHANGE_DAYS = 7
+
+# Retence: dávky a změny starší než MEDICINE_RETENTION_DAYS přesune `manage.py archive_logs`
+# do komprimovaných denních souborů v MEDICINE_ARCHIVE_DIR (zvlášť pro každého uživatele),
+# v databázi zůstanou jen denní souhrny.
+MEDICINE_RETENTION_DAYS = int(os.environ.get('MEDICATION_RETENTION_DAYS', 730))
+MEDICINE_ARCHIVE_DIR = Path(os.environ.get('MEDICATION_ARCHIVE_DIR', BASE_DIR / 'archive'))
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler'},
+    },
+    'loggers': {
+        'medicine.perf': {'handlers': ['console'], 'level': 'INFO', 'propagate': False},
+    },
+}
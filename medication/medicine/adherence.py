@@ -0,0 +1,259 @@
+from collections import defaultdict
+from datetime import timedelta
+from itertools import islice
+
+import numpy as np
+from django.conf import settings
+from django.db.models import Count, Q
+from django.utils import timezone
+
+from . import retention, sharding
+from .db import write_transaction
+from .dates import start_of_day
+from .models import AdherenceDaily, Log, Medication, Schedule
+from .occurrences import MINUTES_PER_DAY, _at, _minutes_since, _week_start, occurrence_minutes
+
+BATCH_SIZE = 500
+TAKEN, LATE, MISSED, PENDING = range(4)
+COUNTS = ('expected', 'taken', 'late', 'missed')
+
+
+def _windows():
+    return settings.MEDICINE_ADHERENCE_ON_TIME_MINUTES, settings.MEDICINE_ADHERENCE_LATE_MINUTES
+
+
+def _fresh(now):
+    # Platný uložený den: nezastaralý a u otevřeného dne ještě před uzavřením dalšího výskytu
+    return Q(stale=False) & (Q(valid_until__isnull=True) | Q(valid_until__gt=now))
+
+
+def last_closed_day():
+    """Poslední den, jehož všechny výskyty už mají uzavřené okno pro pozdní dávku."""
+    return timezone.localdate(timezone.now() - timedelta(minutes=_windows()[1])) - timedelta(days=1)
+
+
+def match(expected, logs, on_time, late):
+    """
+    Přiřadí dávky z Logu k očekávaným výskytům, každou dávku nejvýš jednomu.
+
+    Obě pole jsou seřazené minuty. Nejdřív se párují dávky včas (±on_time),
+    zbylé výskyty pak s dávkami do `late` minut po nich. Začátek okna každého
+    výskytu najde searchsorted, dál se postupuje dvěma ukazateli.
+    Vrací stav každého výskytu: TAKEN, LATE nebo MISSED.
+    """
+    status = np.full(len(expected), MISSED, dtype=np.int8)
+    used = [False] * len(logs)
+    times, ends = logs.tolist(), expected.tolist()
+    for code, low, high, side in ((TAKEN, -on_time, on_time, 'left'), (LATE, on_time, late, 'right')):
+        starts = np.searchsorted(logs, expected + low, side=side).tolist()
+        j = 0
+        for i in np.flatnonzero(status == MISSED).tolist():
+            j = max(j, starts[i])
+            while j < len(times) and used[j]:
+                j += 1
+            if j < len(times) and times[j] <= ends[i] + high:
+                used[j] = True
+                status[i] = code
+                j += 1
+    return status
+
+
+def compute(medication_ids, since, until, using=None, now=None):
+    """
+    Denní počty očekávaných, včas a pozdě užitých a vynechaných dávek pro dny
+    [since, until] spočítané z plánů a Logu k okamžiku `now`; nic se neukládá.
+
+    Výskyty, kterým ještě neuplynulo okno pro pozdní dávku, se za vynechané
+    nepočítají; valid_until dne je chvíle, kdy se to prvnímu z nich změní.
+    Vrací slovníky seřazené podle léku a dne.
+    """
+    on_time, late = _windows()
+    start, end = start_of_day(since), start_of_day(until + timedelta(days=1))
+    week_start = _week_start(start)
+    low, high = _minutes_since(week_start, start), _minutes_since(week_start, end)
+    now = _minutes_since(week_start, now or timezone.now())
+    days = (until - since).days + 1
+
+    owners = dict(Medication.objects.using(using).filter(id__in=medication_ids).values_list('id', 'user_id'))
+    # Kompaktní plány se rozvinou v paměti, z databáze jde jeden řádek na plán
+    recurrences = defaultdict(list)
+    for medication_id, *recurrence in (
+        Schedule.objects.using(using).filter(medication_id__in=owners)
+        .values_list('medication_id', *Schedule.RECURRENCE_FIELDS)
+    ):
+        recurrences[medication_id].append(recurrence)
+    taken = defaultdict(list)
+    for medication_id, created_at in (
+        Log.objects.using(using)
+        .filter(medication_id__in=owners, created_at__gte=start - timedelta(minutes=on_time),
+                created_at__lt=end + timedelta(minutes=late))
+        .values_list('medication_id', 'created_at')
+    ):
+        taken[medication_id].append(_minutes_since(week_start, created_at))
+
+    rows = []
+    for medication_id in sorted(owners):
+        expected = occurrence_minutes(recurrences[medication_id], week_start, low, high)
+        status = match(expected, np.sort(np.array(taken[medication_id], dtype=np.int64)), on_time, late)
+        status[(status == MISSED) & (expected + late > now)] = PENDING
+        day = (expected - low) // MINUTES_PER_DAY
+        # Výskyty jsou seřazené, první čekající výskyt dne se uzavře nejdřív
+        closes = {}
+        for index, minute in zip(day[status == PENDING].tolist(), (expected[status == PENDING] + late).tolist()):
+            closes.setdefault(index, minute)
+        counts = {
+            'expected': np.bincount(day[status != PENDING], minlength=days),
+            'taken': np.bincount(day[status == TAKEN], minlength=days),
+            'late': np.bincount(day[status == LATE], minlength=days),
+            'missed': np.bincount(day[status == MISSED], minlength=days),
+        }
+        for index in range(days):
+            rows.append({
+                'medication_id': medication_id, 'user_id': owners[medication_id],
+                'date': since + timedelta(days=index),
+                **{name: int(counts[name][index]) for name in COUNTS},
+                'valid_until': _at(week_start, closes[index]) if index in closes else None,
+            })
+    return rows
+
+
+def _store(rows, using):
+    with write_transaction(using=using):
+        AdherenceDaily.objects.using(using).bulk_create(
+            [AdherenceDaily(**row, stale=False) for row in rows],
+            update_conflicts=True,
+            unique_fields=['medication', 'date'],
+            update_fields=[*COUNTS, 'valid_until', 'stale'],
+        )
+
+
+def _ensure(medication_ids, since, until, using):
+    """Dopočítá a uloží chybějící nebo zastaralé uzavřené dny; dny před archivem zůstávají, jak jsou."""
+    # Pro archivované dny už Log nemá data, platí to, co se uložilo před archivací. Úplnost se
+    # proto posuzuje až od horizontu, jinak by lék bez řádků z té doby chyběl při každém čtení.
+    horizon = retention.horizon(using=using)
+    if horizon:
+        since = max(since, horizon)
+    if since > until:
+        return
+    days = (until - since).days + 1
+    complete = set(
+        AdherenceDaily.objects.using(using)
+        .filter(_fresh(timezone.now()), medication_id__in=medication_ids, date__range=(since, until))
+        .values('medication_id')
+        .annotate(days=Count('id'))
+        .filter(days=days)
+        .values_list('medication_id', flat=True)
+    )
+    missing = [medication_id for medication_id in medication_ids if medication_id not in complete]
+    if not missing:
+        return
+    # Platné uložené dny se nepřepisují, jejich dávky už mohla smazat probíhající archivace
+    kept = set(
+        AdherenceDaily.objects.using(using)
+        .filter(_fresh(timezone.now()), medication_id__in=missing, date__range=(since, until))
+        .values_list('medication_id', 'date')
+    )
+    _store([row for row in compute(missing, since, until, using) if (row['medication_id'], row['date']) not in kept],
+           using)
+
+
+def ensure_day(medications, day, now=None, using=None):
+    """
+    Uloží dodržování plánu léků `medications` (queryset) za den `day`, i když ještě není uzavřený.
+
+    Přepočítají se jen léky bez platného řádku; otevřený den platí do
+    valid_until nebo do zápisu dávky (invalidate_doses). Počty jsou tytéž
+    jako z compute(), nad uloženými řádky se dá řadit v databázi.
+    """
+    now = now or timezone.now()
+    fresh = AdherenceDaily.objects.using(using).filter(_fresh(now), date=day).values('medication_id')
+    missing = iter(medications.using(using).exclude(id__in=fresh).order_by('id').values_list('id', flat=True))
+    while batch := list(islice(missing, BATCH_SIZE)):
+        _store(compute(batch, day, day, using, now=now), using)
+
+
+def daily(medication_ids, since, until, using=None):
+    """
+    Denní dodržování plánu léků za dny [since, until].
+
+    Uzavřené dny se čtou z AdherenceDaily, chybějící a zastaralé se nejdřív
+    dopočítají a uloží. Dny, kterým ještě neuplynulo okno pro pozdní dávku,
+    se počítají pokaždé znovu a neukládají se.
+    """
+    using = using or sharding.current_alias()
+    closed = min(until, last_closed_day())
+    rows = []
+    ids = iter(sorted(set(medication_ids)))
+    while batch := list(islice(ids, BATCH_SIZE)):
+        if since <= closed:
+            _ensure(batch, since, closed, using)
+            rows.extend(
+                AdherenceDaily.objects.using(using)
+                .filter(medication_id__in=batch, date__range=(since, closed))
+                .order_by('medication_id', 'date')
+                .values('medication_id', 'user_id', 'date', *COUNTS)
+            )
+        if closed < until:
+            rows.extend(compute(batch, max(since, closed + timedelta(days=1)), until, using))
+    rows.sort(key=lambda row: (row['medication_id'], row['date']))
+    return rows
+
+
+def summarize(rows):
+    """Součty přes řádky z daily() a podíl dávek užitých včas nebo pozdě."""
+    totals = {name: sum(row[name] for row in rows) for name in COUNTS}
+    totals['rate'] = round((totals['taken'] + totals['late']) / totals['expected'], 4) if totals['expected'] else None
+    return totals
+
+
+def invalidate_doses(doses, using=None):
+    """
+    Označí uložené dny, kterých se týkají zapsané dávky (medication_id, čas), jako zastaralé.
+
+    Patří sem i otevřené dny uložené přes ensure_day(), zápis dávky proto
+    stojí jeden UPDATE za celou dávku zápisů.
+    """
+    on_time, late = _windows()
+    ranges = {}
+    for medication_id, taken_at in doses:
+        first = timezone.localdate(taken_at - timedelta(minutes=late))
+        last = timezone.localdate(taken_at + timedelta(minutes=on_time))
+        low, high = ranges.get(medication_id, (first, last))
+        ranges[medication_id] = (min(low, first), max(high, last))
+    if ranges:
+        condition = Q()
+        for medication_id, (first, last) in ranges.items():
+            condition |= Q(medication_id=medication_id, date__range=(first, last))
+        AdherenceDaily.objects.using(using).filter(condition).update(stale=True)
+
+
+def invalidate_medication(medication_id, using=None):
+    """Změna plánů mění očekávané výskyty, přepočítají se všechny uložené dny léku."""
+    AdherenceDaily.objects.using(using).filter(medication_id=medication_id, stale=False).update(stale=True)
+
+
+def keep_days(medication_ids, since, until, using=None):
+    """
+    Uloží uzavřené dny [since, until] léků `medication_ids`, dokud jsou v Logu dávky, ze kterých se počítají.
+
+    Archivace to volá před smazáním každé dávky řádků pro její léky a dny
+    včetně sousedních, okna výskytů totiž přesahují půlnoc.
+    """
+    until = min(until, last_closed_day())
+    ids = iter(sorted(set(medication_ids)))
+    while since <= until and (batch := list(islice(ids, BATCH_SIZE))):
+        _ensure(batch, since, until, using)
+
+
+def refresh(since, until=None, batch_size=BATCH_SIZE):
+    """Předpočítá uzavřené dny od `since` pro všechny léky aktuálního shardu. Vrací počet léků."""
+    using = sharding.current_alias()
+    until = min(until or last_closed_day(), last_closed_day())
+    medications = Medication.objects.using(using).order_by('id').values_list('id', flat=True)
+    refreshed, after = 0, 0
+    while since <= until and (batch := list(medications.filter(id__gt=after)[:batch_size])):
+        _ensure(batch, since, until, using)
+        refreshed += len(batch)
+        after = batch[-1]
+    return refreshed
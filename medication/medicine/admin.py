@@ -1,3 +1,30 @@
 from django.contrib import admin
 
-# Register your models here.
+from .history import changed_by
+from .models import CareRelationship, Medication, Schedule
+
+
+class ChangedByAdmin(admin.ModelAdmin):
+    def save_model(self, request, obj, form, change):
+        changed_by(obj, request.user)
+        super().save_model(request, obj, form, change)
+
+
+@admin.register(Medication)
+class MedicationAdmin(ChangedByAdmin):
+    list_display = ('name', 'user', 'dosage', 'remaining_quantity', 'last_taken')
+    search_fields = ('name', 'user__username')
+
+
+@admin.register(Schedule)
+class ScheduleAdmin(ChangedByAdmin):
+    list_display = ('medication', 'describe')
+    list_select_related = ('medication',)
+
+
+@admin.register(CareRelationship)
+class CareRelationshipAdmin(admin.ModelAdmin):
+    list_display = ('clinician', 'patient', 'created_at')
+    list_select_related = ('clinician', 'patient')
+    raw_id_fields = ('clinician', 'patient')
+    search_fields = ('clinician__username', 'patient__username')
@@ -0,0 +1,44 @@
+import time
+
+from django.core.cache import cache
+from django.db import transaction
+
+from . import sharding
+
+GLOBAL = 'all'
+STATISTICS = 'statistics'
+
+
+def _version_key(namespace, scope):
+    return f"medicine:{namespace}:version:{scope}"
+
+
+def _fresh_version():
+    # Po vypadnutí klíče z cache nesmí verze začít znovu od čísla, pod kterým už něco leží
+    return time.time_ns()
+
+
+def versioned_key(namespace, user_id, *parts):
+    """Klíč pro data uživatele; mění se při každém zápisu uživatele i při globálním přepočtu."""
+    keys = [_version_key(namespace, GLOBAL), _version_key(namespace, user_id)]
+    versions = cache.get_many(keys)
+    for key in keys:
+        if key not in versions:
+            versions[key] = _fresh_version()
+            if not cache.add(key, versions[key], None):
+                versions[key] = cache.get(key, versions[key])
+    suffix = ':'.join(str(part) for part in parts)
+    return f"medicine:{namespace}:{versions[keys[0]]}:{user_id}:{versions[keys[1]]}:{suffix}"
+
+
+def bump(namespace, user_id=GLOBAL):
+    # Sdílená cache (soubory) nemá atomický incr: každé zneplatnění proto zapíše novou
+    # jedinečnou verzi, dva souběžné zápisy se tak nemohou slít do jedné
+    cache.set(_version_key(namespace, user_id), _fresh_version(), None)
+
+
+def bump_on_commit(namespace, user_ids, using=None):
+    """Zneplatní až po potvrzení transakce, jinak by se mohla uložit data před zápisem."""
+    user_ids = set(user_ids)
+    transaction.on_commit(
+        lambda: [bump(namespace, user_id) for user_id in user_ids], using=using or sharding.current_alias())
@@ -0,0 +1,119 @@
+import heapq
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from itertools import islice
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db.models import Count, F, Max, OuterRef, Q, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from . import adherence, sharding
+from .models import AdherenceDaily, CareRelationship, Medication, MedicationChangeHistory
+
+
+@dataclass
+class PatientSummary:
+    patient_id: int
+    username: str
+    medications: int = 0
+    low_stock: int = 0
+    out_of_stock: int = 0
+    last_dose_at: datetime | None = None
+    missed_today: int = 0
+    changes: int = 0
+
+    def _last_dose_key(self):
+        # Pacient, který ještě nic neužil, je na tom nejhůř
+        return self.last_dose_at.timestamp() if self.last_dose_at else float('-inf')
+
+
+# Naléhavost: vynechané dávky dnes, pak došlé a docházející léky, pak nejdéle bez dávky.
+# Řazení v SQL a stejný klíč v Pythonu pro slití stránek z více shardů.
+SORTS = {
+    'urgency': (
+        (F('missed_today').desc(), F('out_of_stock').desc(), F('low_stock').desc(),
+         F('last_dose_at').asc(nulls_first=True), 'username'),
+        lambda row: (-row.missed_today, -row.out_of_stock, -row.low_stock, row._last_dose_key(), row.username),
+    ),
+    'last_dose': (
+        (F('last_dose_at').asc(nulls_first=True), 'username'),
+        lambda row: (row._last_dose_key(), row.username),
+    ),
+    'name': (('username',), lambda row: row.username),
+}
+
+LOW_STOCK = Q(remaining_quantity__lt=F('refill_threshold') * F('dosage')) | Q(remaining_quantity__lt=F('dosage'))
+OUT_OF_STOCK = Q(remaining_quantity__lt=F('dosage'))
+
+
+def _per_user(grouped, aggregate):
+    """Korelovaný poddotaz: agregát řádků jednoho pacienta (seskupených podle něj), bez řádků nula."""
+    return Coalesce(Subquery(grouped.annotate(value=aggregate).values('value')), Value(0))
+
+
+def _ranked(alias, patient_ids, sort, limit, now):
+    """
+    Prvních `limit` pacientů jednoho shardu seřazených podle `sort`; jeden dotaz nad kopiemi uživatelů.
+
+    Vynechané dávky dnes se čtou z dnešních řádků AdherenceDaily, které
+    ensure_day() nejdřív doplní tam, kde chybí nebo už neplatí; počty jsou
+    tedy stejné jako v přehledu dodržování plánu.
+    """
+    today = timezone.localdate(now)
+    adherence.ensure_day(Medication.objects.filter(user_id__in=patient_ids), today, now, using=alias)
+    medications = Medication.objects.filter(user=OuterRef('pk')).order_by().values('user')
+    missed = AdherenceDaily.objects.filter(user=OuterRef('pk'), date=today).order_by().values('user')
+    changes = MedicationChangeHistory.objects.filter(
+        medication__user=OuterRef('pk'),
+        change_date__gte=now - timedelta(days=settings.MEDICINE_DASHBOARD_CHANGE_DAYS),
+    ).order_by().values('medication__user')
+    users = User.objects.using(alias) if sharding.enabled() else User.objects.all()
+    rows = users.filter(id__in=patient_ids).annotate(
+        medications=_per_user(medications, Count('id')),
+        low_stock=_per_user(medications.filter(LOW_STOCK), Count('id')),
+        out_of_stock=_per_user(medications.filter(OUT_OF_STOCK), Count('id')),
+        last_dose_at=Subquery(medications.annotate(value=Max('last_taken')).values('value')),
+        missed_today=_per_user(missed, Sum('missed')),
+        changes=_per_user(changes, Count('id')),
+    ).order_by(*SORTS[sort][0]).values_list(
+        'id', 'username', 'medications', 'low_stock', 'out_of_stock', 'last_dose_at', 'missed_today', 'changes',
+    )[:limit]
+    return [PatientSummary(*row) for row in rows]
+
+
+class SupervisedPatients:
+    """
+    Pacienti lékaře seřazení podle `sort` (klíč ze SORTS) pro Paginator.
+
+    Délka je počet vazeb, výřez seřadí a omezí databáze každého shardu
+    (pevný počet dotazů na shard) a stránky shardů se slijí. Pacient je
+    v shardu vždy, vazba ho zaregistruje (signál register_patient).
+    """
+
+    def __init__(self, clinician, sort='urgency', now=None):
+        self.patient_ids = list(
+            CareRelationship.objects.filter(clinician=clinician).values_list('patient_id', flat=True))
+        self.sort = sort
+        self.now = now or timezone.now()
+
+    def __len__(self):
+        return len(self.patient_ids)
+
+    def __getitem__(self, index):
+        if not isinstance(index, slice):
+            return self[index:index + 1][0]
+        start, stop, _ = index.indices(len(self))
+        if start >= stop:
+            return []
+        pages = []
+        for alias, patient_ids in sharding.group_by_shard(self.patient_ids).items():
+            with sharding.use_shard(alias):
+                pages.append(_ranked(alias, patient_ids, self.sort, stop, self.now))
+        return list(islice(heapq.merge(*pages, key=SORTS[self.sort][1]), start, stop))
+
+
+def summarize(clinician, sort='urgency', now=None):
+    """Přehled všech pacientů lékaře seřazený podle `sort`; `now` určuje dnešek a okno změn."""
+    return SupervisedPatients(clinician, sort, now)[:]
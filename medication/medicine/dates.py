@@ -0,0 +1,8 @@
+from datetime import datetime, time
+
+from django.utils import timezone
+
+
+def start_of_day(day):
+    """Začátek dne `day` (půlnoc) v místním časovém pásmu jako aware datetime."""
+    return timezone.make_aware(datetime.combine(day, time.min))
@@ -0,0 +1,30 @@
+import threading
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import transaction
+
+from . import sharding
+
+_write_lock = threading.RLock()
+
+
+@contextmanager
+def write_transaction(using=None):
+    """
+    Transakce pro zápis.
+
+    Se zapnutým SERIALIZE_DB_WRITES v rámci procesu zapisuje vždy jen jedno
+    vlákno, ostatní čekají na zámku v Pythonu místo opakovaného narážení na
+    "database is locked". Čtení mimo tento blok zámek nepotřebují.
+    Bez `using` se transakce otevře v aktuálním shardu.
+    """
+    using = using or sharding.current_alias()
+    if not getattr(settings, 'SERIALIZE_DB_WRITES', False):
+        with transaction.atomic(using=using):
+            yield
+        return
+
+    with _write_lock:
+        with transaction.atomic(using=using):
+            yield
@@ -0,0 +1,117 @@
+import csv
+import json
+import zlib
+from datetime import datetime, timedelta
+from itertools import chain
+
+from django.db import router
+from django.utils import timezone
+
+from .dates import start_of_day
+from .models import Log, MedicationChangeHistory
+
+BATCH_SIZE = 2000
+FORMATS = {'csv': 'text/csv', 'jsonl': 'application/x-ndjson'}
+
+# Sloupce exportu: název ve výstupu -> pole v dotazu
+COLUMNS = {
+    'doses': (Log, 'created_at', {
+        'id': 'id',
+        'medication_id': 'medication_id',
+        'medication': 'medication__name',
+        'taken_at': 'created_at',
+    }),
+    'changes': (MedicationChangeHistory, 'change_date', {
+        'id': 'id',
+        'medication_id': 'medication_id',
+        'medication': 'medication__name',
+        'changed_by': 'user__username',
+        'field': 'field_changed',
+        'old_value': 'old_value',
+        'new_value': 'new_value',
+        'changed_at': 'change_date',
+    }),
+}
+
+
+class _Echo:
+    # csv.writer potřebuje soubor, řádek se ale jen vrátí k odeslání
+    def write(self, value):
+        return value
+
+
+def export_queryset(kind, user, since=None, until=None, medication_id=None):
+    """Záznamy uživatele pro export; `since` a `until` jsou data včetně."""
+    model, date_field, columns = COLUMNS[kind]
+    queryset = model.objects.filter(medication__user=user)
+    if medication_id is not None:
+        queryset = queryset.filter(medication_id=medication_id)
+    if since:
+        queryset = queryset.filter(**{f'{date_field}__gte': start_of_day(since)})
+    if until:
+        queryset = queryset.filter(**{f'{date_field}__lt': start_of_day(until + timedelta(days=1))})
+    # Generátor běží až po návratu z middleware, databáze se proto určí teď
+    return queryset.using(router.db_for_read(model)).values_list(*columns.values())
+
+
+def _rows(queryset, batch_size):
+    # Krátké dávky podle id místo jednoho dlouhého kurzoru: čtení nedrží transakci po celou dobu stahování
+    after = 0
+    while batch := list(queryset.filter(id__gt=after).order_by('id')[:batch_size]):
+        yield from batch
+        after = batch[-1][0]
+
+
+def _value(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+
+def _lines(kind, queryset, fmt, batch_size, archived=()):
+    names = list(COLUMNS[kind][2])
+    rows = chain(archived, _rows(queryset, batch_size))
+    if fmt == 'csv':
+        writer = csv.writer(_Echo())
+        yield writer.writerow(names)
+        for row in rows:
+            yield writer.writerow([_value(value) for value in row])
+    else:
+        for row in rows:
+            yield json.dumps(dict(zip(names, map(_value, row))), ensure_ascii=False) + '\n'
+
+
+def _chunks(lines, size=64 * 1024):
+    # Jednotlivé řádky jsou na odesílání příliš malé, posílají se po blocích
+    buffer, length = [], 0
+    for line in lines:
+        data = line.encode('utf-8')
+        buffer.append(data)
+        length += len(data)
+        if length >= size:
+            yield b''.join(buffer)
+            buffer, length = [], 0
+    if buffer:
+        yield b''.join(buffer)
+
+
+def _gzip(chunks):
+    compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        if data := compressor.compress(chunk):
+            yield data
+    yield compressor.flush()
+
+
+def stream(kind, queryset, fmt='csv', compress=False, batch_size=BATCH_SIZE, archived=()):
+    """
+    Bajty exportu po částech; v paměti je nejvýš jedna dávka řádků.
+
+    `archived` jsou starší řádky z archivu (retention.read), vypíšou se před
+    řádky z databáze.
+    """
+    chunks = _chunks(_lines(kind, queryset, fmt, batch_size, archived))
+    return _gzip(chunks) if compress else chunks
+
+
+def filename(kind, fmt, compress=False):
+    name = f"{kind}-{timezone.localdate():%Y-%m-%d}.{fmt}"
+    return f"{name}.gz" if compress else name
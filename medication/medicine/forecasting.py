@@ -0,0 +1,176 @@
+from datetime import timedelta
+
+import numpy as np
+from django.db import connections
+from django.db.models import Q, Sum
+from django.utils import timezone
+
+from . import caching, rollups, sharding
+from .db import write_transaction
+from .models import DoseDailyRollup, Medication, RunOutForecast, Schedule
+
+BATCH_SIZE = 50000
+# Za kolik posledních dní se počítá skutečné tempo užívání
+WINDOW_DAYS = 28
+# Delší odhad nemá smysl, lék se reálně doplní dřív
+MAX_DAYS = 3650
+
+
+def _upsert_sql(connection):
+    forecast = connection.ops.quote_name(RunOutForecast._meta.db_table)
+    return f"""
+        INSERT INTO {forecast} (medication_id, user_id, doses_per_day, run_out_date, updated_at)
+        VALUES (%s, %s, %s, %s, %s)
+        ON CONFLICT (medication_id) DO UPDATE SET
+            user_id = excluded.user_id,
+            doses_per_day = excluded.doses_per_day,
+            run_out_date = excluded.run_out_date,
+            updated_at = excluded.updated_at
+    """
+
+
+def _spread(ids, keys, values):
+    """Hodnoty seskupené podle léku rozloží do sloupce zarovnaného s `ids`, chybějící jsou 0."""
+    column = np.zeros(len(ids))
+    if len(keys):
+        column[np.searchsorted(ids, keys)] = values
+    return column
+
+
+def weekly_doses(weekdays, times, interval_hours):
+    """Plánovaných dávek za týden podle kompaktního plánu."""
+    days = bin(weekdays).count('1')
+    if interval_hours:
+        return days * 24 / interval_hours
+    return days * len(times)
+
+
+def project(remaining, dosage, weekly, recent, window_days=WINDOW_DAYS):
+    """
+    Tempo užívání a počet dní do vyčerpání pro sloupce léků najednou.
+
+    Tempo je průměr plánovaných dávek za den (z týdenního rozvrhu) a skutečně
+    užitých za posledních `window_days` dní; když jedno z nich chybí, platí
+    druhé. Lék bez tempa nedojde (nekonečno).
+    """
+    scheduled = weekly / 7
+    observed = recent / window_days
+    rate = np.where((scheduled > 0) & (observed > 0), (scheduled + observed) / 2, np.maximum(scheduled, observed))
+    doses_left = remaining // np.maximum(dosage, 1)
+    days = np.divide(doses_left, rate, out=np.full(len(rate), np.inf), where=rate > 0)
+    return rate, days
+
+
+def _run_out_dates(today, days):
+    # Nekonečno (lék se neužívá) je NaT, tolist() z něj udělá None
+    dates = np.full(len(days), np.datetime64('NaT'), dtype='datetime64[D]')
+    finite = np.isfinite(days)
+    dates[finite] = np.datetime64(today) + np.minimum(np.floor(days[finite]), MAX_DAYS).astype('timedelta64[D]')
+    return dates
+
+
+def _changed(ids, users, rates, dates, alias):
+    """Maska léků, jejichž uložený odhad chybí nebo se liší; nezměněné se nepřepisují."""
+    stored = list(
+        RunOutForecast.objects.using(alias).filter(medication_id__gte=ids[0], medication_id__lte=ids[-1])
+        .order_by('medication_id')
+        .values_list('medication_id', 'user_id', 'doses_per_day', 'run_out_date')
+    )
+    changed = np.ones(len(ids), dtype=bool)
+    if not stored:
+        return changed
+    stored_ids, stored_users, stored_rates, stored_dates = zip(*stored)
+    positions = np.searchsorted(ids, stored_ids)
+    # NaT se porovná jako stejné číslo, prázdné datum se tak shoduje s prázdným
+    changed[positions] = (
+        (users[positions] != np.array(stored_users))
+        | (rates[positions] != np.array(stored_rates))
+        | (dates[positions].view(np.int64) != np.array(stored_dates, dtype='datetime64[D]').view(np.int64))
+    )
+    return changed
+
+
+def _forecast_batch(medications, today, alias):
+    ids = np.fromiter((row[0] for row in medications), dtype=np.int64, count=len(medications))
+    low, high = int(ids[0]), int(ids[-1])
+    in_batch = {'medication_id__gte': low, 'medication_id__lte': high}
+
+    # Plány platné dnes; týdenní počet dávek se spočítá z kompaktního tvaru v paměti
+    schedules = list(
+        Schedule.objects.using(alias).filter(**in_batch)
+        .filter(Q(start_date__isnull=True) | Q(start_date__lte=today))
+        .filter(Q(end_date__isnull=True) | Q(end_date__gte=today))
+        .values_list('medication_id', 'weekdays', 'times', 'interval_hours')
+    )
+    recent = (
+        DoseDailyRollup.objects.using(alias).filter(date__gt=today - timedelta(days=WINDOW_DAYS), **in_batch)
+        .values('medication_id')
+        .annotate(doses=Sum('doses'))
+        .order_by('medication_id')
+        .values_list('medication_id', 'doses')
+    )
+    weekly = np.zeros(len(ids))
+    np.add.at(
+        weekly,
+        np.searchsorted(ids, np.fromiter((row[0] for row in schedules), dtype=np.int64, count=len(schedules))),
+        np.fromiter((weekly_doses(*row[1:]) for row in schedules), dtype=float, count=len(schedules)),
+    )
+    recent = np.array(list(recent), dtype=np.int64).reshape(-1, 2)
+
+    columns = np.array([row[1:] for row in medications], dtype=np.int64)
+    rate, days = project(
+        remaining=columns[:, 1], dosage=columns[:, 2],
+        weekly=weekly,
+        recent=_spread(ids, recent[:, 0], recent[:, 1]),
+    )
+
+    users, rate, dates = columns[:, 0], np.round(rate, 4), _run_out_dates(today, days)
+    changed = _changed(ids, users, rate, dates, alias)
+    if not changed.any():
+        return 0
+
+    connection = connections[alias]
+    now = connection.ops.adapt_datetimefield_value(timezone.now())
+    params = zip(
+        ids[changed].tolist(), users[changed].tolist(), rate[changed].tolist(),
+        [connection.ops.adapt_datefield_value(day) for day in dates[changed].tolist()],
+        [now] * int(changed.sum()),
+    )
+    with write_transaction(using=alias):
+        with connection.cursor() as cursor:
+            cursor.executemany(_upsert_sql(connection), list(params))
+    return int(changed.sum())
+
+
+def refresh(batch_size=BATCH_SIZE):
+    """
+    Přepočítá odhady vyčerpání všech léků v aktuálním shardu.
+
+    Léky se čtou po dávkách jako sloupce, rozvrhy a nedávné dávky jedním
+    seskupeným dotazem na dávku a výpočet běží v NumPy nad celými sloupci.
+    Zapisují se jen změněné odhady. Vrací (počet léků, počet změněných odhadů).
+    """
+    alias = sharding.current_alias()
+    # Skutečné tempo se bere z denních souhrnů, musí být aktuální
+    rollups.refresh()
+    today = timezone.localdate()
+    medications = Medication.objects.using(alias).order_by('id').values_list(
+        'id', 'user_id', 'remaining_quantity', 'dosage')
+    forecast, changed, after = 0, 0, 0
+    while batch := list(medications.filter(id__gt=after)[:batch_size]):
+        changed += _forecast_batch(batch, today, alias)
+        forecast += len(batch)
+        after = batch[-1][0]
+    if changed:
+        caching.bump_on_commit(caching.STATISTICS, [caching.GLOBAL], using=alias)
+    return forecast, changed
+
+
+def running_out(user, days):
+    """Odhady léků uživatele, které dojdou do `days` dní, od nejbližšího."""
+    until = timezone.localdate() + timedelta(days=days)
+    return (
+        RunOutForecast.objects.filter(user=user, run_out_date__lte=until)
+        .select_related('medication')
+        .order_by('run_out_date')
+    )
@@ -5,10 +5,54 @@ from .models import Medication, Schedule
 class MedicationForm(forms.ModelForm):
     class Meta:
         model = Medication
-        fields = ['name', 'dosage', 'notes', 'remaining_quantity']
+        fields = ['name', 'dosage', 'notes', 'remaining_quantity', 'refill_threshold']
 
 
 class ScheduleForm(forms.ModelForm):
+    weekdays = forms.MultipleChoiceField(
+        choices=Schedule.DAY_OF_WEEK, required=False, widget=forms.CheckboxSelectMultiple,
+        label="Dny v týdnu", help_text="Bez zaškrtnutí platí každý den.")
+    times = forms.CharField(
+        required=False, label="Časy užívání", help_text="Oddělené čárkou, např. 08:00, 20:00.")
+
     class Meta:
         model = Schedule
-        fields = ['day_of_week','time']
\ No newline at end of file
+        fields = ['weekdays', 'times', 'interval_hours', 'start_date', 'end_date']
+        labels = {
+            'interval_hours': "Každých kolik hodin",
+            'start_date': "Od",
+            'end_date': "Do",
+        }
+        widgets = {
+            'start_date': forms.DateInput(attrs={'type': 'date'}),
+            'end_date': forms.DateInput(attrs={'type': 'date'}),
+        }
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        if self.instance.pk:
+            self.initial['weekdays'] = self.instance.weekday_names()
+            self.initial['times'] = ", ".join(self.instance.time_labels())
+
+    def clean_weekdays(self):
+        days = [day for day, _ in Schedule.DAY_OF_WEEK]
+        chosen = self.cleaned_data['weekdays']
+        if not chosen:
+            return Schedule.EVERY_DAY
+        return sum(1 << days.index(day) for day in set(chosen))
+
+    def clean_times(self):
+        minutes = []
+        for part in self.cleaned_data['times'].split(','):
+            if not part.strip():
+                continue
+            try:
+                value = forms.TimeField().to_python(part.strip())
+            except forms.ValidationError:
+                raise forms.ValidationError(f"Neplatný čas: {part.strip()}")
+            minutes.append(value.hour * 60 + value.minute)
+        return sorted(set(minutes))
+
+    def is_empty(self):
+        """Formulář bez časů i intervalu plán nevytváří."""
+        return not (self.cleaned_data.get('times') or self.cleaned_data.get('interval_hours'))
@@ -0,0 +1,58 @@
+from django.core.cache import cache
+from django.db.models import Exists, F, OuterRef, Prefetch, prefetch_related_objects
+from django.db.models.functions import NullIf
+from django.template.backends.utils import csrf_input
+from django.template.loader import render_to_string
+from django.utils.safestring import mark_safe
+
+from .models import Schedule
+
+CARD_TEMPLATE = 'medication_card.html'
+# Zvýšit při změně šablony karty, staré fragmenty se tím přestanou používat
+CARD_TEMPLATE_VERSION = 3
+CARD_CACHE_TIMEOUT = 24 * 60 * 60
+# Fragmenty jsou sdílené mezi požadavky, CSRF token se dosazuje až při výdeji
+CSRF_PLACEHOLDER = mark_safe('<!-- csrf -->')
+
+
+def with_card_data(queryset):
+    """Doplní hodnoty, které karta léku zobrazuje, přímo do dotazu na léky."""
+    return queryset.annotate(
+        has_schedule=Exists(Schedule.objects.filter(medication=OuterRef('pk'))),
+        doses_left=F('remaining_quantity') / NullIf(F('dosage'), 0),
+    )
+
+
+def card_key(medication):
+    # Id léků se opakují napříč shardy, dvojice s uživatelem je jednoznačná
+    return f"medicine:card:{CARD_TEMPLATE_VERSION}:{medication.user_id}:{medication.id}:{medication.version}"
+
+
+def render_cards(request, medications):
+    """
+    Vrátí HTML karet v pořadí `medications`.
+
+    Karty se berou z cache podle verze léku, vykreslí se jen chybějící
+    a jen pro ně se načtou plány.
+    """
+    medications = list(medications)
+    keys = [card_key(medication) for medication in medications]
+    cards = cache.get_many(keys)
+
+    missing = [medication for medication, key in zip(medications, keys) if key not in cards]
+    if missing:
+        prefetch_related_objects(missing, Prefetch('schedule_set', queryset=Schedule.objects.order_by('id')))
+        rendered = {
+            card_key(medication): render_to_string(
+                CARD_TEMPLATE, {'medication': medication, 'csrf_input': CSRF_PLACEHOLDER})
+            for medication in missing
+        }
+        cache.set_many(rendered, CARD_CACHE_TIMEOUT)
+        cards.update(rendered)
+
+    token = csrf_input(request)
+    return [mark_safe(cards[key].replace(CSRF_PLACEHOLDER, token)) for key in keys]
+
+
+def render_card(request, medication):
+    return render_cards(request, [medication])[0]
@@ -0,0 +1,49 @@
+from .models import MedicationChangeHistory, Schedule
+
+
+def changed_by(instance, user):
+    """Označí, kdo změnu provádí; bez označení se změna připíše vlastníkovi léku."""
+    instance._changed_by = user
+    return instance
+
+
+def _rows(medication_id, user_id, changes, prefix=''):
+    return [
+        MedicationChangeHistory(
+            medication_id=medication_id,
+            user_id=user_id,
+            field_changed=f"{prefix}{field}",
+            old_value=str(old_value),
+            new_value=str(new_value),
+        )
+        for field, old_value, new_value in changes
+    ]
+
+
+def record_instance_changes(instance):
+    """Zapíše změny sledovaných polí od posledního snímku jedním INSERT."""
+    changes = instance.tracked_changes()
+    if changes:
+        user = getattr(instance, '_changed_by', None)
+        if isinstance(instance, Schedule):
+            owner_id = instance.user_id or instance.medication.user_id
+            rows = _rows(instance.medication_id, getattr(user, 'pk', user) or owner_id, changes, 'schedule.')
+        else:
+            rows = _rows(instance.pk, getattr(user, 'pk', user) or instance.user_id, changes)
+        MedicationChangeHistory.objects.using(instance._state.db).bulk_create(rows)
+    instance.take_snapshot()
+
+
+def record_bulk_changes(changes, user):
+    """
+    Zápis změn z hromadných cest, které obcházejí save().
+
+    `changes` jsou n-tice (medication_id, pole, stará hodnota, nová hodnota),
+    vše se zapíše jedním bulk_create.
+    """
+    user_id = getattr(user, 'pk', user)
+    rows = []
+    for medication_id, field, old_value, new_value in changes:
+        if old_value != new_value:
+            rows.extend(_rows(medication_id, user_id, [(field, old_value, new_value)]))
+    MedicationChangeHistory.objects.bulk_create(rows)
@@ -0,0 +1,166 @@
+import csv
+import json
+
+from django import forms
+
+from . import caching
+from .db import write_transaction
+from .forms import MedicationForm, ScheduleForm
+from .models import Medication, Schedule
+from .occurrences import compact_slots
+
+BATCH_SIZE = 500
+FORMATS = ('csv', 'jsonl')
+
+
+class InvalidImport(ValueError):
+    pass
+
+
+def detect_format(filename):
+    for fmt in FORMATS:
+        if filename.lower().endswith(f'.{fmt}'):
+            return fmt
+    raise InvalidImport("Soubor musí mít příponu .csv nebo .jsonl.")
+
+
+def _records(lines, fmt):
+    """(číslo řádku, slovník) pro každý záznam souboru; soubor se čte průběžně."""
+    if fmt == 'csv':
+        reader = csv.DictReader(lines)
+        for row in reader:
+            yield reader.line_num, row
+        return
+    for number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError:
+            yield number, None
+            continue
+        yield number, row
+
+
+def _slot(day, time):
+    """Starý zápis (den, čas) jako (den v týdnu 0–6 nebo None, minuta nebo None); neplatný je None."""
+    days = [name for name, _ in Schedule.DAY_OF_WEEK]
+    if day and day not in days:
+        return None
+    minute = None
+    if time:
+        try:
+            value = forms.TimeField().to_python(time)
+        except forms.ValidationError:
+            return None
+        minute = value.hour * 60 + value.minute
+    return days.index(day) if day else None, minute
+
+
+def _schedule_data(value):
+    """
+    Data formulářů kompaktních plánů. Plány jsou seznam {weekdays, times,
+    interval_hours, start_date, end_date}, nebo ve starém tvaru {day_of_week, time},
+    nebo v CSV text "Monday 08:00; 20:00" (den je nepovinný, plán bez dne platí denně).
+    Starý tvar se sloučí: časy se stejnými dny dají jeden plán.
+    """
+    if not value:
+        return []
+    if isinstance(value, list):
+        entries = value
+    else:
+        entries = []
+        for part in str(value).split(';'):
+            day, _, time = part.strip().rpartition(' ')
+            entries.append({'day_of_week': day.strip(), 'time': time})
+
+    schedules, slots = [], []
+    for entry in entries:
+        if isinstance(entry, dict) and ('day_of_week' in entry or 'time' in entry):
+            slot = _slot(entry.get('day_of_week'), entry.get('time'))
+            if slot is None:
+                # Neplatný den nebo čas nahlásí formulář
+                schedules.append({'weekdays': [entry.get('day_of_week')], 'times': entry.get('time') or ''})
+            else:
+                slots.append(slot)
+        elif isinstance(entry, dict) and isinstance(entry.get('times'), list):
+            schedules.append({**entry, 'times': ", ".join(map(str, entry['times']))})
+        else:
+            schedules.append(entry)
+    for mask, minutes in compact_slots(slots):
+        schedules.append({
+            'weekdays': [day for index, (day, _) in enumerate(Schedule.DAY_OF_WEEK) if mask >> index & 1],
+            'times': ", ".join(f"{minute // 60:02d}:{minute % 60:02d}" for minute in minutes),
+        })
+    return schedules
+
+
+def _validate(row):
+    """Neuložený lék a plány, nebo chyby podle pravidel formulářů."""
+    if not isinstance(row, dict):
+        return None, None, {'__all__': ["Řádek není platný záznam."]}
+    form = MedicationForm(data=row)
+    errors = {} if form.is_valid() else {field: list(messages) for field, messages in form.errors.items()}
+    schedules = []
+    try:
+        schedule_data = _schedule_data(row.get('schedules'))
+    except (TypeError, AttributeError):
+        schedule_data, errors['schedules'] = [], ["Neplatný zápis plánů."]
+    for index, data in enumerate(schedule_data):
+        schedule_form = ScheduleForm(data=data if isinstance(data, dict) else {})
+        if schedule_form.is_valid():
+            schedules.append(schedule_form.save(commit=False))
+        else:
+            errors[f'schedules[{index}]'] = [
+                f"{field}: {message}" for field, messages in schedule_form.errors.items() for message in messages]
+    if errors:
+        return None, None, errors
+    return form.save(commit=False), schedules, None
+
+
+def _insert(user, batch):
+    """Jedna dávka: léky a plány se sloty po jednom bulk_create, bez signálů."""
+    with write_transaction():
+        # SQLite vrací id z bulk_create, plány se tak navážou na stejné objekty
+        medications = Medication.objects.bulk_create([medication for medication, _ in batch])
+        schedules = []
+        for medication, medication_schedules in batch:
+            for schedule in medication_schedules:
+                schedule.medication = medication
+                schedule.user = user
+                # bulk_create obchází save(), časy se musí seřadit tady
+                schedule.normalize()
+                schedules.append(schedule)
+        Schedule.objects.bulk_create(schedules)
+        Schedule.store_slots(schedules, replace=False)
+        # Statistiky vzniknou s první dávkou stejně jako u léků zadaných ručně
+        caching.bump_on_commit(caching.STATISTICS, [user.pk])
+    return len(medications), len(schedules)
+
+
+def import_medications(user, lines, fmt, batch_size=BATCH_SIZE):
+    """
+    Naimportuje léky s plány z CSV nebo JSON řádků.
+
+    Řádky se ověřují stejnými formuláři jako ruční zadání, platné se vkládají
+    po dávkách. Chybné řádky se přeskočí a vrátí v seznamu chyb s číslem řádku.
+    """
+    result = {'medications': 0, 'schedules': 0, 'errors': []}
+    batch = []
+    for line, row in _records(lines, fmt):
+        medication, schedules, errors = _validate(row)
+        if errors:
+            result['errors'].append({'line': line, 'errors': errors})
+            continue
+        medication.user = user
+        batch.append((medication, schedules))
+        if len(batch) >= batch_size:
+            created, scheduled = _insert(user, batch)
+            result['medications'] += created
+            result['schedules'] += scheduled
+            batch = []
+    if batch:
+        created, scheduled = _insert(user, batch)
+        result['medications'] += created
+        result['schedules'] += scheduled
+    return result
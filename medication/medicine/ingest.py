@@ -0,0 +1,142 @@
+from collections import defaultdict
+from datetime import timedelta
+
+from django.db import OperationalError
+from django.db.models import Case, DateTimeField, F, Value, When
+from django.db.models.functions import Coalesce, Greatest
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from . import adherence, caching, sharding, statistics
+from .db import write_transaction
+from .models import Log, Medication
+
+MAX_BATCH_SIZE = 1000
+MAX_ATTEMPTS = 3
+CLOCK_SKEW = timedelta(minutes=5)
+
+
+class _Conflict(Exception):
+    pass
+
+
+class IngestConflict(RuntimeError):
+    """Zásobu mezi čtením a zápisem opakovaně měnil jiný požadavek."""
+
+
+class IngestBusy(RuntimeError):
+    """Databáze zůstala zamčená i po opakování."""
+
+
+def _parse_event(event):
+    if not isinstance(event, dict):
+        return None, None, "Událost musí být objekt."
+    med_id = event.get('med_id')
+    if not isinstance(med_id, int) or isinstance(med_id, bool):
+        return None, None, "Chybí med_id."
+
+    taken_at = event.get('taken_at')
+    try:
+        taken_at = parse_datetime(taken_at) if isinstance(taken_at, str) else None
+    except ValueError:
+        taken_at = None
+    if taken_at is None:
+        return None, None, "Neplatné taken_at."
+    if timezone.is_naive(taken_at):
+        taken_at = timezone.make_aware(taken_at)
+    if taken_at > timezone.now() + CLOCK_SKEW:
+        return None, None, "taken_at je v budoucnosti."
+    return med_id, taken_at, None
+
+
+def ingest_dose_events(user, events):
+    """
+    Zapíše dávku událostí {med_id, taken_at} v jedné transakci.
+
+    Vlastnictví se ověří jedním dotazem, zásoby se odečtou seskupenými
+    podmíněnými UPDATE (jeden na každý počet dávek), Logy se vloží přes
+    bulk_create. Vrací výsledek pro každou událost ve stejném pořadí.
+    """
+    results = [None] * len(events)
+    parsed = []
+    for index, event in enumerate(events):
+        med_id, taken_at, error = _parse_event(event)
+        if error:
+            results[index] = {'index': index, 'status': 'invalid', 'error': error}
+        else:
+            parsed.append((index, med_id, taken_at))
+
+    for attempt in range(MAX_ATTEMPTS):
+        try:
+            with sharding.for_user(user), write_transaction():
+                applied = _apply(user, parsed)
+            break
+        except _Conflict:
+            # Mezi čtením a zápisem zásobu změnil jiný požadavek, dávku zkusíme znovu
+            if attempt == MAX_ATTEMPTS - 1:
+                raise IngestConflict("Zásobu souběžně mění jiný požadavek.")
+        except OperationalError as exc:
+            # Zámek se nepodařilo získat ani po busy timeoutu
+            if 'locked' not in str(exc):
+                raise
+            if attempt == MAX_ATTEMPTS - 1:
+                raise IngestBusy("Databáze je zaneprázdněná.") from exc
+
+    for index, result in applied.items():
+        results[index] = result
+    return results
+
+
+def _apply(user, parsed):
+    ids = {med_id for _, med_id, _ in parsed}
+    stock = dict(
+        Medication.objects.select_for_update()
+        .filter(user=user, id__in=ids)
+        .values_list('id', 'remaining_quantity')
+    )
+
+    results = {}
+    accepted = defaultdict(list)
+    for index, med_id, taken_at in sorted(parsed, key=lambda event: event[2]):
+        if med_id not in stock:
+            results[index] = {'index': index, 'med_id': med_id, 'status': 'not_found'}
+        elif len(accepted[med_id]) >= stock[med_id]:
+            results[index] = {'index': index, 'med_id': med_id, 'status': 'out_of_stock'}
+        else:
+            accepted[med_id].append((index, taken_at))
+
+    by_count = defaultdict(list)
+    for med_id, taken in accepted.items():
+        by_count[len(taken)].append(med_id)
+
+    for count, med_ids in by_count.items():
+        last_taken = Case(
+            *[When(id=med_id, then=Value(accepted[med_id][-1][1])) for med_id in med_ids],
+            output_field=DateTimeField(),
+        )
+        updated = Medication.objects.filter(id__in=med_ids, remaining_quantity__gte=count).update(
+            remaining_quantity=F('remaining_quantity') - count,
+            last_taken=Greatest(Coalesce('last_taken', last_taken), last_taken),
+            version=F('version') + 1,
+        )
+        if updated != len(med_ids):
+            raise _Conflict()
+
+    pending = [
+        (index, Log(medication_id=med_id, created_at=taken_at))
+        for med_id, taken in accepted.items()
+        for index, taken_at in taken
+    ]
+    Log.objects.bulk_create([log for _, log in pending])
+    # Dávky z offline zařízení mohou patřit ke dnům s už spočítaným dodržováním
+    adherence.invalidate_doses((log.medication_id, log.created_at) for _, log in pending)
+    statistics.record_doses(
+        (med_id, len(taken), taken[0][1], taken[-1][1]) for med_id, taken in accepted.items()
+    )
+    # Užití dávky se zapisuje do Logu, ne do historie změn, stejně jako u Medication.take_dose;
+    # historie zásoby zachycuje jen ruční opravy (add_dose, úprava léku)
+    caching.bump_on_commit(caching.STATISTICS, [getattr(user, 'pk', user)])
+
+    for index, log in pending:
+        results[index] = {'index': index, 'med_id': log.medication_id, 'status': 'ok', 'log_id': log.id}
+    return results
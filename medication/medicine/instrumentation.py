@@ -0,0 +1,95 @@
+import re
+import time
+from collections import Counter
+from contextlib import ExitStack, contextmanager
+from contextvars import ContextVar
+
+from django.db import connections
+from django.template.backends.django import DjangoTemplates, Template
+
+_current = ContextVar('medicine_request_stats', default=None)
+
+_IN_LIST = re.compile(r'\((?:%s, )+%s\)')
+_WHITESPACE = re.compile(r'\s+')
+
+
+def fingerprint(sql):
+    """SQL bez proměnné délky seznamů IN, aby se stejné dotazy seskupily."""
+    return _WHITESPACE.sub(' ', _IN_LIST.sub('(%s…)', sql)).strip()
+
+
+class RequestStats:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.total_ms = 0.0
+        self.query_count = 0
+        self.sql_ms = 0.0
+        self.template_ms = 0.0
+        self.fingerprints = Counter()
+        self._rendering = False
+
+    def __call__(self, execute, sql, params, many, context):
+        # execute_wrapper: měří každý dotaz na všech spojeních
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.sql_ms += (time.perf_counter() - started) * 1000
+            self.query_count += 1
+            self.fingerprints[fingerprint(sql)] += 1
+
+    def duplicates(self, limit=5):
+        return [(sql, count) for sql, count in self.fingerprints.most_common(limit) if count > 1]
+
+    def server_timing(self):
+        return ', '.join([
+            f'db;desc="SQL ({self.query_count})";dur={self.sql_ms:.1f}',
+            f'tpl;dur={self.template_ms:.1f}',
+            f'total;dur={self.total_ms:.1f}',
+        ])
+
+
+@contextmanager
+def measure(stats=None):
+    """
+    Po dobu bloku sbírá dotazy ze všech databází a čas vykreslení šablon.
+
+    Předané `stats` se doplní, stejná měření tak lze navázat třeba při čtení
+    streamované odpovědi. Celkový čas se sčítá za všechny bloky.
+    """
+    stats = stats or RequestStats()
+    started = time.perf_counter()
+    token = _current.set(stats)
+    try:
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(stats))
+            yield stats
+    finally:
+        stats.total_ms += (time.perf_counter() - started) * 1000
+        _current.reset(token)
+
+
+class TimedTemplate(Template):
+    def render(self, context=None, request=None):
+        stats = _current.get()
+        # Mimo měření nebo ve vnořeném vykreslení (render_to_string uvnitř šablony) se neměří
+        if stats is None or stats._rendering:
+            return super().render(context, request)
+        stats._rendering = True
+        started = time.perf_counter()
+        try:
+            return super().render(context, request)
+        finally:
+            stats.template_ms += (time.perf_counter() - started) * 1000
+            stats._rendering = False
+
+
+class TimedDjangoTemplates(DjangoTemplates):
+    """Backend šablon Django, který čas vykreslení připíše aktuálnímu měření (viz measure)."""
+
+    def from_string(self, template_code):
+        return TimedTemplate(super().from_string(template_code).template, self)
+
+    def get_template(self, template_name):
+        return TimedTemplate(super().get_template(template_name).template, self)
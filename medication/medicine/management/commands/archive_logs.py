@@ -0,0 +1,28 @@
+from collections import Counter
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from medicine import retention, sharding
+
+
+class Command(BaseCommand):
+    help = (
+        "Přesune dávky a změny starší než retenční lhůta do komprimovaného archivu "
+        "a v databázi ponechá jen denní souhrny."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=settings.MEDICINE_RETENTION_DAYS,
+                            help="Ponechat v databázi posledních N dní.")
+        parser.add_argument('--batch-size', type=int, default=retention.BATCH_SIZE)
+        parser.add_argument('--pause', type=float, default=0.0, help="Pauza mezi dávkami v sekundách.")
+
+    def handle(self, *args, **options):
+        archived = Counter()
+        for alias in sharding.shard_aliases():
+            with sharding.use_shard(alias):
+                archived.update(retention.archive(options['days'], options['batch_size'], options['pause']))
+        self.stdout.write(self.style.SUCCESS(
+            f"Archivováno: dávky {archived['doses']}, změny {archived['changes']} do {settings.MEDICINE_ARCHIVE_DIR}"
+        ))
@@ -0,0 +1,139 @@
+import random
+import statistics
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from io import StringIO
+from pathlib import Path
+
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, OperationalError, connections
+from django.test.utils import override_settings
+
+from medicine import sharding
+from medicine.models import Log, Medication
+
+PROFILES = ('development', 'production')
+
+
+def _profile_settings(profile):
+    """Nastavení hlavní databáze a zámku zápisů tak, jak je zapne MEDICATION_DB_PROFILE."""
+    if profile == 'production':
+        database = {
+            'CONN_MAX_AGE': 600,
+            'CONN_HEALTH_CHECKS': True,
+            'OPTIONS': {**settings.SQLITE_OPTIONS, 'init_command': settings.SQLITE_INIT_COMMAND},
+        }
+    else:
+        database = {'CONN_MAX_AGE': 0, 'CONN_HEALTH_CHECKS': False, 'OPTIONS': dict(settings.SQLITE_OPTIONS)}
+    return database, profile == 'production'
+
+
+@contextmanager
+def _profile_database(path, profile):
+    """
+    Po dobu bloku vede spojení `default` do dočasné databáze `path` s nastavením profilu.
+
+    Vlákna si spojení zakládají z téhož slovníku nastavení, na konci se vrátí původní hodnoty.
+    """
+    database, serialize = _profile_settings(profile)
+    configured = connections.settings[DEFAULT_DB_ALIAS]
+    original = {name: configured.get(name) for name in ('NAME', *database)}
+    connections[DEFAULT_DB_ALIAS].close()
+    configured.update(database, NAME=path)
+    try:
+        with override_settings(SERIALIZE_DB_WRITES=serialize):
+            yield
+    finally:
+        connections[DEFAULT_DB_ALIAS].close()
+        configured.update(original)
+
+
+class Command(BaseCommand):
+    help = (
+        "Porovná propustnost smíšeného čtení a zápisu SQLite ve vývojovém a produkčním profilu. "
+        "Běží přes spojení Django a write_transaction nad dočasnou kopií schématu aplikace."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=8)
+        parser.add_argument('--duration', type=float, default=5.0, help="Délka běhu každého profilu v sekundách.")
+        parser.add_argument('--write-ratio', type=float, default=0.2)
+        parser.add_argument('--users', type=int, default=100)
+        parser.add_argument('--medications', type=int, default=20, help="Léků na uživatele.")
+        parser.add_argument('--seed', type=int, default=42)
+
+    def handle(self, *args, **options):
+        if sharding.enabled():
+            raise CommandError("Měření běží nad hlavní databází, spusťte ho bez MEDICATION_SHARDS.")
+
+        self.stdout.write(
+            f"{'profil':<12} {'op/s':>9} {'čtení/s':>9} {'zápisy/s':>9} {'chyby':>6} {'p50 ms':>8} {'p95 ms':>8}")
+        for profile in PROFILES:
+            with tempfile.TemporaryDirectory() as directory, \
+                    _profile_database(str(Path(directory) / 'bench.sqlite3'), profile):
+                medications = self.seed(options)
+                result = self.run_profile(medications, options)
+            self.stdout.write(
+                f"{profile:<12} {result['ops'] / options['duration']:>9.0f} "
+                f"{result['reads'] / options['duration']:>9.0f} {result['writes'] / options['duration']:>9.0f} "
+                f"{result['errors']:>6} {result['p50']:>8.2f} {result['p95']:>8.2f}"
+            )
+
+    def seed(self, options):
+        """Schéma z migrací a ukázkoví uživatelé; zásoba léků během měření nedojde."""
+        call_command('migrate', verbosity=0, interactive=False)
+        call_command(
+            'seed_demo_data', users=options['users'], medications=options['medications'], schedules=0,
+            years=0, changes=0, patients=0, prefix='bench', seed=options['seed'], stdout=StringIO())
+        Medication.objects.update(remaining_quantity=10 ** 6)
+        return list(Medication.objects.values_list('id', 'user_id'))
+
+    def run_profile(self, medications, options):
+        deadline = time.monotonic() + options['duration']
+        results = []
+
+        def worker(index):
+            rng = random.Random(options['seed'] + index)
+            reads = writes = errors = 0
+            latencies = []
+            while time.monotonic() < deadline:
+                medication_id, user_id = rng.choice(medications)
+                started = time.perf_counter()
+                try:
+                    if rng.random() < options['write_ratio']:
+                        # Stejná cesta jako pohled mark_as_taken: podmíněný UPDATE a Log ve write_transaction
+                        Medication.take_dose(medication_id, user_id)
+                        writes += 1
+                    else:
+                        list(Medication.objects.filter(user_id=user_id).values('id', 'name', 'remaining_quantity'))
+                        Log.objects.filter(medication_id=medication_id).count()
+                        reads += 1
+                except OperationalError:
+                    errors += 1
+                latencies.append((time.perf_counter() - started) * 1000)
+                # Konec požadavku: vývojový profil (CONN_MAX_AGE = 0) spojení zavře, produkční ho drží
+                connections[DEFAULT_DB_ALIAS].close_if_unusable_or_obsolete()
+            connections[DEFAULT_DB_ALIAS].close()
+            results.append((reads, writes, errors, latencies))
+
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(options['threads'])]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        latencies = sorted(latency for *_, thread_latencies in results for latency in thread_latencies)
+        reads = sum(result[0] for result in results)
+        writes = sum(result[1] for result in results)
+        return {
+            'ops': reads + writes,
+            'reads': reads,
+            'writes': writes,
+            'errors': sum(result[2] for result in results),
+            'p50': statistics.median(latencies) if latencies else 0,
+            'p95': latencies[int(len(latencies) * 0.95)] if latencies else 0,
+        }
@@ -0,0 +1,163 @@
+import json
+import math
+import threading
+import time
+from pathlib import Path
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.test import Client
+from django.test.utils import override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from medicine import instrumentation, sharding, urls
+from medicine.models import Medication
+
+BUDGETS_FILE = Path(__file__).resolve().parents[2] / 'query_budgets.json'
+
+
+def _requests(medication_id):
+    """Požadavek pro každou cestu v medicine/urls.py: (název, metoda, cesta, data)."""
+    payloads = {
+        'mark_as_taken': ('post', {}),
+        'add_dose': ('post', {'action': 'increase'}),
+        'ingest_doses': ('json', [{'med_id': medication_id, 'taken_at': timezone.now().isoformat()}]),
+        'export': ('get', {'medication': medication_id}),
+    }
+    arguments = {'kind': 'doses'}
+    for pattern in urls.urlpatterns:
+        kwargs = {name: arguments.get(name, medication_id) for name in pattern.pattern.converters}
+        method, data = payloads.get(pattern.name, ('get', None))
+        yield pattern.name, method, reverse(pattern.name, kwargs=kwargs), data
+
+
+def _send(client, method, path, data):
+    if method == 'json':
+        return client.post(path, json.dumps(data), content_type='application/json')
+    response = getattr(client, method)(path, data)
+    if response.streaming:
+        # Dotazy streamované odpovědi proběhnou až při čtení těla
+        b''.join(response.streaming_content)
+    return response
+
+
+def percentile(values, percent):
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(percent / 100 * len(ordered)) - 1)]
+
+
+class Command(BaseCommand):
+    help = (
+        "Zatíží všechny cesty aplikace medicine přes testovacího klienta a vypíše latence a počty dotazů. "
+        "Selže, pokud některý požadavek skončí chybou nebo pohled překročí zaznamenaný rozpočet dotazů."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=50, help="Počet požadavků na každou cestu.")
+        parser.add_argument('--concurrency', type=int, default=4)
+        parser.add_argument('--prefix', default='demo', help="Předpona uživatelů ze seed_demo_data.")
+        parser.add_argument('--budgets', default=str(BUDGETS_FILE))
+        parser.add_argument('--record', action='store_true', help="Uložit naměřené počty dotazů jako rozpočet.")
+
+    def handle(self, *args, **options):
+        users = list(User.objects.filter(username__startswith=f"{options['prefix']}_")
+                     .order_by('id')[:options['concurrency']])
+        if not users:
+            raise CommandError("Nejsou žádní ukázkoví uživatelé, spusťte nejdřív seed_demo_data.")
+
+        clients = []
+        for index in range(options['concurrency']):
+            user = users[index % len(users)]
+            with sharding.for_user(user):
+                medication_id = Medication.objects.filter(user=user).order_by('id').values_list('id', flat=True).first()
+            if medication_id is None:
+                raise CommandError(f"Uživatel {user.username} nemá žádný lék.")
+            # Výjimka v pohledu (např. zamčená SQLite) se počítá jako chyba, běh pokračuje a nakonec selže
+            client = Client(raise_request_exception=False)
+            client.force_login(user)
+            clients.append((client, medication_id))
+
+        results = {}
+        with override_settings(ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, 'testserver']):
+            for name, *_ in _requests(0):
+                results[name] = self.run_route(name, clients, options['requests'])
+
+        self.stdout.write(
+            f"{'pohled':<20} {'n':>5} {'chyby':>5} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'req/s':>8} "
+            f"{'dotazy p50':>10} {'max':>5}")
+        for name, result in results.items():
+            latencies = result['latencies']
+            if not latencies:
+                self.stdout.write(f"{name:<20} {0:>5} {result['errors']:>5}")
+                continue
+            self.stdout.write(
+                f"{name:<20} {len(latencies):>5} {result['errors']:>5} {percentile(latencies, 50):>8.1f} "
+                f"{percentile(latencies, 95):>8.1f} {percentile(latencies, 99):>8.1f} "
+                f"{len(latencies) / result['elapsed']:>8.1f} {percentile(result['queries'], 50):>10} "
+                f"{max(result['queries']):>5}")
+
+        failed = [
+            f"{name}: {result['errors']} chyb (stavy {', '.join(map(str, sorted(result['statuses'])))})"
+            for name, result in results.items() if result['errors']
+        ]
+        if failed:
+            raise CommandError("Některé požadavky skončily chybou:\n" + "\n".join(failed))
+
+        measured = {name: max(result['queries']) for name, result in results.items()}
+        budgets_path = Path(options['budgets'])
+        if options['record']:
+            budgets_path.write_text(json.dumps(measured, indent=2, sort_keys=True) + '\n')
+            self.stdout.write(self.style.SUCCESS(f"Rozpočty dotazů uloženy do {budgets_path}"))
+            return
+        if not budgets_path.exists():
+            self.stdout.write(self.style.WARNING(f"Soubor s rozpočty {budgets_path} neexistuje, nic se nekontroluje."))
+            return
+
+        budgets = json.loads(budgets_path.read_text())
+        exceeded = [
+            f"{name}: {queries} dotazů, rozpočet {budgets[name]}"
+            for name, queries in measured.items()
+            if name in budgets and queries > budgets[name]
+        ]
+        for name in measured.keys() - budgets.keys():
+            self.stdout.write(self.style.WARNING(f"Pohled {name} nemá rozpočet dotazů."))
+        if exceeded:
+            raise CommandError("Překročen rozpočet dotazů:\n" + "\n".join(exceeded))
+        self.stdout.write(self.style.SUCCESS("Všechny pohledy jsou v rozpočtu dotazů."))
+
+    def run_route(self, name, clients, total):
+        result = {'latencies': [], 'queries': [], 'errors': 0, 'statuses': set()}
+        lock = threading.Lock()
+
+        def worker(client, medication_id, count):
+            try:
+                request = next(request for request in _requests(medication_id) if request[0] == name)
+                for _ in range(count):
+                    with instrumentation.measure() as stats:
+                        response = _send(client, *request[1:])
+                    with lock:
+                        # Chybná odpověď (výjimka, 409/503) skončí dřív a zkreslila by latence i dotazy
+                        if response.status_code >= 400:
+                            result['errors'] += 1
+                            result['statuses'].add(response.status_code)
+                        else:
+                            result['latencies'].append(stats.total_ms)
+                            result['queries'].append(stats.query_count)
+            finally:
+                connections.close_all()
+
+        share, rest = divmod(total, len(clients))
+        threads = [
+            threading.Thread(target=worker, args=(client, medication_id, share + (index < rest)))
+            for index, (client, medication_id) in enumerate(clients)
+        ]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        result['elapsed'] = time.perf_counter() - started
+        return result
@@ -0,0 +1,45 @@
+import sys
+from datetime import date
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from medicine import export, retention, sharding
+
+
+class Command(BaseCommand):
+    help = "Vyexportuje dávky nebo historii změn uživatele jako CSV nebo JSON řádky, po dávkách."
+
+    def add_arguments(self, parser):
+        parser.add_argument('username')
+        parser.add_argument('kind', choices=list(export.COLUMNS))
+        parser.add_argument('--format', choices=list(export.FORMATS), default='csv')
+        parser.add_argument('--since', type=date.fromisoformat, help="Od data (RRRR-MM-DD) včetně.")
+        parser.add_argument('--until', type=date.fromisoformat, help="Do data (RRRR-MM-DD) včetně.")
+        parser.add_argument('--medication', type=int, help="Jen jeden lék.")
+        parser.add_argument('--gzip', action='store_true')
+        parser.add_argument('--archive', action='store_true', help="Včetně archivovaných záznamů (archive_logs).")
+        parser.add_argument('--output', default='-', help="Cílový soubor, výchozí je standardní výstup.")
+        parser.add_argument('--batch-size', type=int, default=export.BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        try:
+            user = User.objects.get(username=options['username'])
+        except User.DoesNotExist:
+            raise CommandError(f"Uživatel {options['username']} neexistuje.")
+
+        filters = {'since': options['since'], 'until': options['until'], 'medication_id': options['medication']}
+        with sharding.for_user(user):
+            queryset = export.export_queryset(options['kind'], user, **filters)
+        archived = retention.read(options['kind'], user.pk, **filters) if options['archive'] else ()
+        chunks = export.stream(
+            options['kind'], queryset, options['format'], options['gzip'], options['batch_size'], archived=archived)
+
+        if options['output'] == '-':
+            for chunk in chunks:
+                sys.stdout.buffer.write(chunk)
+            sys.stdout.buffer.flush()
+            return
+        with open(options['output'], 'wb') as output:
+            for chunk in chunks:
+                output.write(chunk)
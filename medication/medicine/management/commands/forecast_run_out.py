@@ -0,0 +1,25 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from medicine import forecasting, sharding
+
+
+class Command(BaseCommand):
+    help = "Přepočítá odhad, kdy které léky dojdou. Určeno pro noční běh."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=forecasting.BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        forecast = changed = 0
+        for alias in sharding.shard_aliases():
+            with sharding.use_shard(alias):
+                counts = forecasting.refresh(batch_size=options['batch_size'])
+            forecast += counts[0]
+            changed += counts[1]
+        self.stdout.write(self.style.SUCCESS(
+            f"Odhad vyčerpání přepočítán pro {forecast} léků (změněno {changed}) "
+            f"za {time.perf_counter() - started:.1f} s"
+        ))
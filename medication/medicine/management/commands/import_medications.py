@@ -0,0 +1,35 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from medicine import importer, sharding
+
+
+class Command(BaseCommand):
+    help = "Naimportuje léky a plány uživatele z CSV nebo JSON řádků, chybné řádky vypíše."
+
+    def add_arguments(self, parser):
+        parser.add_argument('username')
+        parser.add_argument('path')
+        parser.add_argument('--format', choices=importer.FORMATS, help="Výchozí podle přípony souboru.")
+        parser.add_argument('--batch-size', type=int, default=importer.BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        try:
+            user = User.objects.get(username=options['username'])
+        except User.DoesNotExist:
+            raise CommandError(f"Uživatel {options['username']} neexistuje.")
+        try:
+            fmt = options['format'] or importer.detect_format(options['path'])
+        except importer.InvalidImport as exc:
+            raise CommandError(str(exc))
+
+        with open(options['path'], encoding='utf-8-sig', newline='') as lines, sharding.for_user(user):
+            result = importer.import_medications(user, lines, fmt, batch_size=options['batch_size'])
+
+        for row in result['errors']:
+            messages = '; '.join(f"{field}: {', '.join(errors)}" for field, errors in row['errors'].items())
+            self.stderr.write(f"Řádek {row['line']}: {messages}")
+        self.stdout.write(self.style.SUCCESS(
+            f"Vytvořeno léků: {result['medications']}, plánů: {result['schedules']}, "
+            f"přeskočeno řádků: {len(result['errors'])}"
+        ))
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from medicine import sharding
+
+
+class Command(BaseCommand):
+    help = "Přesune data léků uživatele do jiného shardu po dávkách."
+
+    def add_arguments(self, parser):
+        parser.add_argument('user_id', type=int)
+        parser.add_argument('shard', help="Alias cílového shardu, např. shard_2.")
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        if not sharding.enabled():
+            raise CommandError("Sharding není zapnutý (MEDICATION_SHARDS).")
+        try:
+            moved = sharding.move_user(options['user_id'], options['shard'], batch_size=options['batch_size'])
+        except ValueError as exc:
+            raise CommandError(str(exc))
+        self.stdout.write(self.style.SUCCESS(f"Přesunuto řádků: {moved}"))
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from medicine import sharding, statistics
+
+
+class Command(BaseCommand):
+    help = "Přepočítá statistiky užívání všech léků z Logu."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        rebuilt = 0
+        for alias in sharding.shard_aliases():
+            with sharding.use_shard(alias):
+                rebuilt += statistics.rebuild(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f"Přepočítáno statistik: {rebuilt}"))
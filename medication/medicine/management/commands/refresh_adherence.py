@@ -0,0 +1,21 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+
+from medicine import adherence, sharding
+
+
+class Command(BaseCommand):
+    help = "Předpočítá denní dodržování plánu za uzavřené dny, aby přehledy četly jen uložené souhrny."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=365, help="Kolik posledních uzavřených dní.")
+        parser.add_argument('--batch-size', type=int, default=adherence.BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        since = adherence.last_closed_day() - timedelta(days=options['days'] - 1)
+        refreshed = 0
+        for alias in sharding.shard_aliases():
+            with sharding.use_shard(alias):
+                refreshed += adherence.refresh(since, batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f"Dodržování plánu zkontrolováno pro {refreshed} léků"))
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from medicine import rollups, sharding
+
+
+class Command(BaseCommand):
+    help = "Doplní denní souhrny dávek o nové záznamy z Logu."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=10000)
+
+    def handle(self, *args, **options):
+        processed = 0
+        for alias in sharding.shard_aliases():
+            with sharding.use_shard(alias):
+                processed += rollups.refresh(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f"Zpracováno záznamů z Logu: {processed}"))
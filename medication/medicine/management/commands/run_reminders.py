@@ -0,0 +1,31 @@
+import asyncio
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+
+from medicine.reminders import ReminderDispatcher, get_sender
+
+
+class Command(BaseCommand):
+    help = "Spustí průběžné rozesílání připomínek podle plánů užívání."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--window', type=int, default=60, help="Délka okna v sekundách.")
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--concurrency', type=int, default=100)
+        parser.add_argument('--queue-size', type=int, default=5000)
+        parser.add_argument('--sender', help="Cesta ke třídě odesílače, výchozí z MEDICINE_REMINDER_SENDER.")
+        parser.add_argument('--windows', type=int, help="Zpracovat jen daný počet oken a skončit.")
+
+    def handle(self, *args, **options):
+        dispatcher = ReminderDispatcher(
+            get_sender(options['sender']),
+            window=timedelta(seconds=options['window']),
+            batch_size=options['batch_size'],
+            concurrency=options['concurrency'],
+            queue_size=options['queue_size'],
+        )
+        try:
+            asyncio.run(dispatcher.run(windows=options['windows']))
+        except KeyboardInterrupt:
+            self.stdout.write("Rozesílání ukončeno.")
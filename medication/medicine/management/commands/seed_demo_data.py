@@ -0,0 +1,140 @@
+import random
+from datetime import timedelta
+from itertools import islice
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from medicine import rollups, sharding, statistics
+from medicine.models import CareRelationship, Log, Medication, MedicationChangeHistory, Schedule
+
+NAMES = ["Paralen", "Ibalgin", "Nurofen", "Aspirin", "Zyrtec", "Euthyrox", "Concor", "Prestarium", "Anopyrin",
+         "Tramal", "Lexaurin", "Helicid", "Agen", "Betaloc", "Atoris", "Warfarin", "Metformin", "Vigantol"]
+
+
+def bulk_insert(model, rows, batch_size, using=None):
+    """Vkládá objekty z generátoru po dávkách, v paměti je vždy jen jedna dávka."""
+    created = 0
+    rows = iter(rows)
+    while batch := list(islice(rows, batch_size)):
+        model.objects.using(using).bulk_create(batch)
+        created += len(batch)
+    return created
+
+
+class Command(BaseCommand):
+    help = "Naplní databázi deterministickými ukázkovými daty pro měření výkonu."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=10)
+        parser.add_argument('--medications', type=int, default=10, help="Léků na uživatele.")
+        parser.add_argument('--schedules', type=int, default=2, help="Plánů na lék.")
+        parser.add_argument('--years', type=float, default=1.0, help="Kolik let historie dávek vytvořit.")
+        parser.add_argument('--doses-per-day', type=int, default=2)
+        parser.add_argument('--changes', type=int, default=20, help="Záznamů historie změn na lék.")
+        parser.add_argument('--patients', type=int, default=10, help="Kolik dalších uživatelů každý sleduje jako lékař.")
+        parser.add_argument('--prefix', default='demo')
+        parser.add_argument('--password', default='demo')
+        parser.add_argument('--seed', type=int, default=42)
+        parser.add_argument('--batch-size', type=int, default=5000)
+
+    def handle(self, *args, **options):
+        prefix = options['prefix']
+        if User.objects.filter(username__startswith=f"{prefix}_").exists():
+            raise CommandError(f"Uživatelé s předponou {prefix}_ už existují, zvolte jinou --prefix.")
+
+        rng = random.Random(options['seed'])
+        # Konec historie je zarovnaný na půlnoc, stejné --seed dá během dne stejná data
+        end = timezone.now().replace(hour=0, minute=0, second=0, microsecond=0)
+        days = max(1, int(options['years'] * 365))
+        password = make_password(options['password'])
+
+        users = User.objects.bulk_create(
+            User(username=f"{prefix}_{index:05d}", password=password) for index in range(options['users'])
+        )
+        counts = dict.fromkeys(['medications', 'schedules', 'logs', 'changes'], 0)
+        for user in users:
+            with sharding.for_user(user):
+                self.seed_user(user, rng, end, days, options, counts)
+
+        # Každý uživatel sleduje následující uživatele v pořadí, přehled pacientů tak má co ukázat
+        patients = min(options['patients'], len(users) - 1)
+        bulk_insert(CareRelationship, (
+            CareRelationship(clinician=user, patient=users[(index + offset) % len(users)])
+            for index, user in enumerate(users) for offset in range(1, patients + 1)
+        ), options['batch_size'])
+
+        for alias in sharding.shard_aliases():
+            with sharding.use_shard(alias):
+                statistics.rebuild()
+                rollups.refresh()
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Vytvořeno: uživatelé {len(users)}, léky {counts['medications']}, plány {counts['schedules']}, "
+            f"dávky {counts['logs']}, změny {counts['changes']}"
+        ))
+
+    def seed_user(self, user, rng, end, days, options, counts):
+        using = sharding.current_alias()
+        doses = options['doses_per_day']
+        medications = Medication.objects.using(using).bulk_create(
+            Medication(
+                user=user,
+                name=f"{rng.choice(NAMES)} {rng.choice([100, 200, 400, 500])} mg",
+                dosage=rng.randint(1, 2),
+                remaining_quantity=rng.randint(0, 120),
+                last_taken=end - timedelta(hours=rng.randint(1, 48)),
+            )
+            for _ in range(options['medications'])
+        )
+        counts['medications'] += len(medications)
+
+        def schedules():
+            for medication in medications:
+                for _ in range(options['schedules']):
+                    # Většinou denně, jinak náhodné dny; jeden až tři časy, občas interval
+                    weekdays = Schedule.EVERY_DAY if rng.random() < 0.6 else rng.randint(1, Schedule.EVERY_DAY)
+                    times = [rng.randint(6, 21) * 60 + rng.choice([0, 15, 30, 45]) for _ in range(rng.randint(1, 3))]
+                    schedule = Schedule(medication=medication, user=user, weekdays=weekdays, times=times)
+                    if rng.random() < 0.1:
+                        schedule.times, schedule.interval_hours = times[:1], rng.choice([6, 8, 12])
+                    schedule.normalize()
+                    yield schedule
+
+        def logs():
+            start = end - timedelta(days=days)
+            for medication in medications:
+                for day in range(days):
+                    for dose in range(doses):
+                        # Občas vynechaná dávka, časy kolísají kolem rozvrhu
+                        if rng.random() < 0.1:
+                            continue
+                        hour = 8 + dose * (12 // doses)
+                        yield Log(medication=medication, created_at=start + timedelta(
+                            days=day, hours=hour, minutes=rng.randint(-45, 45)))
+
+        def changes():
+            for medication in medications:
+                for index in range(options['changes']):
+                    yield MedicationChangeHistory(
+                        medication=medication, user=user, field_changed=rng.choice(
+                            ['dosage', 'remaining_quantity', 'notes', 'name']),
+                        old_value=str(index), new_value=str(index + 1),
+                    )
+
+        # Plánů uživatele je pár desítek, po vložení (bulk_create obchází save) se jim dopočítají sloty
+        user_schedules = list(schedules())
+        counts['schedules'] += bulk_insert(Schedule, user_schedules, options['batch_size'], using)
+        Schedule.store_slots(user_schedules, using=using, replace=False)
+        counts['logs'] += bulk_insert(Log, logs(), options['batch_size'], using)
+        counts['changes'] += bulk_insert(MedicationChangeHistory, changes(), options['batch_size'], using)
+
+        # Datum změny nastavuje auto_now_add, rozprostře se dodatečně po letech historie
+        history = MedicationChangeHistory.objects.using(using)
+        for medication in medications:
+            rows = list(history.filter(medication=medication).only('id'))
+            for row in rows:
+                row.change_date = end - timedelta(minutes=rng.randint(0, days * 24 * 60))
+            MedicationChangeHistory.objects.using(using).bulk_update(rows, ['change_date'], batch_size=500)
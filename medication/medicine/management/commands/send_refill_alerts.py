@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from medicine import refills, sharding
+
+
+class Command(BaseCommand):
+    help = "Pošle upozornění na doplnění léků, jejichž zásoba nově klesla pod nastavený práh."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=refills.BATCH_SIZE)
+        parser.add_argument('--sink', help="Cesta ke třídě příjemce, výchozí z MEDICINE_REFILL_SINK.")
+
+    def handle(self, *args, **options):
+        sink = refills.get_sink(options['sink'])
+        sent = 0
+        for alias in sharding.shard_aliases():
+            with sharding.use_shard(alias):
+                sent += refills.send_alerts(sink, batch_size=options['batch_size'])
+        self.stderr.write(self.style.SUCCESS(f"Odesláno upozornění na doplnění: {sent}"))
@@ -0,0 +1,30 @@
+import sqlite3
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS
+
+
+class Command(BaseCommand):
+    help = "Zkopíruje hlavní SQLite databázi do místních replik pro čtení (READ_REPLICAS)."
+
+    def handle(self, *args, **options):
+        databases = settings.DATABASES
+        if not settings.READ_REPLICAS:
+            raise CommandError("Nejsou nastavené žádné repliky (MEDICATION_READ_REPLICAS).")
+        for alias in [DEFAULT_DB_ALIAS, *settings.READ_REPLICAS]:
+            if databases[alias]['ENGINE'] != 'django.db.backends.sqlite3':
+                raise CommandError(f"Databáze {alias} není SQLite, repliky musí zajistit databázový server.")
+
+        source = sqlite3.connect(databases[DEFAULT_DB_ALIAS]['NAME'])
+        try:
+            for alias in settings.READ_REPLICAS:
+                target = sqlite3.connect(databases[alias]['NAME'])
+                try:
+                    # Online záloha dává konzistentní snímek i za běhu zápisů
+                    source.backup(target)
+                finally:
+                    target.close()
+                self.stdout.write(f"{alias}: {databases[alias]['NAME']}")
+        finally:
+            source.close()
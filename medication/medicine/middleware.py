@@ -0,0 +1,115 @@
+import json
+import logging
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.http import HttpResponse
+
+from . import instrumentation, routers, sharding
+
+perf_logger = logging.getLogger('medicine.perf')
+
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+_END = object()
+
+
+class ReadReplicaMiddleware:
+    """
+    Bezpečné požadavky čtou z repliky.
+
+    Ostatní požadavky a uživatelé krátce po vlastním zápisu čtou z hlavní
+    databáze. Musí být až za AuthenticationMiddleware.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        # O připnutí se rozhoduje ještě nad hlavní databází, čerstvá session na replice být nemusí
+        primary = request.method not in SAFE_METHODS or routers.is_pinned(request)
+        with routers.read_context(primary=primary) as state:
+            response = self.get_response(request)
+        if state.wrote:
+            routers.pin_to_primary(request, response)
+        return response
+
+
+class ShardMiddleware:
+    """Data léků přihlášeného uživatele čte a zapisuje v jeho shardu."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not sharding.enabled() or not request.user.is_authenticated:
+            return self.get_response(request)
+        entry = sharding.directory_entry(request.user.pk)
+        if entry.moving and request.method not in SAFE_METHODS:
+            response = HttpResponse("Probíhá přesun vašich dat, zkuste to prosím za chvíli.", status=503)
+            response['Retry-After'] = '30'
+            return response
+        with sharding.use_shard(entry.shard):
+            return self.get_response(request)
+
+
+class PerformanceMiddleware:
+    """
+    Volitelné měření požadavků (MEDICINE_PERF_INSTRUMENTATION).
+
+    Počet a čas SQL dotazů, opakované dotazy, čas šablon a celkový čas podle
+    názvu URL jde do hlavičky Server-Timing a jako JSON řádek do loggeru
+    medicine.perf. Požadavky nad rozpočtem se logují jako varování
+    i s nejčastěji opakovanými dotazy. U streamovaných odpovědí se měří i čtení
+    těla, hlavička Server-Timing chybí. Čas šablon měří backend
+    instrumentation.TimedDjangoTemplates. Patří na začátek MIDDLEWARE.
+    """
+
+    def __init__(self, get_response):
+        if not settings.MEDICINE_PERF_INSTRUMENTATION:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        stats = instrumentation.RequestStats()
+        with instrumentation.measure(stats):
+            response = self.get_response(request)
+        if response.streaming and not response.is_async:
+            # Dotazy streamovaného těla proběhnou až při jeho čtení: měří se dál a záznam se
+            # zapíše po posledním kusu. Hlavičky odcházejí před tělem, Server-Timing by nebyl úplný.
+            response.streaming_content = self._measure_stream(request, response, stats, response.streaming_content)
+            return response
+        response['Server-Timing'] = stats.server_timing()
+        self.log(request, response, stats)
+        return response
+
+    def _measure_stream(self, request, response, stats, content):
+        # Měří se jen výroba každého kusu, ne čekání, než si ho server odebere
+        chunks = iter(content)
+        try:
+            while True:
+                with instrumentation.measure(stats):
+                    chunk = next(chunks, _END)
+                if chunk is _END:
+                    return
+                yield chunk
+        finally:
+            self.log(request, response, stats)
+
+    def log(self, request, response, stats):
+        match = request.resolver_match
+        record = {
+            'view': match.view_name if match else None,
+            'method': request.method,
+            'status': response.status_code,
+            'queries': stats.query_count,
+            'duplicate_queries': sum(count - 1 for count in stats.fingerprints.values()),
+            'sql_ms': round(stats.sql_ms, 1),
+            'template_ms': round(stats.template_ms, 1),
+            'total_ms': round(stats.total_ms, 1),
+        }
+        if (stats.query_count > settings.MEDICINE_PERF_QUERY_BUDGET
+                or stats.total_ms > settings.MEDICINE_PERF_TIME_BUDGET_MS):
+            record['top_duplicates'] = [{'sql': sql, 'count': count} for sql, count in stats.duplicates()]
+            perf_logger.warning(json.dumps(record, ensure_ascii=False))
+        else:
+            perf_logger.info(json.dumps(record, ensure_ascii=False))
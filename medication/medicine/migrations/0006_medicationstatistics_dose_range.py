@@ -0,0 +1,56 @@
+# Generated by Django 5.1.15 on 2026-10-18 09:19
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, Max, Min, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def deduplicate_statistics(apps, schema_editor):
+    MedicationStatistics = apps.get_model('medicine', 'MedicationStatistics')
+    db_alias = schema_editor.connection.alias
+    keep = MedicationStatistics.objects.filter(medication=OuterRef('medication')).order_by('id').values('id')[:1]
+    MedicationStatistics.objects.using(db_alias).exclude(id=Subquery(keep)).delete()
+
+
+def recompute_from_log(apps, schema_editor):
+    Log = apps.get_model('medicine', 'Log')
+    MedicationStatistics = apps.get_model('medicine', 'MedicationStatistics')
+    db_alias = schema_editor.connection.alias
+    logs = Log.objects.filter(medication=OuterRef('medication')).order_by().values('medication')
+    MedicationStatistics.objects.using(db_alias).update(
+        total_doses_taken=Coalesce(Subquery(logs.annotate(total=Count('id')).values('total')[:1]), 0),
+        first_dose_at=Subquery(logs.annotate(first=Min('created_at')).values('first')[:1]),
+        last_dose_at=Subquery(logs.annotate(last=Max('created_at')).values('last')[:1]),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('medicine', '0005_medicationchangehistory'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='medicationstatistics',
+            name='average_doses_per_day',
+        ),
+        migrations.AddField(
+            model_name='medicationstatistics',
+            name='first_dose_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='medicationstatistics',
+            name='last_dose_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.RunPython(deduplicate_statistics, migrations.RunPython.noop),
+        migrations.RunPython(recompute_from_log, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='medicationstatistics',
+            constraint=models.UniqueConstraint(fields=('medication',), name='unique_statistics_per_medication'),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.1.15 on 2026-10-18 09:20
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('medicine', '0006_medicationstatistics_dose_range'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='log',
+            name='created_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+    ]
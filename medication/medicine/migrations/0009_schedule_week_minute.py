@@ -0,0 +1,42 @@
+# Generated by Django 5.1.15 on 2026-10-18 09:21
+
+from django.db import migrations, models
+
+WEEKDAYS = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
+
+
+def fill_slots(apps, schema_editor):
+    Schedule = apps.get_model('medicine', 'Schedule')
+    schedules = Schedule.objects.using(schema_editor.connection.alias)
+    last_id = 0
+    while True:
+        batch = list(schedules.filter(id__gt=last_id, time__isnull=False).order_by('id')[:1000])
+        if not batch:
+            break
+        for schedule in batch:
+            schedule.minute_of_day = schedule.time.hour * 60 + schedule.time.minute
+            if schedule.day_of_week in WEEKDAYS:
+                schedule.week_minute = WEEKDAYS.index(schedule.day_of_week) * 24 * 60 + schedule.minute_of_day
+        schedules.bulk_update(batch, ['minute_of_day', 'week_minute'])
+        last_id = batch[-1].id
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('medicine', '0008_dosedailyrollup_checkpoint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='schedule',
+            name='minute_of_day',
+            field=models.PositiveSmallIntegerField(blank=True, db_index=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='schedule',
+            name='week_minute',
+            field=models.PositiveSmallIntegerField(blank=True, db_index=True, editable=False, null=True),
+        ),
+        migrations.RunPython(fill_slots, migrations.RunPython.noop),
+    ]
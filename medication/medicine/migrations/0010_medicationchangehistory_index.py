@@ -0,0 +1,19 @@
+# Generated by Django 5.1.15 on 2026-10-18 09:24
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('medicine', '0009_schedule_week_minute'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='medicationchangehistory',
+            index=models.Index(fields=['medication', 'change_date'], name='history_medication_date_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.15 on 2026-10-18 09:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('medicine', '0010_medicationchangehistory_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='medication',
+            name='version',
+            field=models.PositiveIntegerField(default=1, editable=False),
+        ),
+    ]
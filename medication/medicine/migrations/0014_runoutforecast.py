@@ -0,0 +1,30 @@
+# Generated by Django 5.1.15 on 2026-10-18 09:57
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('medicine', '0013_changedailyrollup'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RunOutForecast',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('doses_per_day', models.FloatField(default=0)),
+                ('run_out_date', models.DateField(blank=True, null=True)),
+                ('updated_at', models.DateTimeField()),
+                ('medication', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='forecast', to='medicine.medication')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['user', 'run_out_date'], name='forecast_user_run_out_idx'), models.Index(fields=['run_out_date'], name='forecast_run_out_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 5.1.15 on 2026-10-18 09:58
+
+import django.db.models.expressions
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('medicine', '0014_runoutforecast'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='medication',
+            name='refill_alerted_at',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='medication',
+            name='refill_threshold',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='medication',
+            index=models.Index(condition=models.Q(('refill_alerted_at__isnull', True), ('remaining_quantity__lt', django.db.models.expressions.CombinedExpression(models.F('refill_threshold'), '*', models.F('dosage')))), fields=['id'], name='medication_refill_due_idx'),
+        ),
+    ]
@@ -0,0 +1,126 @@
+from django.db import migrations, models
+
+WEEKDAYS = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
+EVERY_DAY = 0b1111111
+BATCH_SIZE = 500
+
+
+def _medication_batches(schedules):
+    last_id = 0
+    while True:
+        batch = list(schedules.filter(medication_id__gt=last_id).order_by('medication_id')
+                     .values_list('medication_id', flat=True).distinct()[:BATCH_SIZE])
+        if not batch:
+            return
+        yield batch
+        last_id = batch[-1]
+
+
+def merge_schedules(apps, schema_editor):
+    """
+    Řádky (den, čas) jednoho léku sloučí do kompaktních plánů: časy se stejnou
+    množinou dnů sdílí jeden řádek. Zůstane nejnižší id ze skupiny, ostatní se smažou.
+    """
+    Schedule = apps.get_model('medicine', 'Schedule')
+    schedules = Schedule.objects.using(schema_editor.connection.alias)
+    for medication_ids in _medication_batches(schedules):
+        rows = {}
+        for schedule in schedules.filter(medication_id__in=medication_ids).order_by('id'):
+            rows.setdefault(schedule.medication_id, []).append(schedule)
+
+        kept, removed = [], []
+        for medication_rows in rows.values():
+            masks, owners = {}, {}
+            for schedule in medication_rows:
+                minute = schedule.time.hour * 60 + schedule.time.minute if schedule.time else None
+                day = WEEKDAYS.index(schedule.day_of_week) if schedule.day_of_week in WEEKDAYS else None
+                masks[minute] = masks.get(minute, 0) | (EVERY_DAY if day is None else 1 << day)
+                owners.setdefault(minute, []).append(schedule)
+            groups = {}
+            for minute, mask in masks.items():
+                groups.setdefault(mask, []).append(minute)
+            for mask, minutes in groups.items():
+                members = sorted((schedule for minute in minutes for schedule in owners[minute]), key=lambda s: s.id)
+                first, *rest = members
+                first.weekdays = mask
+                first.times = sorted(minute for minute in minutes if minute is not None)
+                kept.append(first)
+                removed.extend(schedule.id for schedule in rest)
+
+        schedules.bulk_update(kept, ['weekdays', 'times'])
+        schedules.filter(id__in=removed).delete()
+
+
+def split_schedules(apps, schema_editor):
+    """Zpět na řádek za každý den a čas; intervaly a rozsahy dat se ztratí."""
+    Schedule = apps.get_model('medicine', 'Schedule')
+    schedules = Schedule.objects.using(schema_editor.connection.alias)
+    for medication_ids in _medication_batches(schedules):
+        created, updated = [], []
+        for schedule in schedules.filter(medication_id__in=medication_ids).order_by('id'):
+            days = [None] if schedule.weekdays == EVERY_DAY else [
+                day for index, day in enumerate(WEEKDAYS) if schedule.weekdays >> index & 1]
+            slots = [(day, minute) for minute in schedule.times or [None] for day in days]
+            for index, (day, minute) in enumerate(slots):
+                row = schedule if index == 0 else Schedule(medication_id=schedule.medication_id,
+                                                           user_id=schedule.user_id)
+                row.day_of_week = day
+                row.time = None if minute is None else f"{minute // 60:02d}:{minute % 60:02d}"
+                row.minute_of_day = minute
+                row.week_minute = None if day is None or minute is None else (
+                    WEEKDAYS.index(day) * 24 * 60 + minute)
+                (updated if index == 0 else created).append(row)
+        schedules.bulk_update(updated, ['day_of_week', 'time', 'minute_of_day', 'week_minute'])
+        schedules.bulk_create(created)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('medicine', '0017_carerelationship'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='schedule',
+            name='weekdays',
+            field=models.PositiveSmallIntegerField(default=127),
+        ),
+        migrations.AddField(
+            model_name='schedule',
+            name='times',
+            field=models.JSONField(blank=True, default=list),
+        ),
+        migrations.AddField(
+            model_name='schedule',
+            name='interval_hours',
+            field=models.PositiveSmallIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='schedule',
+            name='start_date',
+            field=models.DateField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='schedule',
+            name='end_date',
+            field=models.DateField(blank=True, null=True),
+        ),
+        migrations.RunPython(merge_schedules, split_schedules),
+        migrations.RemoveField(
+            model_name='schedule',
+            name='day_of_week',
+        ),
+        migrations.RemoveField(
+            model_name='schedule',
+            name='time',
+        ),
+        migrations.RemoveField(
+            model_name='schedule',
+            name='minute_of_day',
+        ),
+        migrations.RemoveField(
+            model_name='schedule',
+            name='week_minute',
+        ),
+    ]
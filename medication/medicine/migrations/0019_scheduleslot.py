@@ -0,0 +1,48 @@
+# Generated by Django 5.1.15 on 2026-10-18 10:40
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+from medicine.occurrences import slots
+
+BATCH_SIZE = 500
+
+
+def fill_slots(apps, schema_editor):
+    """Sloty pro existující plány, po dávkách podle id."""
+    Schedule = apps.get_model('medicine', 'Schedule')
+    ScheduleSlot = apps.get_model('medicine', 'ScheduleSlot')
+    alias = schema_editor.connection.alias
+    fields = ('weekdays', 'times', 'interval_hours', 'start_date', 'end_date')
+    last_id = 0
+    while batch := list(Schedule.objects.using(alias).filter(id__gt=last_id).order_by('id')
+                        .values_list('id', *fields)[:BATCH_SIZE]):
+        rows = []
+        for schedule_id, *recurrence in batch:
+            cycle, minutes = slots(recurrence)
+            rows.extend(ScheduleSlot(schedule_id=schedule_id, cycle=cycle, minute=minute) for minute in minutes)
+        ScheduleSlot.objects.using(alias).bulk_create(rows)
+        last_id = batch[-1][0]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('medicine', '0018_schedule_recurrence'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ScheduleSlot',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('cycle', models.PositiveIntegerField()),
+                ('minute', models.PositiveIntegerField()),
+                ('schedule', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='slots', to='medicine.schedule')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['cycle', 'minute'], name='schedule_slot_minute_idx')],
+            },
+        ),
+        migrations.RunPython(fill_slots, migrations.RunPython.noop),
+    ]
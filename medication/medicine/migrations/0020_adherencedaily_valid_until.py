@@ -0,0 +1,18 @@
+# Generated by Django 5.1.15 on 2026-10-18 10:56
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('medicine', '0019_scheduleslot'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='adherencedaily',
+            name='valid_until',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
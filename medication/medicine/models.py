@@ -1,41 +1,165 @@
 from django.utils import timezone
 from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
 from django.db import models
+from django.db.models import Case, F, Q, Value, When
 
+from . import caching, sharding
+from .db import write_transaction
 
-class Medication(models.Model):
+
+class TrackedFieldsMixin:
+    """
+    Pamatuje si hodnoty sledovaných polí při načtení z databáze.
+
+    Změny oproti tomuto snímku zapisuje signál po uložení do historie změn,
+    bez dalšího dotazu na původní stav.
+    """
+    tracked_fields = ()
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance.take_snapshot()
+        return instance
+
+    def take_snapshot(self):
+        # Seznamy (časy plánu) se kopírují, jinak by změna na místě ve snímku nebyla vidět
+        self._tracked_snapshot = {
+            field: list(value) if isinstance(value, list) else value
+            for field, value in self.__dict__.items() if field in self.tracked_fields
+        }
+
+    def tracked_changes(self):
+        snapshot = getattr(self, '_tracked_snapshot', None) or {}
+        return [
+            (field, old_value, getattr(self, field))
+            for field, old_value in snapshot.items()
+            if getattr(self, field) != old_value
+        ]
+
+
+class Medication(TrackedFieldsMixin, models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     name = models.CharField(max_length=100)
     dosage = models.PositiveIntegerField(default=1)
     notes = models.TextField(blank=True, null=True)
     remaining_quantity = models.PositiveIntegerField(default=0)
     last_taken = models.DateTimeField(blank=True, null=True)
+    # Zvyšuje se při každém zápisu, je součástí klíče vykreslené karty léku v cache
+    version = models.PositiveIntegerField(default=1, editable=False)
+    # Pod kolik zbývajících dávek poslat upozornění na doplnění; prázdné = neupozorňovat
+    refill_threshold = models.PositiveIntegerField(blank=True, null=True)
+    # Kdy odešlo upozornění za aktuální pokles pod práh; doplnění zásoby ho vynuluje
+    refill_alerted_at = models.DateTimeField(blank=True, null=True, editable=False)
 
+    tracked_fields = ('name', 'dosage', 'notes', 'remaining_quantity')
+
+    class Meta:
+        indexes = [
+            # Jen léky pod prahem, za které ještě upozornění neodešlo: dávková úloha
+            # čte tento malý index, ne celou tabulku
+            models.Index(
+                fields=['id'], name='medication_refill_due_idx',
+                condition=Q(refill_alerted_at__isnull=True, remaining_quantity__lt=F('refill_threshold') * F('dosage')),
+            ),
+        ]
 
     def __str__(self):
         return self.name
 
+    def save(self, *args, **kwargs):
+        if self.refill_alerted_at is not None and not self.needs_refill():
+            # Zásoba doplněna nad práh, další pokles pod něj pošle nové upozornění
+            self.refill_alerted_at = None
+            update_fields = kwargs.get('update_fields')
+            if update_fields is not None:
+                kwargs['update_fields'] = {*update_fields, 'refill_alerted_at'}
+        if not self._state.adding:
+            self.version = F('version') + 1
+            update_fields = kwargs.get('update_fields')
+            if update_fields is not None:
+                kwargs['update_fields'] = {*update_fields, 'version'}
+        super().save(*args, **kwargs)
+        # Skutečná hodnota se načte až při přístupu, save() tak nestojí dotaz navíc
+        if hasattr(self.__dict__.get('version'), 'resolve_expression'):
+            del self.__dict__['version']
+
     def remaining_doses(self):
         return self.remaining_quantity // self.dosage
 
+    def needs_refill(self):
+        # Stejná podmínka jako v indexu: quantity < práh * dávka je totéž co remaining_doses() < práh
+        return self.refill_threshold is not None and self.remaining_doses() < self.refill_threshold
+
 
     def mark_as_taken(self):
-        self.remaining_quantity -= 1
-        self.last_taken = timezone.now()
-        self.save()
+        log = Medication.take_dose(self.id, self.user_id)
+        if log is not None:
+            self.remaining_quantity -= 1
+            self.last_taken = log.created_at
+        return log
+
+    @classmethod
+    def take_dose(cls, med_id, user):
+        # Odečet probíhá podmíněně přímo v databázi, souběžná užití se tak neztratí.
+        # Celkem tři příkazy: UPDATE léku, INSERT do Logu a upsert statistik.
+        now = timezone.now()
+        with sharding.for_user(user), write_transaction():
+            taken = cls.objects.filter(id=med_id, user=user, remaining_quantity__gt=0).update(
+                remaining_quantity=F('remaining_quantity') - 1,
+                last_taken=now,
+                version=F('version') + 1,
+            )
+            if not taken:
+                return None
+
+            # Statistiky navýší signál na Logu jedním upsertem; stejný čas jako last_taken
+            log = Log.objects.create(medication_id=med_id, created_at=now)
+            caching.bump_on_commit(caching.STATISTICS, [getattr(user, 'pk', user)])
+        return log
+
+    @classmethod
+    def adjust_stock(cls, med_id, user, delta, changed_by=None):
+        """
+        Ruční oprava zásoby o `delta` kusů podmíněným UPDATE, bez čtení a save().
+
+        Souběžný odečet z take_dose se tak nepřepíše. Zásoba nesmí klesnout pod
+        nulu; doplnění nad práh vynuluje refill_alerted_at jako save(). Změna se
+        zapíše do historie. Vrací novou zásobu, nebo None, když se nic nezměnilo.
+        """
+        from .history import record_bulk_changes
+
+        with sharding.for_user(user), write_transaction():
+            medications = cls.objects.filter(id=med_id, user=user, remaining_quantity__gte=max(-delta, 0))
+            # SET se vyhodnocuje nad původním řádkem: nová zásoba >= práh * dávka
+            refilled = Q(refill_threshold__isnull=True) | Q(
+                remaining_quantity__gte=F('refill_threshold') * F('dosage') - delta)
+            updated = medications.update(
+                remaining_quantity=F('remaining_quantity') + delta,
+                refill_alerted_at=Case(When(refilled, then=Value(None)), default=F('refill_alerted_at')),
+                version=F('version') + 1,
+            )
+            if not updated:
+                return None
+            remaining = cls.objects.filter(id=med_id).values_list('remaining_quantity', flat=True).get()
+            record_bulk_changes([(med_id, 'remaining_quantity', remaining - delta, remaining)], changed_by or user)
+            caching.bump_on_commit(caching.STATISTICS, [getattr(user, 'pk', user)])
+        return remaining
 
 
 
 class Log(models.Model):
     medication = models.ForeignKey(Medication, on_delete=models.CASCADE)
-    created_at = models.DateTimeField(auto_now_add=True)
+    # Ne auto_now_add: dávky nahrané zpětně z offline zařízení si nesou vlastní čas
+    created_at = models.DateTimeField(default=timezone.now)
 
     def __str__(self):
         return f"{self.medication.name}: {self.created_at}"
 
 
 
-class Schedule(models.Model):
+class Schedule(TrackedFieldsMixin, models.Model):
     DAY_OF_WEEK = [
         ('Monday', 'Pondělí'),
         ('Tuesday', 'Úterý'),
@@ -45,31 +169,131 @@ class Schedule(models.Model):
         ('Saturday', 'Sobota'),
         ('Sunday', 'Neděle'),
     ]
+    DAY_ABBREVIATIONS = ['Po', 'Út', 'St', 'Čt', 'Pá', 'So', 'Ne']
+    EVERY_DAY = 0b1111111
+    # Pole, ze kterých se výskyty rozvinou (occurrences.expand), v tomto pořadí
+    RECURRENCE_FIELDS = ('weekdays', 'times', 'interval_hours', 'start_date', 'end_date')
+
     medication = models.ForeignKey(Medication, on_delete=models.CASCADE)
     user = models.ForeignKey(User, on_delete=models.CASCADE, blank=True, null=True)  # Uživatel není povinný
-    day_of_week = models.CharField(max_length=9, choices=DAY_OF_WEEK, blank=True, null=True)  # Den může být prázdný
-    time = models.TimeField(blank=True, null=True)
-
+    # Dny v týdnu jako bity, pondělí je nejnižší bit
+    weekdays = models.PositiveSmallIntegerField(default=EVERY_DAY)
+    # Časy dávek během dne jako seřazené minuty od půlnoci; jeden řádek nahradí plán pro každý den a čas
+    times = models.JSONField(default=list, blank=True)
+    # Dávka každých N hodin od prvního času (bez času od půlnoci) prvního dne plánu
+    interval_hours = models.PositiveSmallIntegerField(blank=True, null=True)
+    start_date = models.DateField(blank=True, null=True)
+    end_date = models.DateField(blank=True, null=True)
 
+    tracked_fields = RECURRENCE_FIELDS
 
     def __str__(self):
-        return f"{self.medication.name} - {self.get_day_of_week_display()} v {self.time}"
+        return f"{self.medication.name} - {self.describe()}"
+
+    @property
+    def recurrence(self):
+        return tuple(getattr(self, field) for field in self.RECURRENCE_FIELDS)
+
+    def weekday_names(self):
+        return [day for index, (day, _) in enumerate(self.DAY_OF_WEEK) if self.weekdays >> index & 1]
+
+    def time_labels(self):
+        return [f"{minute // 60:02d}:{minute % 60:02d}" for minute in self.times]
+
+    def describe(self):
+        """Plán v jednom řádku, např. "Po, St, Pá v 08:00, 20:00"."""
+        if self.weekdays == self.EVERY_DAY:
+            days = "Denně"
+        else:
+            days = ", ".join(name for index, name in enumerate(self.DAY_ABBREVIATIONS) if self.weekdays >> index & 1)
+        if self.interval_hours:
+            text = f"{days} každých {self.interval_hours} h od {(self.time_labels() or ['00:00'])[0]}"
+        elif self.times:
+            text = f"{days} v {', '.join(self.time_labels())}"
+        else:
+            text = days
+        if self.start_date:
+            text += f" od {self.start_date.day}. {self.start_date.month}. {self.start_date.year}"
+        if self.end_date:
+            text += f" do {self.end_date.day}. {self.end_date.month}. {self.end_date.year}"
+        return text
+
+    def clean(self):
+        if self.interval_hours and len(self.times) > 1:
+            raise ValidationError("Plán s intervalem může mít nejvýš jeden počáteční čas.")
+        if self.start_date and self.end_date and self.end_date < self.start_date:
+            raise ValidationError("Konec plánu nesmí být před začátkem.")
+
+    def save(self, *args, **kwargs):
+        self.normalize()
+        adding = self._state.adding
+        changed = adding or any(field in self.RECURRENCE_FIELDS for field, *_ in self.tracked_changes())
+        super().save(*args, **kwargs)
+        if changed:
+            Schedule.store_slots([self], using=self._state.db, replace=not adding)
+
+    def normalize(self):
+        # Rozvinutí počítá se seřazenými časy bez duplicit
+        self.times = sorted({int(minute) for minute in self.times or ()})
+        self.weekdays &= self.EVERY_DAY
+
+    @classmethod
+    def store_slots(cls, schedules, using=None, replace=True):
+        """
+        Uloží odvozené sloty uložených plánů (ScheduleSlot). save() to dělá samo,
+        hromadné zápisy (bulk_create) ho musí zavolat po vložení plánů.
+        """
+        from .occurrences import slots
 
-    def get_day_of_week_display(self):
-        return dict(self.DAY_OF_WEEK).get(self.day_of_week, self.day_of_week)
+        schedules = list(schedules)
+        if replace:
+            ScheduleSlot.objects.using(using).filter(schedule__in=[schedule.pk for schedule in schedules]).delete()
+        rows = []
+        for schedule in schedules:
+            cycle, minutes = slots(schedule.recurrence)
+            rows.extend(ScheduleSlot(schedule_id=schedule.pk, cycle=cycle, minute=minute) for minute in minutes)
+        ScheduleSlot.objects.using(using).bulk_create(rows)
 
 
+class ScheduleSlot(models.Model):
+    # Výskyty plánu jako minuty v opakujícím se cyklu (occurrences.slots). Zdrojem pravdy je
+    # kompaktní plán, sloty slouží jen k vyhledání plánů splatných v okně indexem.
+    schedule = models.ForeignKey(Schedule, on_delete=models.CASCADE, related_name='slots')
+    # Délka cyklu v minutách: týden, u intervalů nejmenší společný násobek týdne a periody
+    cycle = models.PositiveIntegerField()
+    # Minuta výskytu v cyklu počítaná od occurrences.INTERVAL_EPOCH
+    minute = models.PositiveIntegerField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['cycle', 'minute'], name='schedule_slot_minute_idx'),
+        ]
+
 
 class MedicationStatistics(models.Model):
     medication = models.ForeignKey(Medication, on_delete=models.CASCADE)
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     total_doses_taken = models.PositiveIntegerField(default=0)
-    average_doses_per_day = models.FloatField(default=0)
+    first_dose_at = models.DateTimeField(blank=True, null=True)
+    last_dose_at = models.DateTimeField(blank=True, null=True)
     last_update = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['medication'], name='unique_statistics_per_medication'),
+        ]
+
     def __str__(self):
         return f"Statistiky pro {self.medication.name} - {self.user.username}"
 
+    @property
+    def average_doses_per_day(self):
+        # Průměr se počítá od první dávky, ne od poslední
+        if not self.first_dose_at:
+            return 0
+        days = (timezone.now() - self.first_dose_at).days + 1
+        return round(self.total_doses_taken / days, 2)
+
 
 class MedicationChangeHistory(models.Model):
     medication = models.ForeignKey(Medication, on_delete=models.CASCADE)
@@ -78,6 +302,12 @@ class MedicationChangeHistory(models.Model):
     field_changed = models.CharField(max_length=100)
     old_value = models.TextField()
     new_value = models.TextField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['medication', 'change_date'], name='history_medication_date_idx'),
+        ]
+
     def __str__(self):
         return f"Změna u {self.medication.name} od {self.user.username} na {self.change_date}"
 
@@ -91,3 +321,123 @@ class MedicationChangeHistory(models.Model):
                 field_changed=field,
                 old_value=str(old_value),
                 new_value=str(new_value))
+
+
+class DoseDailyRollup(models.Model):
+    medication = models.ForeignKey(Medication, on_delete=models.CASCADE)
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    date = models.DateField()
+    doses = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['medication', 'user', 'date'], name='unique_rollup_per_medication_day'),
+        ]
+        indexes = [
+            models.Index(fields=['user', 'date'], name='rollup_user_date_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.medication.name} {self.date}: {self.doses}"
+
+
+class ChangeDailyRollup(models.Model):
+    # Počty archivovaných změn za den; samotné záznamy jsou v archivních souborech
+    medication = models.ForeignKey(Medication, on_delete=models.CASCADE)
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    date = models.DateField()
+    field_changed = models.CharField(max_length=100)
+    changes = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['medication', 'date', 'field_changed'], name='unique_change_rollup_per_medication_day'),
+        ]
+        indexes = [
+            models.Index(fields=['user', 'date'], name='change_rollup_user_date_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.medication.name} {self.date} {self.field_changed}: {self.changes}"
+
+
+class AdherenceDaily(models.Model):
+    # Dodržování plánu za den: výskyty plánů proti Logu, počítá medicine/adherence.py
+    medication = models.ForeignKey(Medication, on_delete=models.CASCADE)
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    date = models.DateField()
+    expected = models.PositiveIntegerField(default=0)
+    taken = models.PositiveIntegerField(default=0)
+    late = models.PositiveIntegerField(default=0)
+    missed = models.PositiveIntegerField(default=0)
+    # Zpětně zapsaná dávka nebo změna plánu: při dalším čtení se den přepočítá
+    stale = models.BooleanField(default=False)
+    # Otevřený den (přehled lékaře): kdy se uzavře okno dalšímu čekajícímu výskytu
+    valid_until = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['medication', 'date'], name='unique_adherence_per_medication_day'),
+        ]
+        indexes = [
+            models.Index(fields=['user', 'date'], name='adherence_user_date_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.medication.name} {self.date}: {self.taken + self.late}/{self.expected}"
+
+
+class RunOutForecast(models.Model):
+    # Odhad, kdy lék dojde; přepočítává ho hromadně `manage.py forecast_run_out`
+    medication = models.OneToOneField(Medication, on_delete=models.CASCADE, related_name='forecast')
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    doses_per_day = models.FloatField(default=0)
+    run_out_date = models.DateField(blank=True, null=True)  # Prázdné: lék se neužívá, nedojde
+    # Kdy se odhad naposledy změnil; nezměněné odhady noční přepočet nepřepisuje
+    updated_at = models.DateTimeField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', 'run_out_date'], name='forecast_user_run_out_idx'),
+            models.Index(fields=['run_out_date'], name='forecast_run_out_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.medication.name} dojde {self.run_out_date}"
+
+
+class Checkpoint(models.Model):
+    # Značka, kam až dávkové úlohy zpracovaly data (např. poslední Log.id)
+    name = models.CharField(max_length=100, unique=True)
+    position = models.BigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.name}: {self.position}"
+
+
+class UserShard(models.Model):
+    # Adresář shardů, vždy v hlavní databázi: ve kterém shardu leží data léků uživatele
+    user = models.OneToOneField(User, on_delete=models.CASCADE, related_name='shard')
+    shard = models.CharField(max_length=50)
+    # Během přesunu mezi shardy se zápisy uživatele odmítají
+    moving = models.BooleanField(default=False)
+
+    def __str__(self):
+        return f"{self.user_id}: {self.shard}"
+
+
+class CareRelationship(models.Model):
+    # Koho lékař nebo pečovatel sleduje; vždy v hlavní databázi, pacienti mohou ležet v různých shardech
+    clinician = models.ForeignKey(User, on_delete=models.CASCADE, related_name='supervised_patients')
+    patient = models.ForeignKey(User, on_delete=models.CASCADE, related_name='care_team')
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['clinician', 'patient'], name='unique_care_relationship'),
+        ]
+
+    def __str__(self):
+        return f"{self.clinician.username} → {self.patient.username}"
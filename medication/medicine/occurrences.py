@@ -0,0 +1,194 @@
+import math
+from datetime import date, datetime, time, timedelta
+
+import numpy as np
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import Schedule, ScheduleSlot
+
+MINUTES_PER_DAY = 24 * 60
+MINUTES_PER_WEEK = 7 * MINUTES_PER_DAY
+# Kotva intervalových plánů bez data začátku (pondělí), aby výskyty nezávisely na okně
+INTERVAL_EPOCH = date(2001, 1, 1)
+# Jak daleko dopředu next_occurrences hledá, než to vzdá (plány s koncem nebo prázdné)
+MAX_WEEKS_AHEAD = 520
+
+
+def _week_start(moment):
+    local = timezone.localtime(moment)
+    return datetime.combine(local.date() - timedelta(days=local.weekday()), time.min)
+
+
+def _minutes_since(week_start, moment):
+    local = timezone.localtime(moment).replace(tzinfo=None)
+    return int((local - week_start).total_seconds() // 60)
+
+
+def _at(week_start, minute):
+    return timezone.make_aware(week_start + timedelta(minutes=minute))
+
+
+def _day_minute(week_start, day):
+    return (day - week_start.date()).days * MINUTES_PER_DAY
+
+
+def expand(recurrence, week_start, low, high):
+    """
+    Seřazené minuty výskytů jednoho plánu v [low, high), počítané od začátku týdne `week_start`.
+
+    `recurrence` jsou hodnoty Schedule.RECURRENCE_FIELDS. Pevné časy se
+    rozvinou jako součet dnů a časů, interval jako aritmetická řada od kotvy;
+    dny mimo masku se nakonec odfiltrují. Okno může být libovolně dlouhé.
+    """
+    weekdays, times, interval_hours, start_date, end_date = recurrence
+    if start_date:
+        low = max(low, _day_minute(week_start, start_date))
+    if end_date:
+        high = min(high, _day_minute(week_start, end_date + timedelta(days=1)))
+    if low >= high or not weekdays or not (times or interval_hours):
+        return np.empty(0, dtype=np.int64)
+
+    if interval_hours:
+        period = interval_hours * 60
+        anchor = _day_minute(week_start, start_date or INTERVAL_EPOCH) + (times[0] if times else 0)
+        first = anchor + -(-(low - anchor) // period) * period
+        minutes = np.arange(first, high, period, dtype=np.int64)
+    else:
+        days = np.arange(low // MINUTES_PER_DAY, -(-high // MINUTES_PER_DAY), dtype=np.int64)
+        minutes = (days[:, None] * MINUTES_PER_DAY + np.asarray(times, dtype=np.int64)).ravel()
+        minutes = minutes[(minutes >= low) & (minutes < high)]
+    if weekdays != Schedule.EVERY_DAY:
+        # Začátek týdne je pondělí, den v týdnu je tedy pořadí dne modulo 7
+        minutes = minutes[(weekdays >> (minutes // MINUTES_PER_DAY % 7)) & 1 == 1]
+    return minutes
+
+
+def occurrence_minutes(recurrences, week_start, low, high):
+    """Seřazené minuty výskytů všech plánů `recurrences` v [low, high) najednou (viz expand)."""
+    parts = [expand(recurrence, week_start, low, high) for recurrence in recurrences]
+    if not parts:
+        return np.empty(0, dtype=np.int64)
+    return np.sort(np.concatenate(parts))
+
+
+def _epoch_minutes(moment):
+    return _minutes_since(datetime.combine(INTERVAL_EPOCH, time.min), moment)
+
+
+def slots(recurrence):
+    """
+    Výskyty plánu jako minuty v opakujícím se cyklu od INTERVAL_EPOCH: (délka cyklu, seřazené minuty).
+
+    Pevné časy se opakují po týdnu, interval po nejmenším společném násobku
+    týdne a periody; stejně jako v expand se nakonec odfiltrují dny mimo masku.
+    Rozsah dat do slotů nepatří, filtruje se na plánu.
+    """
+    weekdays, times, interval_hours, start_date, _ = recurrence
+    if not weekdays or not (times or interval_hours):
+        return MINUTES_PER_WEEK, []
+    if interval_hours:
+        period = interval_hours * 60
+        cycle = math.lcm(MINUTES_PER_WEEK, period)
+        anchor = ((start_date or INTERVAL_EPOCH) - INTERVAL_EPOCH).days * MINUTES_PER_DAY + (times[0] if times else 0)
+        minutes = np.arange(anchor % period, cycle, period, dtype=np.int64)
+    else:
+        cycle = MINUTES_PER_WEEK
+        minutes = (np.arange(7, dtype=np.int64)[:, None] * MINUTES_PER_DAY + np.asarray(times, dtype=np.int64)).ravel()
+    # Cyklus je násobek týdne a epocha je pondělí, den v týdnu je tedy pořadí dne modulo 7
+    minutes = minutes[(weekdays >> (minutes // MINUTES_PER_DAY % 7)) & 1 == 1]
+    return cycle, sorted(minutes.tolist())
+
+
+def slot_filter(start, end, cycles):
+    """Podmínka na ScheduleSlot: sloty cyklů `cycles`, které padnou do [start, end)."""
+    low, high = _epoch_minutes(start), _epoch_minutes(end)
+    condition = Q(pk__in=[])
+    for cycle in cycles:
+        if high - low >= cycle:
+            condition |= Q(cycle=cycle)
+            continue
+        first, last = low % cycle, high % cycle
+        # Okno přes konec cyklu se rozdělí na dva rozsahy
+        window = Q(minute__gte=first, minute__lt=last) if first < last else Q(minute__gte=first) | Q(minute__lt=last)
+        condition |= Q(cycle=cycle) & window
+    return condition
+
+
+def compact_slots(slots):
+    """
+    Sloučí dvojice (den v týdnu 0–6 nebo None pro každý den, minuta dne nebo None)
+    do kompaktních plánů [(maska dnů, seřazené časy)]: časy se stejnými dny sdílí jeden plán.
+    """
+    masks = {}
+    for weekday, minute in slots:
+        masks[minute] = masks.get(minute, 0) | (Schedule.EVERY_DAY if weekday is None else 1 << weekday)
+    groups = {}
+    for minute, mask in masks.items():
+        times = groups.setdefault(mask, [])
+        if minute is not None:
+            times.append(minute)
+    return [(mask, sorted(times)) for mask, times in sorted(groups.items())]
+
+
+def due_filter(start, end, using=None):
+    """
+    Podmínka na plány, které mají výskyt v intervalu [start, end).
+
+    Splatné plány se najdou přes index slotů (ScheduleSlot) a rozsah dat;
+    přesné časy se pak rozvinou v paměti (occurrences_in). Délek cyklů je
+    jen pár, zjistí se jedním dotazem nad indexem.
+    """
+    first = timezone.localdate(start)
+    last = timezone.localdate(end - timedelta(microseconds=1))
+    cycles = ScheduleSlot.objects.using(using).order_by().values_list('cycle', flat=True).distinct()
+    return (
+        (Q(start_date__isnull=True) | Q(start_date__lte=last))
+        & (Q(end_date__isnull=True) | Q(end_date__gte=first))
+        & Q(id__in=ScheduleSlot.objects.filter(slot_filter(start, end, list(cycles))).values('schedule_id'))
+    )
+
+
+def occurrences_in(schedule, start, end):
+    """Konkrétní časy výskytů jednoho plánu v intervalu [start, end)."""
+    week_start = _week_start(start)
+    minutes = expand(schedule.recurrence, week_start, _minutes_since(week_start, start),
+                     _minutes_since(week_start, end))
+    return [_at(week_start, minute) for minute in minutes.tolist()]
+
+
+def due_between(start, end, queryset=None):
+    """Seřazené dvojice (čas výskytu, plán) pro všechny plány splatné v [start, end)."""
+    if queryset is None:
+        queryset = Schedule.objects.all()
+    due = []
+    for schedule in queryset.filter(due_filter(start, end, using=queryset.db)):
+        due.extend((occurs_at, schedule) for occurs_at in occurrences_in(schedule, start, end))
+    due.sort(key=lambda item: (item[0], item[1].id))
+    return due
+
+
+def next_occurrences(medication, n, after=None):
+    """Nejbližších `n` výskytů plánů jednoho léku, načtou se jen jeho plány a rozvinou po týdnech."""
+    after = after or timezone.now()
+    schedules = list(Schedule.objects.filter(medication=medication))
+    if not schedules or n <= 0:
+        return []
+
+    week_start = _week_start(after)
+    low = _minutes_since(week_start, after)
+    last_day = None if any(not schedule.end_date for schedule in schedules) else max(
+        schedule.end_date for schedule in schedules)
+    upcoming = []
+    for week in range(MAX_WEEKS_AHEAD):
+        start = low + week * MINUTES_PER_WEEK
+        if last_day and start >= _day_minute(week_start, last_day + timedelta(days=1)):
+            break
+        upcoming.extend(sorted(
+            (minute, schedule.id, schedule)
+            for schedule in schedules
+            for minute in expand(schedule.recurrence, week_start, start, start + MINUTES_PER_WEEK).tolist()
+        ))
+        if len(upcoming) >= n:
+            break
+    return [(_at(week_start, minute), schedule) for minute, _, schedule in upcoming[:n]]
@@ -0,0 +1,86 @@
+import base64
+import json
+
+from django.db.models import Q
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+class KeysetPage:
+    def __init__(self, object_list, next_cursor):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+
+class KeysetPaginator:
+    """
+    Stránkování podle klíče (keyset) místo OFFSET.
+
+    `ordering` je n-tice polí jako pro `order_by()`, poslední pole musí být
+    jednoznačné (typicky `id`). Kurzor nese hodnoty posledního řádku stránky,
+    takže každá stránka je jeden rozsahový dotaz po indexu bez ohledu na to,
+    jak daleko uživatel listuje.
+    """
+
+    def __init__(self, queryset, ordering, per_page):
+        self.queryset = queryset
+        self.ordering = tuple(ordering)
+        self.per_page = per_page
+        self.fields = [name.lstrip('-') for name in self.ordering]
+
+    def page(self, cursor=None):
+        queryset = self.queryset.order_by(*self.ordering)
+        if cursor:
+            queryset = queryset.filter(self._after(self.decode(cursor)))
+
+        rows = list(queryset[:self.per_page + 1])
+        next_cursor = None
+        if len(rows) > self.per_page:
+            rows = rows[:self.per_page]
+            next_cursor = self.encode(rows[-1])
+        return KeysetPage(rows, next_cursor)
+
+    def _after(self, values):
+        # (a, b, c) > (x, y, z)  ==  a > x | (a = x & b > y) | (a = x & b = y & c > z)
+        condition = Q()
+        equal = {}
+        for name, value in zip(self.ordering, values):
+            field = name.lstrip('-')
+            lookup = 'lt' if name.startswith('-') else 'gt'
+            condition |= Q(**equal, **{f'{field}__{lookup}': value})
+            equal[field] = value
+        return condition
+
+    def encode(self, obj):
+        # value_to_string zachová u času i mikrosekundy, DjangoJSONEncoder je ořezává
+        values = [self.queryset.model._meta.get_field(field).value_to_string(obj) for field in self.fields]
+        raw = json.dumps(values).encode()
+        return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+    def decode(self, cursor):
+        try:
+            raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+            values = json.loads(raw)
+        except (ValueError, TypeError):
+            raise InvalidCursor(cursor)
+        if not isinstance(values, list) or len(values) != len(self.fields):
+            raise InvalidCursor(cursor)
+
+        model = self.queryset.model
+        try:
+            return [model._meta.get_field(field).to_python(value)
+                    for field, value in zip(self.fields, values)]
+        except Exception:
+            raise InvalidCursor(cursor)
@@ -0,0 +1,94 @@
+import json
+import sys
+from dataclasses import asdict, dataclass
+
+from django.conf import settings
+from django.db.models import F
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from . import sharding
+from .db import write_transaction
+from .models import Medication
+
+BATCH_SIZE = 500
+
+
+@dataclass(frozen=True)
+class RefillAlert:
+    medication_id: int
+    user_id: int
+    medication_name: str
+    remaining_quantity: int
+    remaining_doses: int
+    refill_threshold: int
+    shard: str
+
+    def as_json(self):
+        return json.dumps(asdict(self), ensure_ascii=False)
+
+
+class ConsoleSink:
+    """Místní náhrada za lékárnu: vypisuje upozornění na výstup."""
+
+    def __init__(self, stream=None):
+        self.stream = stream or sys.stdout
+
+    def send(self, alerts):
+        self.stream.write(''.join(alert.as_json() + '\n' for alert in alerts))
+
+
+class FileSink:
+    """Připisuje upozornění jako JSON řádky do souboru."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def send(self, alerts):
+        with open(self.path, 'a', encoding='utf-8') as output:
+            output.write(''.join(alert.as_json() + '\n' for alert in alerts))
+
+
+def get_sink(path=None, **options):
+    path = path or getattr(settings, 'MEDICINE_REFILL_SINK', 'medicine.refills.ConsoleSink')
+    options = {**getattr(settings, 'MEDICINE_REFILL_SINK_OPTIONS', {}), **options}
+    return import_string(path)(**options)
+
+
+def due():
+    """
+    Léky pod prahem, za které upozornění ještě neodešlo.
+
+    Podmínka je stejná jako u částečného indexu medication_refill_due_idx,
+    dotaz tak čte jen ten. Do indexu lék dostane zápis, který zásobu sníží
+    pod práh, doplnění nad práh ho znovu připraví (Medication.save).
+    """
+    return Medication.objects.filter(
+        refill_alerted_at__isnull=True, remaining_quantity__lt=F('refill_threshold') * F('dosage'))
+
+
+def send_alerts(sink, batch_size=BATCH_SIZE):
+    """
+    Pošle upozornění na doplnění za aktuální shard po dávkách. Vrací jejich počet.
+
+    Dávka se nejdřív předá odesílači a teprve pak se léky označí jako
+    upozorněné; po pádu mezi tím se dávka pošle znovu, neztratí se.
+    """
+    alias = sharding.current_alias()
+    sent, after = 0, 0
+    columns = ('id', 'user_id', 'name', 'remaining_quantity', 'dosage', 'refill_threshold')
+    while batch := list(due().using(alias).filter(id__gt=after).order_by('id').values_list(*columns)[:batch_size]):
+        sink.send([
+            RefillAlert(
+                medication_id=medication_id, user_id=user_id, medication_name=name,
+                remaining_quantity=quantity, remaining_doses=quantity // dosage, refill_threshold=threshold,
+                shard=alias,
+            )
+            for medication_id, user_id, name, quantity, dosage, threshold in batch
+        ])
+        with write_transaction(using=alias):
+            # Jen léky stále pod prahem: doplněné mezitím zůstanou připravené na další pokles
+            due().using(alias).filter(id__in=[row[0] for row in batch]).update(refill_alerted_at=timezone.now())
+        sent += len(batch)
+        after = batch[-1][0]
+    return sent
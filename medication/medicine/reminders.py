@@ -0,0 +1,193 @@
+import asyncio
+import json
+import logging
+import sys
+from collections import defaultdict
+from dataclasses import asdict, dataclass
+from datetime import datetime, timedelta
+
+import numpy as np
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import close_old_connections
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from . import adherence, sharding
+from .models import Log, Schedule
+from .occurrences import due_filter, occurrences_in
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class Reminder:
+    schedule_id: int
+    medication_id: int
+    user_id: int
+    medication_name: str
+    occurs_at: datetime
+
+    def as_json(self):
+        return json.dumps({**asdict(self), 'occurs_at': self.occurs_at.isoformat()}, ensure_ascii=False)
+
+
+class ConsoleSender:
+    """Místní náhrada za skutečné doručování: vypisuje připomínky na výstup."""
+
+    def __init__(self, stream=None):
+        self.stream = stream or sys.stdout
+
+    async def send(self, reminder):
+        self.stream.write(reminder.as_json() + '\n')
+
+
+class FileSender:
+    """Připisuje připomínky jako JSON řádky do souboru."""
+
+    def __init__(self, path):
+        self.path = path
+
+    async def send(self, reminder):
+        await asyncio.to_thread(self._append, reminder.as_json() + '\n')
+
+    def _append(self, line):
+        with open(self.path, 'a', encoding='utf-8') as output:
+            output.write(line)
+
+
+def get_sender(path=None, **options):
+    path = path or getattr(settings, 'MEDICINE_REMINDER_SENDER', 'medicine.reminders.ConsoleSender')
+    options = {**getattr(settings, 'MEDICINE_REMINDER_SENDER_OPTIONS', {}), **options}
+    return import_string(path)(**options)
+
+
+def _taken(medication_ids, start, end, tolerance, using):
+    """
+    Výskyty (čas, id plánu) léků `medication_ids` kolem okna [start, end), ke kterým už je dávka v Logu.
+
+    Každá dávka se přiřadí nejvýš jednomu výskytu stejně jako v dodržování
+    plánu (adherence.match s oknem ±`tolerance`). Sousední výskyty mimo okno
+    soupeří o tytéž dávky, párují se proto také.
+    """
+    low, high = start - 2 * tolerance, end + 2 * tolerance
+    expected = defaultdict(list)
+    for schedule in Schedule.objects.using(using).filter(medication_id__in=medication_ids):
+        expected[schedule.medication_id].extend(
+            (occurs_at, schedule.id) for occurs_at in occurrences_in(schedule, low, high))
+    logs = defaultdict(list)
+    for medication_id, created_at in Log.objects.using(using).filter(
+        medication_id__in=medication_ids, created_at__gte=low - tolerance, created_at__lte=high + tolerance,
+    ).values_list('medication_id', 'created_at'):
+        logs[medication_id].append(int(created_at.timestamp()))
+
+    seconds = int(tolerance.total_seconds())
+    taken = set()
+    for medication_id, occurrences in expected.items():
+        occurrences.sort()
+        status = adherence.match(
+            np.array([int(occurs_at.timestamp()) for occurs_at, _ in occurrences], dtype=np.int64),
+            np.sort(np.array(logs[medication_id], dtype=np.int64)), on_time=seconds, late=seconds)
+        taken.update(occurrence for occurrence, code in zip(occurrences, status.tolist()) if code == adherence.TAKEN)
+    return taken
+
+
+def due_reminders(start, end, after_id=0, batch_size=1000, tolerance=timedelta(minutes=30), using=None):
+    """
+    Jedna dávka připomínek pro okno [start, end), plány po `after_id` podle id.
+
+    Výskyty, ke kterým už je v Logu dávka v toleranci, se přeskočí; jedna
+    dávka vynahradí jen jeden výskyt (viz _taken). Vrací (připomínky, id
+    posledního plánu, zda už žádné další plány nejsou). `using` je shard,
+    bez něj rozhoduje router.
+    """
+    close_old_connections()
+    schedules = list(
+        Schedule.objects.using(using).filter(due_filter(start, end, using=using), id__gt=after_id)
+        .select_related('medication')
+        .order_by('id')[:batch_size]
+    )
+    if not schedules:
+        return [], after_id, True
+
+    due = [(occurs_at, schedule) for schedule in schedules for occurs_at in occurrences_in(schedule, start, end)]
+    taken = _taken({schedule.medication_id for schedule in schedules}, start, end, tolerance, using) if due else set()
+    reminders = [
+        Reminder(
+            schedule_id=schedule.id,
+            medication_id=schedule.medication_id,
+            user_id=schedule.medication.user_id,
+            medication_name=schedule.medication.name,
+            occurs_at=occurs_at,
+        )
+        for occurs_at, schedule in due
+        if (occurs_at, schedule.id) not in taken
+    ]
+    return reminders, schedules[-1].id, len(schedules) < batch_size
+
+
+class ReminderDispatcher:
+    """
+    Asynchronní rozesílání připomínek po časových oknech.
+
+    Databáze se čte po dávkách v jednom vlákně, připomínky jdou do omezené
+    fronty a z ní je odebírá `concurrency` odesílačů. Plná fronta zastaví
+    čtení další dávky (back-pressure), takže ani špička v 08:00 nepřetíží
+    databázi. Okna navazují na sebe podle hodin, zpoždění se dohání bez mezer.
+    """
+
+    def __init__(self, sender, window=timedelta(minutes=1), batch_size=1000, concurrency=100,
+                 queue_size=5000, send_timeout=10, tolerance=timedelta(minutes=30)):
+        self.sender = sender
+        self.window = window
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+        self.send_timeout = send_timeout
+        self.tolerance = tolerance
+
+    async def run(self, start=None, windows=None):
+        start = start or timezone.now().replace(second=0, microsecond=0)
+        processed = 0
+        while windows is None or processed < windows:
+            delay = (start - timezone.now()).total_seconds()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            elif -delay > self.window.total_seconds():
+                logger.warning("Rozesílání připomínek se zpožďuje o %.0f s", -delay)
+
+            end = start + self.window
+            sent = await self.dispatch_window(start, end)
+            logger.info("Okno %s–%s: odesláno %d připomínek", start, end, sent)
+            start = end
+            processed += 1
+
+    async def dispatch_window(self, start, end):
+        queue = asyncio.Queue(maxsize=self.queue_size)
+        counter = {'sent': 0}
+        workers = [asyncio.create_task(self._worker(queue, counter)) for _ in range(self.concurrency)]
+        try:
+            for alias in sharding.shard_aliases():
+                after_id, exhausted = 0, False
+                while not exhausted:
+                    reminders, after_id, exhausted = await sync_to_async(due_reminders)(
+                        start, end, after_id, self.batch_size, self.tolerance, alias)
+                    for reminder in reminders:
+                        await queue.put(reminder)
+            await queue.join()
+        finally:
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+        return counter['sent']
+
+    async def _worker(self, queue, counter):
+        while True:
+            reminder = await queue.get()
+            try:
+                await asyncio.wait_for(self.sender.send(reminder), self.send_timeout)
+                counter['sent'] += 1
+            except Exception:
+                logger.exception("Připomínku pro plán %s se nepodařilo odeslat", reminder.schedule_id)
+            finally:
+                queue.task_done()
@@ -0,0 +1,156 @@
+import gzip
+import json
+import time as clock
+from collections import Counter
+from datetime import date, timedelta
+from itertools import groupby
+
+from django.conf import settings
+from django.utils import timezone
+
+from . import export, rollups, sharding
+from .db import write_transaction
+from .dates import start_of_day
+from .models import Checkpoint, Log, MedicationChangeHistory
+
+BATCH_SIZE = 500
+CHECKPOINT = 'archive_horizon'
+
+# Co se archivuje: model, pole s datem a sloupce navíc proti exportu (vlastník léku)
+KINDS = {
+    'doses': (Log, 'created_at', 'taken_at', {'user_id': 'medication__user_id'}),
+    'changes': (MedicationChangeHistory, 'change_date', 'changed_at', {
+        'user_id': 'medication__user_id', 'changed_by_id': 'user_id',
+    }),
+}
+
+
+def _user_root(kind, user_id):
+    return settings.MEDICINE_ARCHIVE_DIR / kind / str(user_id)
+
+
+def archive_path(kind, user_id, day):
+    """Denní soubor archivu uživatele: <MEDICINE_ARCHIVE_DIR>/<druh>/<user_id>/RRRR/MM/RRRR-MM-DD.jsonl.gz"""
+    return _user_root(kind, user_id) / f"{day:%Y}" / f"{day:%m}" / f"{day:%Y-%m-%d}.jsonl.gz"
+
+
+def horizon(using=None):
+    """Den, před kterým jsou data v databázi už jen v souhrnech, nebo None."""
+    checkpoint = Checkpoint.objects.using(using).filter(name=CHECKPOINT).first()
+    return date.fromordinal(checkpoint.position) if checkpoint and checkpoint.position else None
+
+
+def _write(kind, rows):
+    """
+    Připíše řádky do denních souborů jejich vlastníků jako nový člen gzipu.
+
+    Každý uživatel a den je jeden zápis v režimu připojení, soubor je tak po
+    každé dávce čitelný celý. Pokud se běh přeruší před smazáním z databáze,
+    řádky se zapíšou znovu a čtení je podle (shard, id) přeskočí.
+    """
+    date_column = KINDS[kind][2]
+
+    def owner_day(row):
+        return row['user_id'], timezone.localdate(row[date_column])
+
+    # Dávka je seřazená podle data, řazení je stabilní a pořadí id uvnitř dne zůstane
+    for (user_id, day), day_rows in groupby(sorted(rows, key=owner_day), key=owner_day):
+        data = ''.join(
+            json.dumps({name: export._value(value) for name, value in row.items()}, ensure_ascii=False) + '\n'
+            for row in day_rows
+        )
+        path = archive_path(kind, user_id, day)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, 'ab') as archive:
+            archive.write(gzip.compress(data.encode('utf-8')))
+
+
+def _batch(kind, cutoff, batch_size, alias, counted):
+    model, date_field, _, extra = KINDS[kind]
+    columns = {**export.COLUMNS[kind][2], **extra}
+    queryset = model.objects.using(alias).filter(**{f'{date_field}__lt': cutoff})
+    if model is Log:
+        # Mazat jde jen dávky, které už denní souhrny započítaly
+        queryset = queryset.filter(id__lte=counted)
+    # Řazení podle data seskupí řádky do denních souborů, id drží pořadí uvnitř dne
+    rows = queryset.order_by(date_field, 'id').values_list(*columns.values())[:batch_size]
+    return [dict(zip(columns, row), shard=alias) for row in rows]
+
+
+def archive(days=None, batch_size=BATCH_SIZE, pause=0.0):
+    """
+    Přesune dávky a změny starší než `days` dní z aktuálního shardu do archivu.
+
+    Nejdřív se doplní denní souhrny dávek, dodržování plánu se uloží před
+    každou dávkou mazání jen pro její léky a dny. Změny se do souhrnů
+    přičtou ve stejné transakci, ve které se mažou. Každá dávka je vlastní
+    krátká transakce, mezi dávkami lze nechat `pause` sekund pro ostatní
+    zápisy. Vrací počty řádků.
+    """
+    from . import adherence
+
+    alias = sharding.current_alias()
+    day = timezone.localdate() - timedelta(days=settings.MEDICINE_RETENTION_DAYS if days is None else days)
+    cutoff = start_of_day(day)
+    rollups.refresh()
+    counted = rollups.counted_position(using=alias)
+
+    archived = Counter()
+    for kind, (model, *_) in KINDS.items():
+        while rows := _batch(kind, cutoff, batch_size, alias, counted):
+            if model is Log:
+                # Dodržování plánu se z archivovaných dnů už spočítat nedá, uloží se předem
+                adherence.keep_days(
+                    {row['medication_id'] for row in rows},
+                    timezone.localdate(rows[0]['taken_at']) - timedelta(days=1),
+                    timezone.localdate(rows[-1]['taken_at']) + timedelta(days=1),
+                    using=alias,
+                )
+            _write(kind, rows)
+            with write_transaction(using=alias):
+                if model is MedicationChangeHistory:
+                    changes = Counter(
+                        (row['medication_id'], row['user_id'], timezone.localdate(row['changed_at']), row['field'])
+                        for row in rows
+                    )
+                    rollups.add_changes([(*key, count) for key, count in changes.items()], using=alias)
+                model.objects.using(alias).filter(id__in=[row['id'] for row in rows]).delete()
+            archived[kind] += len(rows)
+            if pause:
+                clock.sleep(pause)
+
+    with write_transaction(using=alias):
+        checkpoint, _ = Checkpoint.objects.using(alias).select_for_update().get_or_create(name=CHECKPOINT)
+        if checkpoint.position < day.toordinal():
+            checkpoint.position = day.toordinal()
+            checkpoint.save(update_fields=['position', 'updated_at'])
+    return dict(archived)
+
+
+def _files(kind, user_id, since, until):
+    for path in sorted(_user_root(kind, user_id).glob('*/*/*.jsonl.gz')):
+        day = date.fromisoformat(path.name.removesuffix('.jsonl.gz'))
+        if (since is None or day >= since) and (until is None or day <= until):
+            yield path
+
+
+def read(kind, user_id, since=None, until=None, medication_id=None):
+    """
+    Archivované řádky uživatele ve tvaru exportu, po dnech od nejstaršího.
+
+    Čtou se jen soubory uživatele. Archiv je společný pro všechny shardy; id
+    léků odpovídají shardu, ve kterém data byla v době archivace.
+    """
+    names = list(export.COLUMNS[kind][2])
+    for path in _files(kind, user_id, since, until):
+        seen = set()
+        with gzip.open(path, 'rt', encoding='utf-8') as archive:
+            for line in archive:
+                row = json.loads(line)
+                if medication_id is not None and row['medication_id'] != medication_id:
+                    continue
+                key = (row['shard'], row['id'])
+                if key in seen:
+                    continue
+                seen.add(key)
+                yield tuple(row[name] for name in names)
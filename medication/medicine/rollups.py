@@ -0,0 +1,116 @@
+from datetime import timedelta
+
+from django.db import connections, router
+from django.db.models import Count, Max, Sum
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+from . import caching
+from .db import write_transaction
+from .models import ChangeDailyRollup, Checkpoint, DoseDailyRollup, Log
+
+CHECKPOINT = 'dose_daily_rollup'
+
+
+def _upsert_sql(connection):
+    rollup = connection.ops.quote_name(DoseDailyRollup._meta.db_table)
+    return f"""
+        INSERT INTO {rollup} (medication_id, user_id, date, doses) VALUES (%s, %s, %s, %s)
+        ON CONFLICT (medication_id, user_id, date) DO UPDATE SET
+            doses = {rollup}.doses + excluded.doses
+    """
+
+
+def add_doses(rows, using=None):
+    """Přičte (medication_id, user_id, date, počet) do denních souhrnů."""
+    connection = connections[using or router.db_for_write(DoseDailyRollup)]
+    params = [
+        (medication_id, user_id, connection.ops.adapt_datefield_value(date), doses)
+        for medication_id, user_id, date, doses in rows
+    ]
+    if params:
+        with connection.cursor() as cursor:
+            cursor.executemany(_upsert_sql(connection), params)
+
+
+def _change_upsert_sql(connection):
+    rollup = connection.ops.quote_name(ChangeDailyRollup._meta.db_table)
+    return f"""
+        INSERT INTO {rollup} (medication_id, user_id, date, field_changed, changes) VALUES (%s, %s, %s, %s, %s)
+        ON CONFLICT (medication_id, date, field_changed) DO UPDATE SET
+            changes = {rollup}.changes + excluded.changes
+    """
+
+
+def add_changes(rows, using=None):
+    """Přičte (medication_id, user_id, date, pole, počet) do denních souhrnů změn."""
+    connection = connections[using or router.db_for_write(ChangeDailyRollup)]
+    params = [
+        (medication_id, user_id, connection.ops.adapt_datefield_value(date), field, changes)
+        for medication_id, user_id, date, field, changes in rows
+    ]
+    if params:
+        with connection.cursor() as cursor:
+            cursor.executemany(_change_upsert_sql(connection), params)
+
+
+def counted_position(using=None):
+    """Nejvyšší Log.id, které už je v denních souhrnech započtené."""
+    checkpoint = Checkpoint.objects.using(using).filter(name=CHECKPOINT).first()
+    return checkpoint.position if checkpoint else 0
+
+
+def refresh(batch_size=10000):
+    """
+    Doplní denní souhrny o Logy přidané od posledního běhu.
+
+    Postupuje po rozsazích Log.id od uložené značky, každý rozsah je vlastní
+    krátká transakce, takže přerušený běh pokračuje tam, kde skončil.
+    Vrací počet zpracovaných záznamů z Logu.
+    """
+    high = Log.objects.aggregate(high=Max('id'))['high'] or 0
+    processed = 0
+    while True:
+        with write_transaction(using=router.db_for_write(Checkpoint)):
+            checkpoint, _ = Checkpoint.objects.select_for_update().get_or_create(name=CHECKPOINT)
+            low = checkpoint.position
+            if low >= high:
+                break
+            upper = min(low + batch_size, high)
+
+            rows = (
+                Log.objects.filter(id__gt=low, id__lte=upper)
+                .annotate(date=TruncDate('created_at'))
+                .values('medication_id', 'medication__user_id', 'date')
+                .annotate(doses=Count('id'))
+                .order_by()
+            )
+            counted = 0
+            batch = []
+            for row in rows:
+                batch.append((row['medication_id'], row['medication__user_id'], row['date'], row['doses']))
+                counted += row['doses']
+            add_doses(batch)
+            caching.bump_on_commit(caching.STATISTICS, [user_id for _, user_id, _, _ in batch])
+
+            checkpoint.position = upper
+            checkpoint.save(update_fields=['position', 'updated_at'])
+            processed += counted
+    return processed
+
+
+def daily_series(rollups, days=90):
+    """Denní součty dávek za posledních `days` dní včetně dnů bez užití."""
+    start = timezone.localdate() - timedelta(days=days - 1)
+    totals = dict(
+        rollups.filter(date__gte=start)
+        .values('date')
+        .annotate(total=Sum('doses'))
+        .order_by()
+        .values_list('date', 'total')
+    )
+    series = []
+    for offset in range(days):
+        date = start + timedelta(days=offset)
+        series.append((date, totals.get(date, 0)))
+    return series
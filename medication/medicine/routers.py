@@ -0,0 +1,118 @@
+import random
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+
+from . import sharding
+
+# Stav aktuálního požadavku; mimo požadavek (příkazy, testy, vlákna) se čte z hlavní databáze
+_request_state = ContextVar('medicine_read_state', default=None)
+
+
+class _ReadState:
+    def __init__(self, primary):
+        self.primary = primary
+        self.wrote = False
+        replicas = getattr(settings, 'READ_REPLICAS', [])
+        # Jedna replika na celý požadavek, aby se stránka nečetla z různě opožděných kopií
+        self.replica = random.choice(replicas) if replicas else None
+
+
+@contextmanager
+def read_context(primary=False):
+    """Po dobu bloku čte z repliky, pokud není `primary` a dosud se nezapisovalo."""
+    state = _ReadState(primary)
+    token = _request_state.set(state)
+    try:
+        yield state
+    finally:
+        _request_state.reset(token)
+
+
+PIN_COOKIE = 'medicine_primary'
+_PIN_SALT = 'medicine.routers.pin'
+
+
+def pin_to_primary(request, response):
+    """
+    Uživatel po zápisu čte chvíli z hlavní databáze, aby viděl své změny.
+
+    Připnutí nese podepsaná cookie s id uživatele, platí tedy pro všechny
+    procesy i bez sdíleného úložiště.
+    """
+    if request.user.is_authenticated and settings.READ_AFTER_WRITE_WINDOW > 0:
+        response.set_signed_cookie(
+            PIN_COOKIE, str(request.user.pk), salt=_PIN_SALT, max_age=settings.READ_AFTER_WRITE_WINDOW,
+            httponly=True, samesite='Lax')
+
+
+def is_pinned(request):
+    if not request.user.is_authenticated:
+        return False
+    # Podpis obsahuje čas vydání, starší cookie se odmítne i tehdy, když ji prohlížeč pošle
+    pinned = request.get_signed_cookie(
+        PIN_COOKIE, default=None, salt=_PIN_SALT, max_age=settings.READ_AFTER_WRITE_WINDOW)
+    return pinned == str(request.user.pk)
+
+
+def _note_write():
+    # Zápis kamkoli (hlavní databáze i shard) přepne zbytek požadavku na hlavní databázi a připne uživatele
+    state = _request_state.get()
+    if state is not None:
+        state.wrote = True
+
+
+class ReadReplicaRouter:
+    def db_for_read(self, model, **hints):
+        state = _request_state.get()
+        if state is None or state.primary or state.wrote or state.replica is None:
+            return DEFAULT_DB_ALIAS
+        return state.replica
+
+    def db_for_write(self, model, **hints):
+        _note_write()
+        # Výslovně, jinak by Django zapisoval tam, odkud byla instance načtena
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Repliky obsahují stejná data jako hlavní databáze
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # Repliky dostávají schéma kopií hlavní databáze
+        return db == DEFAULT_DB_ALIAS
+
+
+class ShardRouter:
+    """
+    Modely aplikace medicine směruje do shardu uživatele.
+
+    Uživatelé, session a adresář shardů zůstávají v hlavní databázi, o ně se
+    postará další router. Bez nastavených shardů router nic nerozhoduje.
+    """
+
+    def _shard(self, model, hints):
+        if not sharding.enabled() or not sharding.is_sharded(model):
+            return None
+        instance = hints.get('instance')
+        if instance is not None and instance._state.db in settings.SHARDS:
+            return instance._state.db
+        return sharding.current_alias()
+
+    def db_for_read(self, model, **hints):
+        return self._shard(model, hints)
+
+    def db_for_write(self, model, **hints):
+        alias = self._shard(model, hints)
+        if alias is not None:
+            # Na další router zápis nedojde, připnutí po zápisu se proto zaznamená tady
+            _note_write()
+        return alias
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # Shard potřebuje i tabulky uživatelů kvůli cizím klíčům, schéma je všude stejné
+        if db in getattr(settings, 'SHARDS', []):
+            return True
+        return None
@@ -0,0 +1,242 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.db import DEFAULT_DB_ALIAS
+from django.db.models import Count, Max
+from django.db.models.functions import TruncDate
+
+# Shard, se kterým pracuje aktuální požadavek nebo úloha
+_current_shard = ContextVar('medicine_shard', default=None)
+
+
+class ShardNotSelected(RuntimeError):
+    pass
+
+
+def enabled():
+    return bool(getattr(settings, 'SHARDS', []))
+
+
+def shard_aliases():
+    """Databáze s daty léků; bez shardingu jen hlavní databáze."""
+    return list(settings.SHARDS) if enabled() else [DEFAULT_DB_ALIAS]
+
+
+def is_sharded(model):
+    # Adresář shardů musí zůstat v hlavní databázi, jinak by nešel najít; vazby lékař–pacient
+    # spojují uživatele z různých shardů
+    return model._meta.app_label == 'medicine' and model._meta.model_name not in ('usershard', 'carerelationship')
+
+
+def current_shard():
+    return _current_shard.get()
+
+
+def current_alias():
+    """Databáze pro data léků v aktuálním kontextu."""
+    if not enabled():
+        return DEFAULT_DB_ALIAS
+    shard = _current_shard.get()
+    if shard is None:
+        raise ShardNotSelected("Není zvolen shard, použijte sharding.for_user() nebo sharding.use_shard().")
+    return shard
+
+
+@contextmanager
+def use_shard(alias):
+    token = _current_shard.set(alias)
+    try:
+        yield alias
+    finally:
+        _current_shard.reset(token)
+
+
+def for_user(user):
+    return use_shard(shard_for_user(getattr(user, 'pk', user)))
+
+
+def replicate_users(user_ids, alias):
+    """
+    Zkopíruje uživatele do shardu kvůli cizím klíčům.
+
+    Kopie nese jen id, jméno a datum registrace, přihlašování jde vždy přes
+    hlavní databázi.
+    """
+    if alias == DEFAULT_DB_ALIAS:
+        return
+    users = User.objects.using(DEFAULT_DB_ALIAS).filter(pk__in=set(user_ids))
+    User.objects.using(alias).bulk_create(
+        [
+            User(pk=user.pk, username=user.username, date_joined=user.date_joined, password=make_password(None))
+            for user in users.only('username', 'date_joined')
+        ],
+        ignore_conflicts=True,
+    )
+
+
+def directory_entry(user_id):
+    """Záznam adresáře pro uživatele; nový uživatel dostane shard podle id."""
+    from .models import UserShard
+
+    entry = UserShard.objects.using(DEFAULT_DB_ALIAS).filter(user_id=user_id).first()
+    if entry is None:
+        shard = settings.SHARDS[user_id % len(settings.SHARDS)]
+        replicate_users([user_id], shard)
+        entry, _ = UserShard.objects.using(DEFAULT_DB_ALIAS).get_or_create(user_id=user_id, defaults={'shard': shard})
+    return entry
+
+
+def shard_for_user(user_id):
+    if not enabled():
+        return DEFAULT_DB_ALIAS
+    return directory_entry(user_id).shard
+
+
+def group_by_shard(user_ids):
+    """
+    Rozdělí uživatele podle shardů jedním dotazem do adresáře: {alias: [user_id, ...]}.
+
+    Uživatel bez záznamu v adresáři ještě žádná data nemá, zařadí se podle
+    stejného pravidla jako v directory_entry(), ale záznam se nevytváří.
+    """
+    from .models import UserShard
+
+    if not enabled():
+        return {DEFAULT_DB_ALIAS: list(user_ids)} if user_ids else {}
+    directory = dict(UserShard.objects.using(DEFAULT_DB_ALIAS).filter(user_id__in=user_ids)
+                     .values_list('user_id', 'shard'))
+    groups = {}
+    for user_id in user_ids:
+        shard = directory.get(user_id) or settings.SHARDS[user_id % len(settings.SHARDS)]
+        groups.setdefault(shard, []).append(user_id)
+    return groups
+
+
+def _copy(instance, **values):
+    data = {field.attname: getattr(instance, field.attname) for field in instance._meta.concrete_fields
+            if not field.primary_key}
+    data.update(values)
+    return type(instance)(**data)
+
+
+def _batches(queryset, batch_size):
+    after = 0
+    while batch := list(queryset.filter(id__gt=after).order_by('id')[:batch_size]):
+        yield batch
+        after = batch[-1].id
+
+
+def delete_user_data(user_id, alias, batch_size=500):
+    """Smaže data léků uživatele ze shardu po dávkách, nejdřív závislé tabulky."""
+    from .db import write_transaction
+    from .models import (
+        AdherenceDaily, ChangeDailyRollup, DoseDailyRollup, Log, Medication, MedicationChangeHistory,
+        MedicationStatistics, RunOutForecast, Schedule,
+    )
+
+    for model in (
+        Log, Schedule, MedicationChangeHistory, MedicationStatistics, RunOutForecast, DoseDailyRollup,
+        ChangeDailyRollup, AdherenceDaily, Medication,
+    ):
+        lookup = 'user_id' if model is Medication else 'medication__user_id'
+        queryset = model.objects.using(alias).filter(**{lookup: user_id})
+        while ids := list(queryset.values_list('id', flat=True)[:batch_size]):
+            with write_transaction(using=alias):
+                model.objects.using(alias).filter(id__in=ids).delete()
+
+
+def move_user(user_id, target, batch_size=500):
+    """
+    Přesune data léků uživatele do jiného shardu. Vrací počet přesunutých řádků.
+
+    Řádky se kopírují po dávkách s novými id (id léků se v cílovém shardu
+    přečíslují), pak se přepne adresář a nakonec se data smažou ze zdroje.
+    Zápisy uživatele se po dobu přesunu odmítají, čtení běží ze zdroje.
+    Přerušený přesun se při dalším spuštění začne znovu.
+    """
+    from . import caching, rollups
+    from .db import write_transaction
+    from .models import (
+        AdherenceDaily, ChangeDailyRollup, Checkpoint, DoseDailyRollup, Log, Medication, MedicationChangeHistory,
+        MedicationStatistics, RunOutForecast, Schedule, UserShard,
+    )
+
+    if target not in settings.SHARDS:
+        raise ValueError(f"Neznámý shard {target!r}.")
+    entry = directory_entry(user_id)
+    source = entry.shard
+    if source == target:
+        return 0
+
+    UserShard.objects.using(DEFAULT_DB_ALIAS).filter(pk=entry.pk).update(moving=True)
+    replicate_users([user_id], target)
+    # Zbytky dříve přerušeného přesunu
+    delete_user_data(user_id, target, batch_size)
+
+    moved = 0
+    medication_ids = {}
+    for batch in _batches(Medication.objects.using(source).filter(user_id=user_id), batch_size):
+        with write_transaction(using=target):
+            copies = Medication.objects.using(target).bulk_create([_copy(medication) for medication in batch])
+        medication_ids.update((medication.id, copy.id) for medication, copy in zip(batch, copies))
+        moved += len(batch)
+
+    for model in (
+        Schedule, MedicationStatistics, RunOutForecast, MedicationChangeHistory, ChangeDailyRollup, AdherenceDaily, Log,
+    ):
+        queryset = model.objects.using(source).filter(medication__user_id=user_id)
+        for batch in _batches(queryset, batch_size):
+            copies = [_copy(row, medication_id=medication_ids[row.medication_id]) for row in batch]
+            with write_transaction(using=target):
+                if model is MedicationChangeHistory:
+                    # Změny mohl provést i jiný uživatel (správce)
+                    replicate_users({row.user_id for row in batch}, target)
+                if model is Log:
+                    # Nová id nad značkou denních souhrnů, aby je cílový shard započítal
+                    checkpoint = Checkpoint.objects.using(target).filter(name=rollups.CHECKPOINT).first()
+                    start = max(
+                        Log.objects.using(target).aggregate(high=Max('id'))['high'] or 0,
+                        checkpoint.position if checkpoint else 0,
+                    )
+                    for offset, copy in enumerate(copies, start + 1):
+                        copy.id = offset
+                model.objects.using(target).bulk_create(copies)
+                if model is Schedule:
+                    Schedule.store_slots(copies, using=target, replace=False)
+                if model is MedicationChangeHistory:
+                    # auto_now_add při vložení přepíše datum změny, vrátí se zpět
+                    for row, copy in zip(batch, copies):
+                        copy.change_date = row.change_date
+                    model.objects.using(target).bulk_update(copies, ['change_date'])
+            moved += len(batch)
+
+    # Denní souhrny dávek se v cíli spočítají z přesunutých Logů, přenese se jen
+    # zbytek za archivované dávky, které v Logu už nejsou
+    counted = rollups.counted_position(using=source)
+    live = dict(
+        ((row['medication_id'], row['date']), row['doses'])
+        for row in Log.objects.using(source)
+        .filter(medication__user_id=user_id, id__lte=counted)
+        .annotate(date=TruncDate('created_at'))
+        .values('medication_id', 'date')
+        .annotate(doses=Count('id'))
+        .order_by()
+    )
+    for batch in _batches(DoseDailyRollup.objects.using(source).filter(user_id=user_id), batch_size):
+        copies = [
+            _copy(row, medication_id=medication_ids[row.medication_id],
+                  doses=row.doses - live.get((row.medication_id, row.date), 0))
+            for row in batch
+        ]
+        with write_transaction(using=target):
+            DoseDailyRollup.objects.using(target).bulk_create([copy for copy in copies if copy.doses > 0])
+
+    UserShard.objects.using(DEFAULT_DB_ALIAS).filter(pk=entry.pk).update(shard=target, moving=False)
+    delete_user_data(user_id, source, batch_size)
+    with use_shard(target):
+        rollups.refresh()
+    caching.bump(caching.STATISTICS, user_id)
+    return moved
@@ -1,24 +1,54 @@
 # signals.py
-from django.db.models.signals import post_save
+from django.db.models.signals import post_delete, post_save
+from django.db.models import F
 from django.dispatch import receiver
-from .models import Medication, MedicationStatistics
-from django.utils import timezone
+from .models import CareRelationship, Log, Medication, Schedule
+from . import adherence, caching, history, sharding, statistics
+
+
+@receiver(post_save, sender=Log)
+def update_medication_statistics(sender, instance, created, using, **kwargs):
+    # Statistiky se odvozují jen z opravdu užitých dávek, ne z každé úpravy léku
+    if created:
+        statistics.record_dose(instance, using=using)
+        adherence.invalidate_doses([(instance.medication_id, instance.created_at)], using=using)
+
 
 @receiver(post_save, sender=Medication)
-def update_medication_statistics(sender, instance, created, **kwargs):
+@receiver(post_save, sender=Schedule)
+def record_medication_changes(sender, instance, created, **kwargs):
+    if created:
+        instance.take_snapshot()
+    else:
+        history.record_instance_changes(instance)
 
-    stats, created = MedicationStatistics.objects.get_or_create(
-        user=instance.user,
-        medication=instance
-    )
 
-    stats.total_doses_taken += 1
+@receiver(post_save, sender=Medication)
+@receiver(post_delete, sender=Medication)
+def invalidate_statistics(sender, instance, using, **kwargs):
+    caching.bump_on_commit(caching.STATISTICS, [instance.user_id], using=using)
 
 
-    if instance.last_taken:
-        days_since_last_use = (timezone.now() - instance.last_taken).days or 1
-        stats.average_doses_per_day = stats.total_doses_taken / days_since_last_use
-    else:
-        stats.average_doses_per_day = 0
+@receiver(post_save, sender=Schedule)
+@receiver(post_delete, sender=Schedule)
+def bump_medication_version(sender, instance, using, origin=None, **kwargs):
+    # Plány jsou součástí karty léku, její verze se musí změnit i s nimi
+    if isinstance(origin, Medication) or getattr(origin, 'model', None) is Medication:
+        return
+    Medication.objects.using(using).filter(id=instance.medication_id).update(version=F('version') + 1)
+
+
+@receiver(post_save, sender=Schedule)
+@receiver(post_delete, sender=Schedule)
+def invalidate_adherence(sender, instance, using, origin=None, **kwargs):
+    # Smazaný lék si uložené dny odnese sám
+    if isinstance(origin, Medication) or getattr(origin, 'model', None) is Medication:
+        return
+    adherence.invalidate_medication(instance.medication_id, using=using)
+
 
-    stats.save()
+@receiver(post_save, sender=CareRelationship)
+def register_patient(sender, instance, created, **kwargs):
+    # Přehled lékaře řadí pacienty nad jejich kopiemi v shardech, pacient tam musí být i bez dat
+    if created and sharding.enabled():
+        sharding.directory_entry(instance.patient_id)
@@ -0,0 +1,121 @@
+from itertools import islice
+
+from django.db import connections, router
+from django.db.models import Count, Exists, Max, Min, OuterRef, Q, Sum
+from django.utils import timezone
+
+from . import caching, rollups
+from .db import write_transaction
+from .dates import start_of_day
+from .models import DoseDailyRollup, Log, Medication, MedicationStatistics
+
+
+def _upsert_sql(connection):
+    qn = connection.ops.quote_name
+    stats = qn(MedicationStatistics._meta.db_table)
+    medication = qn(Medication._meta.db_table)
+    return f"""
+        INSERT INTO {stats} (medication_id, user_id, total_doses_taken, first_dose_at, last_dose_at, last_update)
+        SELECT id, user_id, %s, %s, %s, %s FROM {medication} WHERE id = %s
+        ON CONFLICT (medication_id) DO UPDATE SET
+            total_doses_taken = {stats}.total_doses_taken + excluded.total_doses_taken,
+            first_dose_at = CASE
+                WHEN {stats}.first_dose_at IS NULL OR excluded.first_dose_at < {stats}.first_dose_at
+                THEN excluded.first_dose_at ELSE {stats}.first_dose_at END,
+            last_dose_at = CASE
+                WHEN {stats}.last_dose_at IS NULL OR excluded.last_dose_at > {stats}.last_dose_at
+                THEN excluded.last_dose_at ELSE {stats}.last_dose_at END,
+            last_update = excluded.last_update
+    """
+
+
+def record_doses(doses, using=None):
+    """
+    Přičte užité dávky do statistik.
+
+    `doses` jsou n-tice (medication_id, počet, první užití, poslední užití).
+    Každý lék je jeden upsert, uživatel se dohledá přímo v INSERT ... SELECT.
+    """
+    connection = connections[using or router.db_for_write(MedicationStatistics)]
+    adapt = connection.ops.adapt_datetimefield_value
+    now = adapt(timezone.now())
+    params = [
+        (count, adapt(first_at), adapt(last_at), now, medication_id)
+        for medication_id, count, first_at, last_at in doses
+    ]
+    if not params:
+        return
+    with connection.cursor() as cursor:
+        cursor.executemany(_upsert_sql(connection), params)
+
+
+def record_dose(log, using=None):
+    record_doses([(log.medication_id, 1, log.created_at, log.created_at)], using=using)
+
+
+def _totals(batch_size):
+    """
+    Statistiky léků sloučené ze dvou proudů seřazených podle léku: denní souhrny
+    (zahrnují i archivované dávky, které už v Logu nejsou) a Logy, které souhrny
+    ještě nezapočetly. U archivovaných dnů je čas první dávky jen začátek dne.
+    """
+    counted = rollups.counted_position()
+    logs = iter(
+        Log.objects.values('medication_id', 'medication__user_id')
+        .annotate(pending=Count('id', filter=Q(id__gt=counted)), first=Min('created_at'), last=Max('created_at'))
+        .order_by('medication_id')
+        .iterator(chunk_size=batch_size)
+    )
+    days = iter(
+        DoseDailyRollup.objects.values('medication_id', 'user_id')
+        .annotate(total=Sum('doses'), first_day=Min('date'), last_day=Max('date'))
+        .order_by('medication_id')
+        .iterator(chunk_size=batch_size)
+    )
+    log, day = next(logs, None), next(days, None)
+    while log or day:
+        if day is None or (log and log['medication_id'] < day['medication_id']):
+            yield MedicationStatistics(
+                medication_id=log['medication_id'], user_id=log['medication__user_id'],
+                total_doses_taken=log['pending'], first_dose_at=log['first'], last_dose_at=log['last'],
+            )
+            log = next(logs, None)
+            continue
+        first, last = start_of_day(day['first_day']), start_of_day(day['last_day'])
+        total = day['total']
+        if log and log['medication_id'] == day['medication_id']:
+            total += log['pending']
+            if day['first_day'] >= timezone.localdate(log['first']):
+                first = log['first']
+            if day['last_day'] <= timezone.localdate(log['last']):
+                last = log['last']
+            log = next(logs, None)
+        yield MedicationStatistics(
+            medication_id=day['medication_id'], user_id=day['user_id'],
+            total_doses_taken=total, first_dose_at=first, last_dose_at=last,
+        )
+        day = next(days, None)
+
+
+def rebuild(batch_size=1000):
+    """Přepočítá všechny statistiky hromadnými dotazy. Vrací počet léků s dávkami."""
+    totals = _totals(batch_size)
+    rebuilt = 0
+    with write_transaction(using=router.db_for_write(MedicationStatistics)):
+        while batch := list(islice(totals, batch_size)):
+            MedicationStatistics.objects.bulk_create(
+                batch,
+                update_conflicts=True,
+                unique_fields=['medication'],
+                update_fields=['user', 'total_doses_taken', 'first_dose_at', 'last_dose_at', 'last_update'],
+            )
+            rebuilt += len(batch)
+
+        # Léky bez jediné dávky v Logu ani v souhrnech nemají co počítat
+        MedicationStatistics.objects.exclude(
+            Exists(Log.objects.filter(medication=OuterRef('medication')))
+        ).exclude(
+            Exists(DoseDailyRollup.objects.filter(medication=OuterRef('medication')))
+        ).update(total_doses_taken=0, first_dose_at=None, last_dose_at=None, last_update=timezone.now())
+        caching.bump_on_commit(caching.STATISTICS, [caching.GLOBAL])
+    return rebuilt
@@ -1,3 +1,1235 @@
-from django.test import TestCase
+import asyncio
+import gzip
+import json
+import tempfile
+import threading
+from contextlib import ExitStack, contextmanager
+from datetime import date, datetime, time, timedelta
+from io import StringIO
+from pathlib import Path
+from types import SimpleNamespace
+from unittest import mock, skipUnless
 
-# Create your tests here.
+import numpy as np
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import DEFAULT_DB_ALIAS, OperationalError, connection, connections, router
+from django.db.models.signals import post_save
+from django.http import Http404, HttpResponse
+from django.test import RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from . import (
+    adherence, dashboard, export, forecasting, importer, ingest, occurrences, refills, retention, rollups, sharding,
+    statistics, views,
+)
+from .history import changed_by
+from .ingest import ingest_dose_events
+from .middleware import PerformanceMiddleware, ReadReplicaMiddleware
+from .reminders import ReminderDispatcher, due_reminders
+from .models import (
+    AdherenceDaily, CareRelationship, ChangeDailyRollup, Checkpoint, DoseDailyRollup, Log, Medication,
+    MedicationChangeHistory, MedicationStatistics, RunOutForecast, Schedule,
+)
+
+
+def _register_in_shard(sender, instance, created, **kwargs):
+    if created:
+        sharding.directory_entry(instance.pk)
+
+
+class SingleShardMixin:
+    """
+    S MEDICATION_SHARDS běží test celý v prvním shardu: všichni uživatelé do něj
+    patří a přímé dotazy na modely jdou do něj. Rozdělení mezi shardy pokrývá ShardingTests.
+    """
+    databases = '__all__'
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        if not settings.SHARDS:
+            return
+        cls.enterClassContext(override_settings(SHARDS=settings.SHARDS[:1]))
+        cls.enterClassContext(sharding.use_shard(settings.SHARDS[0]))
+        # Nový uživatel hned dostane záznam v adresáři a kopii ve shardu, jinak by je
+        # založil až první požadavek a započítal se do měřených dotazů
+        post_save.connect(_register_in_shard, sender=User)
+        cls.addClassCleanup(post_save.disconnect, _register_in_shard, sender=User)
+
+    @classmethod
+    def captureOnCommitCallbacks(cls, *, using=None, execute=False):
+        # Zápisy dat léků potvrzuje databáze aktuálního shardu
+        return super().captureOnCommitCallbacks(using=using or sharding.current_alias(), execute=execute)
+
+    @contextmanager
+    def capture_queries(self):
+        """
+        Dotazy do hlavní databáze i do shardu. Dotazy do adresáře shardů se
+        nepočítají, bez shardingu se nekonají a počty mají vyjít stejně.
+        """
+        captured = SimpleNamespace(captured_queries=[])
+        with ExitStack() as stack:
+            contexts = [
+                stack.enter_context(CaptureQueriesContext(connections[alias]))
+                for alias in dict.fromkeys([DEFAULT_DB_ALIAS, sharding.current_alias()])
+            ]
+            yield captured
+        captured.captured_queries = [
+            query for context in contexts for query in context.captured_queries
+            if '"medicine_usershard"' not in query['sql']
+        ]
+
+    @contextmanager
+    def assertNumQueries(self, num):
+        with self.capture_queries() as queries:
+            yield
+        executed = len(queries.captured_queries)
+        self.assertEqual(executed, num, "%d queries executed, %d expected\nCaptured queries were:\n%s" % (
+            executed, num, "\n".join(query['sql'] for query in queries.captured_queries)))
+
+
+class MedicineTestCase(SingleShardMixin, TestCase):
+    pass
+
+
+class MedicineTransactionTestCase(SingleShardMixin, TransactionTestCase):
+    pass
+
+
+class MedicineListViewTests(MedicineTestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('pacient', password='heslo')
+        self.client.force_login(self.user)
+
+    def create_medications(self, count):
+        for i in range(count):
+            medication = Medication.objects.create(
+                user=self.user, name=f"Lék {i}", dosage=2, remaining_quantity=7)
+            Schedule.objects.create(medication=medication, user=self.user, weekdays=0b1)
+
+    def test_query_count_does_not_grow_with_medications(self):
+        self.create_medications(3)
+        with self.assertNumQueries(4):
+            self.client.get(reverse('medication_list'))
+
+        self.create_medications(20)
+        with self.assertNumQueries(4):
+            response = self.client.get(reverse('medication_list'))
+        self.assertEqual(response.context['medications'][0].doses_left, 3)
+        self.assertTrue(response.context['medications'][0].has_schedule)
+
+    def test_cards_are_reused_until_medication_changes(self):
+        self.create_medications(5)
+        self.client.get(reverse('medication_list'))
+        # Všechny karty z cache: plány se vůbec nenačítají
+        with self.assertNumQueries(3):
+            self.client.get(reverse('medication_list'))
+
+        medication = Medication.objects.first()
+        Medication.take_dose(medication.id, self.user)
+        with self.capture_queries() as queries:
+            response = self.client.get(reverse('medication_list'))
+        schedule_queries = [q for q in queries.captured_queries if 'FROM "medicine_schedule"' in q['sql']
+                            and 'EXISTS' not in q['sql']]
+        self.assertEqual(len(schedule_queries), 1)
+        self.assertIn(f'"medication_id" IN ({medication.id})', schedule_queries[0]['sql'])
+        self.assertContains(response, "<strong>Počet zbývajících dávek:</strong> 6")
+        self.assertContains(response, 'name="csrfmiddlewaretoken"', count=16)
+
+    def test_schedule_change_refreshes_card(self):
+        self.create_medications(1)
+        self.client.get(reverse('medication_list'))
+        schedule = Schedule.objects.get()
+        schedule.weekdays, schedule.times = 0b10000, [8 * 60 + 30]
+        schedule.save()
+        self.assertContains(self.client.get(reverse('medication_list')), "Pá v 08:30")
+
+    def test_keyset_pagination(self):
+        self.create_medications(55)
+        response = self.client.get(reverse('medication_list'))
+        first_page = response.context['medications']
+        self.assertEqual(len(first_page), 50)
+
+        cursor = response.context['page_obj'].next_cursor
+        response = self.client.get(reverse('medication_list'), {'after': cursor})
+        second_page = response.context['medications']
+        self.assertEqual(len(second_page), 5)
+        self.assertFalse(response.context['page_obj'].has_next)
+        self.assertGreater(second_page[0].id, first_page[-1].id)
+
+    def test_invalid_cursor(self):
+        response = self.client.get(reverse('medication_list'), {'after': '!!!'})
+        self.assertEqual(response.status_code, 404)
+
+
+class TakeDoseTests(MedicineTestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('pacient', password='heslo')
+        self.medication = Medication.objects.create(user=self.user, name="Ibalgin", remaining_quantity=2)
+        self.client.force_login(self.user)
+
+    def test_take_dose_is_conditional(self):
+        self.assertIsNotNone(Medication.take_dose(self.medication.id, self.user))
+        log = Medication.take_dose(self.medication.id, self.user)
+        self.assertIsNotNone(log)
+        self.assertIsNone(Medication.take_dose(self.medication.id, self.user))
+
+        self.medication.refresh_from_db()
+        self.assertEqual(self.medication.remaining_quantity, 0)
+        self.assertEqual(Log.objects.filter(medication=self.medication).count(), 2)
+        stats = MedicationStatistics.objects.get(medication=self.medication)
+        self.assertEqual(stats.total_doses_taken, 2)
+        # Odečet, Log i statistiky nesou tentýž čas dávky
+        self.assertEqual(self.medication.last_taken, log.created_at)
+        self.assertEqual(stats.last_dose_at, log.created_at)
+
+    def test_take_dose_ignores_foreign_medication(self):
+        other = User.objects.create_user('jiny', password='heslo')
+        self.assertIsNone(Medication.take_dose(self.medication.id, other))
+        response = self.client.post(reverse('mark_as_taken', args=[self.medication.id]))
+        self.assertEqual(response.status_code, 302)
+
+        self.client.force_login(other)
+        response = self.client.post(reverse('mark_as_taken', args=[self.medication.id]))
+        self.assertEqual(response.status_code, 404)
+
+    def test_view_statement_count(self):
+        url = reverse('mark_as_taken', args=[self.medication.id])
+        Medication.take_dose(self.medication.id, self.user)
+        # session + uživatel, savepointy, UPDATE léku, INSERT logu, upsert statistik, zastarání dne dodržování
+        with self.assertNumQueries(8):
+            self.client.post(url)
+
+
+class PartialDoseResponseTests(MedicineTestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('pacient', password='heslo')
+        self.medication = Medication.objects.create(user=self.user, name="Ibalgin", dosage=2, remaining_quantity=5)
+        self.client.force_login(self.user)
+
+    def test_plain_post_redirects(self):
+        response = self.client.post(reverse('mark_as_taken', args=[self.medication.id]))
+        self.assertRedirects(response, reverse('medication_list'))
+
+    def test_json_response(self):
+        response = self.client.post(
+            reverse('mark_as_taken', args=[self.medication.id]), HTTP_ACCEPT='application/json')
+        data = response.json()
+        self.assertEqual(
+            (data['taken'], data['remaining_quantity'], data['remaining_doses']), (True, 4, 2))
+        self.assertIsNotNone(data['last_taken'])
+
+        response = self.client.post(
+            reverse('add_dose', args=[self.medication.id]), {'action': 'increase'}, HTTP_ACCEPT='application/json')
+        self.assertEqual(response.json()['remaining_quantity'], 5)
+
+    def test_fragment_response(self):
+        response = self.client.post(
+            reverse('add_dose', args=[self.medication.id]), {'action': 'decrease'},
+            HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, f'<li id="medication-{self.medication.id}">')
+        self.assertContains(response, "<strong>Počet zbývajících dávek:</strong> 4")
+        self.assertContains(response, 'name="csrfmiddlewaretoken"', count=3)
+
+    def test_add_dose_keeps_concurrent_take_dose(self):
+        stale = Medication.objects.get(id=self.medication.id)
+        Medication.take_dose(self.medication.id, self.user)
+        self.client.post(reverse('add_dose', args=[stale.id]), {'action': 'increase'})
+
+        self.medication.refresh_from_db()
+        self.assertEqual(self.medication.remaining_quantity, 5)
+        change = MedicationChangeHistory.objects.get(medication=self.medication)
+        self.assertEqual((change.field_changed, change.old_value, change.new_value), ('remaining_quantity', '4', '5'))
+
+
+class StatisticsTests(MedicineTestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('pacient', password='heslo')
+        self.medication = Medication.objects.create(user=self.user, name="Ibalgin", remaining_quantity=5)
+
+    def test_edits_do_not_count_as_doses(self):
+        self.medication.remaining_quantity = 10
+        self.medication.save()
+        self.assertFalse(MedicationStatistics.objects.exists())
+
+    def test_average_uses_first_dose(self):
+        first = timezone.now() - timedelta(days=9)
+        statistics.record_doses([(self.medication.id, 5, first, first)])
+        statistics.record_doses([(self.medication.id, 5, timezone.now(), timezone.now())])
+
+        stats = MedicationStatistics.objects.get(medication=self.medication)
+        self.assertEqual(stats.total_doses_taken, 10)
+        self.assertEqual(stats.first_dose_at, first)
+        self.assertEqual(stats.average_doses_per_day, 1)
+
+    def test_rebuild_from_log(self):
+        Medication.take_dose(self.medication.id, self.user)
+        Medication.take_dose(self.medication.id, self.user)
+        MedicationStatistics.objects.update(total_doses_taken=99, first_dose_at=None)
+
+        call_command('rebuild_statistics', stdout=StringIO())
+        stats = MedicationStatistics.objects.get(medication=self.medication)
+        self.assertEqual(stats.total_doses_taken, 2)
+        self.assertEqual(stats.first_dose_at, Log.objects.earliest('created_at').created_at)
+
+
+class IngestDosesTests(MedicineTestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('pacient', password='heslo')
+        self.medication = Medication.objects.create(user=self.user, name="Ibalgin", remaining_quantity=2)
+        self.client.force_login(self.user)
+
+    def post(self, events):
+        return self.client.post(reverse('ingest_doses'), json.dumps(events), content_type='application/json')
+
+    def test_batch_results(self):
+        other = Medication.objects.create(
+            user=User.objects.create_user('jiny', password='heslo'), name="Cizí", remaining_quantity=5)
+        taken_at = timezone.now() - timedelta(hours=3)
+        events = [
+            {'med_id': self.medication.id, 'taken_at': (taken_at + timedelta(minutes=i)).isoformat()}
+            for i in range(3)
+        ] + [
+            {'med_id': other.id, 'taken_at': taken_at.isoformat()},
+            {'med_id': self.medication.id, 'taken_at': 'včera'},
+        ]
+
+        response = self.post(events)
+        self.assertEqual(response.status_code, 200)
+        statuses = [result['status'] for result in response.json()['results']]
+        self.assertEqual(statuses, ['ok', 'ok', 'out_of_stock', 'not_found', 'invalid'])
+
+        self.medication.refresh_from_db()
+        self.assertEqual(self.medication.remaining_quantity, 0)
+        self.assertEqual(self.medication.last_taken, taken_at + timedelta(minutes=1))
+        self.assertEqual(Log.objects.earliest('created_at').created_at, taken_at)
+        self.assertEqual(MedicationStatistics.objects.get(medication=self.medication).total_doses_taken, 2)
+        other.refresh_from_db()
+        self.assertEqual(other.remaining_quantity, 5)
+
+    def test_exhausted_retries_are_json_errors(self):
+        events = [{'med_id': self.medication.id, 'taken_at': timezone.now().isoformat()}]
+        with mock.patch('medicine.ingest._apply', side_effect=ingest._Conflict) as apply:
+            response = self.post(events)
+        self.assertEqual((response.status_code, apply.call_count), (409, ingest.MAX_ATTEMPTS))
+        with mock.patch('medicine.ingest._apply', side_effect=OperationalError("database is locked")):
+            response = self.post(events)
+        self.assertEqual((response.status_code, response['Retry-After']), (503, '1'))
+        self.assertIn('error', response.json())
+
+    def test_rejects_non_list(self):
+        self.assertEqual(self.post({'med_id': 1}).status_code, 400)
+
+
+class DoseDailyRollupTests(MedicineTestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('pacient', password='heslo')
+        self.medication = Medication.objects.create(user=self.user, name="Ibalgin", remaining_quantity=50)
+        self.client.force_login(self.user)
+
+    def log_doses(self, days_ago, count):
+        created_at = timezone.now() - timedelta(days=days_ago)
+        Log.objects.bulk_create(Log(medication=self.medication, created_at=created_at) for _ in range(count))
+
+    def test_incremental_refresh(self):
+        self.log_doses(3, 2)
+        self.log_doses(0, 1)
+        self.assertEqual(rollups.refresh(batch_size=2), 3)
+        self.assertEqual(rollups.refresh(), 0)
+
+        self.log_doses(0, 2)
+        call_command('refresh_rollups', stdout=StringIO())
+
+        doses = dict(DoseDailyRollup.objects.values_list('date', 'doses'))
+        self.assertEqual(doses[timezone.localdate()], 3)
+        self.assertEqual(doses[timezone.localdate() - timedelta(days=3)], 2)
+
+    def test_statistics_chart_reads_rollup(self):
+        cache.clear()
+        self.log_doses(1, 4)
+        rollups.refresh()
+
+        with self.assertNumQueries(5):
+            response = self.client.get(reverse('statistics'))
+        series = response.context['daily_doses']
+        self.assertEqual(len(series), 90)
+        self.assertEqual(series[-2], (timezone.localdate() - timedelta(days=1), 4))
+
+
+class OccurrenceTests(MedicineTestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('pacient', password='heslo')
+        self.medication = Medication.objects.create(user=self.user, name="Ibalgin")
+
+    def schedule(self, day, hour, minute):
+        days = [name for name, _ in Schedule.DAY_OF_WEEK]
+        return Schedule.objects.create(
+            medication=self.medication, user=self.user,
+            weekdays=Schedule.EVERY_DAY if day is None else 1 << days.index(day), times=[hour * 60 + minute])
+
+    def test_window_wraps_across_week_boundary(self):
+        sunday = self.schedule('Sunday', 23, 55)
+        monday = self.schedule('Monday', 0, 5)
+        daily = self.schedule(None, 0, 0)
+        self.schedule('Tuesday', 0, 5)
+        self.schedule('Sunday', 23, 40)
+
+        start = timezone.make_aware(datetime(2025, 3, 9, 23, 50))  # neděle
+        due = occurrences.due_between(start, start + timedelta(minutes=20))
+        self.assertEqual(
+            [(occurs_at.strftime('%a %H:%M'), schedule) for occurs_at, schedule in due],
+            [('Sun 23:55', sunday), ('Mon 00:00', daily), ('Mon 00:05', monday)],
+        )
+
+    def test_next_occurrences(self):
+        self.schedule('Wednesday', 8, 0)
+        self.schedule(None, 20, 0)
+        after = timezone.make_aware(datetime(2025, 3, 11, 21, 0))  # úterý
+
+        upcoming = occurrences.next_occurrences(self.medication, 3, after=after)
+        self.assertEqual(
+            [occurs_at.strftime('%a %H:%M') for occurs_at, _ in upcoming],
+            ['Wed 08:00', 'Wed 20:00', 'Thu 20:00'],
+        )
+
+    def test_expand_intervals_weekdays_and_date_range(self):
+        week_start = datetime(2025, 3, 10)  # pondělí
+        every_8_hours = (Schedule.EVERY_DAY, [6 * 60], 8, date(2025, 3, 11), None)
+        self.assertEqual(
+            occurrences.expand(every_8_hours, week_start, 0, 2 * 24 * 60).tolist(),
+            [24 * 60 + 6 * 60, 24 * 60 + 14 * 60, 24 * 60 + 22 * 60])
+        # Pondělí a středa v 08:00 a 20:00, jen do úterý příštího týdne
+        twice = (0b101, [8 * 60, 20 * 60], None, None, date(2025, 3, 18))
+        self.assertEqual(
+            [minute // 60 for minute in occurrences.expand(twice, week_start, 0, 14 * 24 * 60).tolist()],
+            [8, 20, 56, 68, 176, 188])
+
+    def test_slots_repeat_expansion(self):
+        # Pět týdnů od pondělí pokryje celý cyklus i pro interval 5 h (nejmenší společný násobek s týdnem)
+        week_start = datetime(2025, 3, 10)
+        offset = (week_start.date() - occurrences.INTERVAL_EPOCH).days * 24 * 60
+        for recurrence in [
+            (0b101, [8 * 60, 20 * 60], None, None, None),
+            (Schedule.EVERY_DAY, [6 * 60], 8, None, None),
+            (0b1111100, [7 * 60 + 30], 5, date(2025, 2, 26), None),
+        ]:
+            cycle, minutes = occurrences.slots(recurrence)
+            expanded = occurrences.expand(recurrence, week_start, 0, cycle) + offset
+            self.assertEqual(sorted(set((expanded % cycle).tolist())), minutes)
+
+    def test_due_schedules_found_through_slot_index(self):
+        every_5_hours = Schedule.objects.create(
+            medication=self.medication, times=[60], interval_hours=5, start_date=date(2025, 3, 10))
+        self.schedule(None, 8, 0)
+        start = timezone.make_aware(datetime(2025, 3, 12, 12, 55))  # od pondělí 01:00 po 5 h vychází středa 13:00
+        due = occurrences.due_between(start, start + timedelta(minutes=10))
+        self.assertEqual([(occurs_at.strftime('%H:%M'), schedule) for occurs_at, schedule in due],
+                         [('13:00', every_5_hours)])
+
+        every_5_hours.interval_hours = 7
+        every_5_hours.save()
+        self.assertEqual(occurrences.due_between(start, start + timedelta(minutes=10)), [])
+        plan = Schedule.objects.filter(occurrences.due_filter(start, start + timedelta(minutes=10))).explain()
+        self.assertIn('schedule_slot_minute_idx', plan)
+
+    def test_compact_slots_merge_rows_with_same_days(self):
+        # Tři denní časy zapsané starým způsobem pro každý den zvlášť: 21 řádků
+        slots = [(day, minute) for day in range(7) for minute in (8 * 60, 14 * 60, 20 * 60)]
+        self.assertEqual(occurrences.compact_slots(slots + [(0, 22 * 60)]),
+                         [(0b1, [22 * 60]), (Schedule.EVERY_DAY, [8 * 60, 14 * 60, 20 * 60])])
+
+    def test_create_view_saves_compact_schedule(self):
+        self.client.force_login(self.user)
+        self.client.post(reverse('medication_add'), {
+            'name': "Paralen", 'dosage': 1, 'remaining_quantity': 20,
+            'weekdays': ['Monday', 'Friday'], 'times': "20:00, 08:00", 'start_date': '2025-03-10',
+        })
+        schedule = Schedule.objects.get(medication__name="Paralen")
+        self.assertEqual((schedule.weekdays, schedule.times), (0b10001, [8 * 60, 20 * 60]))
+        self.assertEqual(schedule.describe(), "Po, Pá v 08:00, 20:00 od 10. 3. 2025")
+
+
+class StatisticsCacheTests(MedicineTestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('pacient', password='heslo')
+        self.medication = Medication.objects.create(user=self.user, name="Ibalgin", remaining_quantity=5)
+        self.client.force_login(self.user)
+        self.url = reverse('statistics')
+
+    def take_dose(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            Medication.take_dose(self.medication.id, self.user)
+
+    def test_served_from_cache_until_dose(self):
+        self.take_dose()
+        with self.assertNumQueries(5):
+            self.client.get(self.url)
+        # Jen session a uživatel
+        with self.assertNumQueries(2):
+            response = self.client.get(self.url)
+        self.assertEqual(response.context['stats'][0].total_doses_taken, 1)
+
+        self.take_dose()
+        response = self.client.get(self.url)
+        self.assertEqual(response.context['stats'][0].total_doses_taken, 2)
+
+    def test_medication_edit_invalidates(self):
+        self.take_dose()
+        self.client.get(self.url)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.medication.name = "Ibalgin 400"
+            self.medication.save()
+        self.assertContains(self.client.get(self.url), "Ibalgin 400")
+
+
+class ChangeHistoryTests(MedicineTestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('pacient', password='heslo')
+        self.medication = Medication.objects.create(user=self.user, name="Ibalgin", dosage=1, remaining_quantity=5)
+        self.client.force_login(self.user)
+
+    def test_update_view_writes_one_insert(self):
+        url = reverse('medication_update', args=[self.medication.id])
+        data = {'name': "Ibalgin 400", 'dosage': 2, 'notes': "po jídle", 'remaining_quantity': 5}
+        with self.capture_queries() as queries:
+            self.client.post(url, data)
+        inserts = [q['sql'] for q in queries.captured_queries if 'INSERT INTO "medicine_medicationchangehistory"' in q['sql']]
+        self.assertEqual(len(inserts), 1)
+
+        changes = {change.field_changed: (change.old_value, change.new_value)
+                   for change in MedicationChangeHistory.objects.filter(medication=self.medication)}
+        self.assertEqual(changes, {
+            'name': ("Ibalgin", "Ibalgin 400"),
+            'dosage': ("1", "2"),
+            'notes': ("None", "po jídle"),
+        })
+
+    def test_function_update_view_is_scoped_to_owner(self):
+        other = User.objects.create_user('jiny', password='heslo')
+        request = RequestFactory().post('/', {'name': "Cizí", 'dosage': 1, 'remaining_quantity': 5})
+        request.user = other
+        with self.assertRaises(Http404):
+            views.update_medication(request, self.medication.id)
+        self.assertFalse(MedicationChangeHistory.objects.filter(medication=self.medication).exists())
+
+    def test_schedule_changes_are_tracked(self):
+        schedule = Schedule.objects.create(medication=self.medication, weekdays=0b1, times=[8 * 60])
+        schedule = Schedule.objects.get(id=schedule.id)
+        schedule.times.append(20 * 60)
+        schedule.save()
+
+        change = MedicationChangeHistory.objects.get(medication=self.medication)
+        self.assertEqual((change.field_changed, change.user), ('schedule.times', self.user))
+        self.assertEqual((change.old_value, change.new_value), ('[480]', '[480, 1200]'))
+
+    def test_unchanged_save_writes_nothing(self):
+        Medication.objects.get(id=self.medication.id).save()
+        self.assertFalse(MedicationChangeHistory.objects.exists())
+
+    def test_dose_paths_record_only_log(self):
+        # Užití dávky je v Logu u jednotlivé i hromadné cesty, historie zásoby zůstane prázdná
+        events = [{'med_id': self.medication.id, 'taken_at': timezone.now().isoformat()}] * 2
+        self.client.post(reverse('ingest_doses'), json.dumps(events), content_type='application/json')
+        Medication.take_dose(self.medication.id, self.user)
+
+        self.medication.refresh_from_db()
+        self.assertEqual(self.medication.remaining_quantity, 2)
+        self.assertEqual(Log.objects.filter(medication=self.medication).count(), 3)
+        self.assertFalse(MedicationChangeHistory.objects.filter(medication=self.medication).exists())
+
+
+class MedicationHistoryViewTests(MedicineTestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('pacient', password='heslo')
+        self.medication = Medication.objects.create(user=self.user, name="Ibalgin")
+        self.client.force_login(self.user)
+        self.url = reverse('medication_history', args=[self.medication.id])
+
+    def record(self, count, field='dosage', days_ago=0):
+        MedicationChangeHistory.objects.bulk_create(
+            MedicationChangeHistory(
+                medication=self.medication, user=self.user, field_changed=field,
+                old_value=str(i), new_value=str(i + 1),
+            )
+            for i in range(count)
+        )
+        MedicationChangeHistory.objects.filter(field_changed=field).update(
+            change_date=timezone.now() - timedelta(days=days_ago))
+
+    def test_pages_without_n_plus_one(self):
+        self.record(60)
+        with self.assertNumQueries(5):
+            response = self.client.get(self.url)
+        self.assertEqual(len(response.context['changes']), 50)
+
+        response = self.client.get(f"{self.url}?{response.context['next_query']}")
+        self.assertEqual(len(response.context['changes']), 10)
+        self.assertIsNone(response.context['next_query'])
+
+    def test_filters(self):
+        self.record(3, field='notes')
+        self.record(2, field='dosage', days_ago=10)
+        self.assertEqual(len(self.client.get(self.url, {'field': 'notes'}).context['changes']), 3)
+
+        since = (timezone.localdate() - timedelta(days=11)).isoformat()
+        until = (timezone.localdate() - timedelta(days=9)).isoformat()
+        response = self.client.get(self.url, {'since': since, 'until': until})
+        self.assertEqual([change.field_changed for change in response.context['changes']], ['dosage'] * 2)
+
+    def test_foreign_medication_is_hidden(self):
+        self.client.force_login(User.objects.create_user('jiny', password='heslo'))
+        self.assertEqual(self.client.get(self.url).status_code, 404)
+
+
+class ExportTests(MedicineTestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('pacient', password='heslo')
+        self.medication = Medication.objects.create(user=self.user, name="Paralen")
+        other = Medication.objects.create(user=self.user, name="Ibalgin")
+        stranger = Medication.objects.create(user=User.objects.create_user('cizi'), name="Cizí")
+        now = timezone.now()
+        Log.objects.bulk_create(
+            [Log(medication=self.medication, created_at=now - timedelta(days=days)) for days in range(5)]
+            + [Log(medication=other, created_at=now), Log(medication=stranger, created_at=now)]
+        )
+        self.client.force_login(self.user)
+
+    def test_csv_with_filters(self):
+        since = timezone.localdate() - timedelta(days=2)
+        response = self.client.get(reverse('export', args=['doses']), {
+            'medication': self.medication.id, 'since': since.isoformat(),
+        })
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Type'], 'text/csv; charset=utf-8')
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual(lines[0], 'id,medication_id,medication,taken_at')
+        self.assertEqual(len(lines), 4)
+        self.assertTrue(all(',Paralen,' in line for line in lines[1:]))
+
+    def test_gzip_jsonl_in_batches(self):
+        queryset = export.export_queryset('doses', self.user)
+        data = gzip.decompress(b''.join(export.stream('doses', queryset, 'jsonl', compress=True, batch_size=2)))
+        rows = [json.loads(line) for line in data.decode().splitlines()]
+        self.assertEqual(len(rows), 6)
+        self.assertEqual({row['medication'] for row in rows}, {"Paralen", "Ibalgin"})
+
+    def test_command_writes_changes(self):
+        changed_by(self.medication, self.user).dosage = 2
+        self.medication.save()
+        with tempfile.NamedTemporaryFile(suffix='.csv') as output:
+            call_command('export_history', 'pacient', 'changes', output=output.name)
+            lines = Path(output.name).read_text().splitlines()
+        self.assertEqual(lines[0], 'id,medication_id,medication,changed_by,field,old_value,new_value,changed_at')
+        self.assertIn('pacient,dosage,1,2', lines[1])
+
+    def test_unknown_kind_and_format(self):
+        self.assertEqual(self.client.get(reverse('export', args=['ostatni'])).status_code, 404)
+        self.assertEqual(self.client.get(reverse('export', args=['doses']), {'format': 'xml'}).status_code, 400)
+
+
+class ForecastTests(MedicineTestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('pacient', password='heslo')
+
+    def test_project_columns(self):
+        rate, days = forecasting.project(
+            remaining=np.array([20, 20, 20, 20]), dosage=np.array([1, 2, 1, 1]),
+            weekly=np.array([14, 14, 0, 0]), recent=np.array([0, 0, 112, 0]), window_days=28,
+        )
+        self.assertEqual(rate.tolist(), [2, 2, 4, 0])
+        self.assertEqual(days.tolist(), [10, 5, 5, np.inf])
+
+    def test_command_stores_forecasts(self):
+        daily = Medication.objects.create(user=self.user, name="Paralen", remaining_quantity=10)
+        Schedule.objects.create(medication=daily, times=[8 * 60, 20 * 60])
+        weekly = Medication.objects.create(user=self.user, name="Vigantol", remaining_quantity=10)
+        Schedule.objects.create(medication=weekly, weekdays=0b1, times=[8 * 60])
+        # Ukončený plán se do tempa nepočítá
+        Schedule.objects.create(medication=weekly, times=[8 * 60], end_date=timezone.localdate() - timedelta(days=1))
+        unused = Medication.objects.create(user=self.user, name="Ibalgin", remaining_quantity=10)
+
+        call_command('forecast_run_out', batch_size=2, stdout=StringIO())
+
+        today = timezone.localdate()
+        forecasts = {forecast.medication_id: forecast for forecast in RunOutForecast.objects.all()}
+        self.assertEqual(forecasts[daily.id].run_out_date, today + timedelta(days=5))
+        self.assertEqual(forecasts[weekly.id].run_out_date, today + timedelta(days=70))
+        self.assertIsNone(forecasts[unused.id].run_out_date)
+        self.assertEqual([forecast.medication for forecast in forecasting.running_out(self.user, 14)], [daily])
+
+        self.client.force_login(self.user)
+        self.assertContains(self.client.get(reverse('statistics')), "Brzy dojdou")
+
+
+class AdherenceTests(MedicineTestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('pacient', password='heslo')
+        self.medication = Medication.objects.create(user=self.user, name="Paralen", remaining_quantity=10)
+        Schedule.objects.create(medication=self.medication, times=[8 * 60])
+        self.today = timezone.localdate()
+
+    def at(self, days_ago, hour, minute=0):
+        day = self.today - timedelta(days=days_ago)
+        return timezone.make_aware(datetime.combine(day, time(hour, minute)))
+
+    def test_match_uses_each_dose_once(self):
+        status = adherence.match(np.array([0, 60, 720]), np.array([50, 900]), on_time=30, late=180)
+        self.assertEqual(status.tolist(), [adherence.MISSED, adherence.TAKEN, adherence.LATE])
+
+    def test_daily_counts_are_cached_and_invalidated(self):
+        Log.objects.bulk_create([
+            Log(medication=self.medication, created_at=self.at(3, 8, 10)),
+            Log(medication=self.medication, created_at=self.at(2, 10)),
+        ])
+        since, until = self.today - timedelta(days=4), self.today - timedelta(days=2)
+        rows = adherence.daily([self.medication.id], since, until)
+        self.assertEqual(
+            [(row['taken'], row['late'], row['missed']) for row in rows], [(0, 0, 1), (1, 0, 0), (0, 1, 0)])
+        self.assertEqual(AdherenceDaily.objects.count(), 3)
+
+        # Horizont archivu, kontrola úplnosti a čtení uložených dnů
+        with self.assertNumQueries(3):
+            adherence.daily([self.medication.id], since, until)
+
+        ingest_dose_events(self.user, [{'med_id': self.medication.id, 'taken_at': self.at(4, 8, 5).isoformat()}])
+        self.assertTrue(AdherenceDaily.objects.get(date=since).stale)
+        rows = adherence.daily([self.medication.id], since, until)
+        self.assertEqual(adherence.summarize(rows)['rate'], 1)
+
+    def test_days_before_horizon_are_not_missing(self):
+        since, until = self.today - timedelta(days=6), self.today - timedelta(days=2)
+        # Před horizontem lék žádné uložené dny nemá a z Logu se už dopočítat nedají
+        Checkpoint.objects.create(name=retention.CHECKPOINT, position=(since + timedelta(days=3)).toordinal())
+        rows = adherence.daily([self.medication.id], since, until)
+        self.assertEqual([row['date'] for row in rows], [since + timedelta(days=3), until])
+        with self.assertNumQueries(3):
+            adherence.daily([self.medication.id], since, until)
+
+    def test_report_view(self):
+        self.client.force_login(self.user)
+        response = self.client.get(reverse('adherence'), {
+            'since': (self.today - timedelta(days=6)).isoformat(), 'until': self.today.isoformat()})
+        data = response.json()
+        self.assertEqual(data['medications'][0]['name'], "Paralen")
+        self.assertEqual(len(data['medications'][0]['days']), 7)
+        self.assertGreaterEqual(data['totals']['missed'], 5)
+        self.assertEqual(self.client.get(reverse('adherence'), {'since': '2000-01-01'}).status_code, 400)
+
+
+class ClinicianDashboardTests(MedicineTestCase):
+    def setUp(self):
+        self.clinician = User.objects.create_user('lekar', password='heslo')
+        self.today = timezone.localdate()
+
+    def add_patient(self, username, remaining_quantity=10, take_dose=False):
+        patient = User.objects.create_user(username, password='heslo')
+        CareRelationship.objects.create(clinician=self.clinician, patient=patient)
+        medication = Medication.objects.create(
+            user=patient, name="Paralen", remaining_quantity=remaining_quantity, refill_threshold=3)
+        if take_dose:
+            Medication.take_dose(medication.id, patient)
+        return patient, medication
+
+    def test_summary_and_urgency(self):
+        self.add_patient('klidny', take_dose=True)
+        self.add_patient('dochazi', remaining_quantity=2, take_dose=True)
+        _, medication = self.add_patient('vynechava')
+        # Plán o půlnoci a v šest: v jednu ráno mají oba výskyty okno pro pozdní dávku otevřené, v poledne ne
+        Schedule.objects.create(medication=medication, times=[0, 6 * 60])
+        MedicationChangeHistory.record_change(medication, self.clinician, 'dosage', 1, 2)
+        early = timezone.make_aware(datetime.combine(self.today, time(1)))
+        noon = timezone.make_aware(datetime.combine(self.today, time(12)))
+
+        self.assertEqual([row.missed_today for row in dashboard.summarize(self.clinician, now=early)], [0, 0, 0])
+        rows = dashboard.summarize(self.clinician, now=noon)
+        self.assertEqual([row.username for row in rows], ['vynechava', 'dochazi', 'klidny'])
+        summaries = {row.username: row for row in rows}
+        self.assertEqual(summaries['vynechava'].missed_today, 2)
+        self.assertEqual(summaries['dochazi'].low_stock, 1)
+        self.assertEqual(summaries['vynechava'].changes, 1)
+        self.assertIsNone(summaries['vynechava'].last_dose_at)
+        self.assertEqual([row.username for row in dashboard.summarize(self.clinician, 'name', now=noon)],
+                         ['dochazi', 'klidny', 'vynechava'])
+
+        # Dávka mimo okna výskytů nic nevynahradí, dávka v okně vynahradí právě jeden výskyt
+        Log.objects.create(medication=medication, created_at=noon - timedelta(hours=1))
+        self.assertEqual(dashboard.summarize(self.clinician, now=noon)[0].missed_today, 2)
+        Log.objects.create(medication=medication, created_at=noon - timedelta(hours=5, minutes=50))
+        self.assertEqual(dashboard.summarize(self.clinician, now=noon)[0].missed_today, 1)
+        self.assertEqual(
+            adherence.compute([medication.id], self.today, self.today, now=noon)[0]['missed'], 1)
+
+    def test_queries_do_not_grow_with_patients(self):
+        self.add_patient('prvni', take_dose=True)
+        # Vazby, léky bez platného dnešního řádku, jejich dodržování plánu a jeden seřazený dotaz
+        with self.assertNumQueries(9):
+            dashboard.summarize(self.clinician)
+        with self.assertNumQueries(3):
+            dashboard.summarize(self.clinician)
+        for index in range(5):
+            self.add_patient(f'dalsi{index}', remaining_quantity=index)
+        with self.assertNumQueries(9):
+            self.assertEqual(len(dashboard.summarize(self.clinician)), 6)
+
+    def test_page_is_sliced_in_query(self):
+        for index in range(5):
+            self.add_patient(f'pacient{index}', remaining_quantity=index)
+        patients = dashboard.SupervisedPatients(self.clinician, 'last_dose')
+        self.assertEqual(len(patients), 5)
+        with self.capture_queries() as queries:
+            page = patients[1:3]
+        self.assertEqual(page, dashboard.summarize(self.clinician, 'last_dose', now=patients.now)[1:3])
+        self.assertIn('LIMIT 3', queries.captured_queries[-1]['sql'])
+
+    def test_view_sorts_and_rejects_unknown_sort(self):
+        for index in range(3):
+            self.add_patient(f'pacient{index}')
+        self.client.force_login(self.clinician)
+        response = self.client.get(reverse('clinician_dashboard'), {'sort': 'name'})
+        self.assertContains(response, 'pacient2')
+        self.assertEqual(self.client.get(reverse('clinician_dashboard'), {'sort': 'x'}).status_code, 400)
+
+        self.client.force_login(User.objects.get(username='pacient0'))
+        self.assertContains(self.client.get(reverse('clinician_dashboard')), "Nesledujete žádné pacienty.")
+
+
+class RefillAlertTests(MedicineTestCase):
+    class Sink:
+        def __init__(self):
+            self.alerts = []
+
+        def send(self, alerts):
+            self.alerts.extend(alerts)
+
+    def setUp(self):
+        self.user = User.objects.create_user('pacient', password='heslo')
+        self.medication = Medication.objects.create(
+            user=self.user, name="Paralen", dosage=2, remaining_quantity=6, refill_threshold=2)
+        Medication.objects.create(user=self.user, name="Bez prahu", remaining_quantity=0)
+        self.client.force_login(self.user)
+
+    def send(self):
+        sink = self.Sink()
+        refills.send_alerts(sink, batch_size=1)
+        return [alert.medication_id for alert in sink.alerts]
+
+    def test_alert_once_per_crossing(self):
+        self.assertEqual(self.send(), [])
+        for _ in range(3):
+            Medication.take_dose(self.medication.id, self.user)
+        self.assertEqual(self.send(), [self.medication.id])
+        # Další dávky pod prahem už nic neposílají
+        Medication.take_dose(self.medication.id, self.user)
+        self.assertEqual(self.send(), [])
+
+        url = reverse('add_dose', args=[self.medication.id])
+        for _ in range(2):
+            self.client.post(url, {'action': 'increase'})
+        self.medication.refresh_from_db()
+        self.assertIsNone(self.medication.refill_alerted_at)
+        self.client.post(url, {'action': 'decrease'})
+        self.assertEqual(self.send(), [self.medication.id])
+
+    def test_due_query_uses_partial_index(self):
+        queryset = refills.due().filter(id__gt=0).order_by('id')
+        self.assertIn('medication_refill_due_idx', queryset.explain())
+
+
+class RetentionTests(MedicineTestCase):
+    def setUp(self):
+        self.archive_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.archive_dir.cleanup)
+        override = override_settings(MEDICINE_ARCHIVE_DIR=Path(self.archive_dir.name))
+        override.enable()
+        self.addCleanup(override.disable)
+
+        self.user = User.objects.create_user('pacient', password='heslo')
+        self.medication = Medication.objects.create(user=self.user, name="Paralen")
+        self.old = timezone.now() - timedelta(days=100)
+        Log.objects.bulk_create(
+            [Log(medication=self.medication, created_at=self.old + timedelta(minutes=i)) for i in range(3)]
+            + [Log(medication=self.medication, created_at=timezone.now())]
+        )
+        changed_by(self.medication, self.user).dosage = 2
+        self.medication.save()
+        MedicationChangeHistory.objects.update(change_date=self.old)
+        self.client.force_login(self.user)
+
+    def test_archives_old_rows_and_keeps_totals(self):
+        Medication.objects.create(user=self.user, name="Ibalgin")
+        call_command('archive_logs', days=30, batch_size=2, stdout=StringIO())
+
+        # Dodržování plánu se uloží jen pro archivovaný lék a dny jeho dávek se sousedními
+        old_day = timezone.localdate(self.old)
+        self.assertEqual(
+            set(AdherenceDaily.objects.values_list('medication_id', 'date')),
+            {(self.medication.id, old_day + timedelta(days=offset)) for offset in (-1, 0, 1)},
+        )
+
+        self.assertEqual(Log.objects.count(), 1)
+        self.assertFalse(MedicationChangeHistory.objects.exists())
+        self.assertTrue(retention.archive_path('doses', self.user.id, timezone.localdate(self.old)).exists())
+        self.assertEqual(ChangeDailyRollup.objects.get().changes, 1)
+        self.assertEqual(retention.horizon(), timezone.localdate() - timedelta(days=30))
+
+        statistics.rebuild()
+        stats = MedicationStatistics.objects.get(medication=self.medication)
+        self.assertEqual(stats.total_doses_taken, 4)
+        self.assertEqual(timezone.localdate(stats.first_dose_at), timezone.localdate(self.old))
+
+    def test_export_reads_archive_on_demand(self):
+        retention.archive(days=30)
+        # Opakovaný zápis po přerušeném běhu se při čtení přeskočí
+        retention._write('doses', [{
+            'id': Log.objects.get().id - 1, 'medication_id': self.medication.id, 'medication': "Paralen",
+            'taken_at': self.old, 'user_id': self.user.id, 'shard': sharding.current_alias(),
+        }])
+
+        url = reverse('export', args=['doses'])
+        live = b''.join(self.client.get(url).streaming_content).decode().splitlines()
+        self.assertEqual(len(live), 2)
+        lines = b''.join(self.client.get(url, {'archive': '1'}).streaming_content).decode().splitlines()
+        self.assertEqual(len(lines), 5)
+        self.assertTrue(lines[1].endswith(self.old.isoformat()))
+
+        # Archiv je rozdělený podle uživatelů, cizí soubory se vůbec neotevřou
+        other = User.objects.create_user('jiny')
+        with mock.patch('medicine.retention.gzip.open') as opened:
+            self.assertEqual(list(retention.read('doses', other.id)), [])
+        opened.assert_not_called()
+
+
+class ImportTests(MedicineTestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('pacient', password='heslo')
+        self.client.force_login(self.user)
+
+    def test_csv_upload_reports_bad_rows(self):
+        upload = SimpleUploadedFile('leky.csv', (
+            "name,dosage,notes,remaining_quantity,schedules\n"
+            "Paralen,1,,20,Monday 08:00; 20:00\n"
+            "Ibalgin,abc,,10,\n"
+            "Zyrtec,1,na noc,30,Pátek 08:00\n"
+            "Euthyrox,1,,30,\n"
+        ).encode(), content_type='text/csv')
+        response = self.client.post(reverse('medication_import'), {'file': upload}, HTTP_ACCEPT='application/json')
+
+        result = response.json()
+        self.assertEqual((result['medications'], result['schedules']), (2, 2))
+        self.assertEqual([row['line'] for row in result['errors']], [3, 4])
+        self.assertIn('dosage', result['errors'][0]['errors'])
+        self.assertIn('schedules[0]', result['errors'][1]['errors'])
+
+        paralen = Medication.objects.get(user=self.user, name="Paralen")
+        self.assertEqual(
+            list(paralen.schedule_set.order_by('weekdays').values_list('weekdays', 'times')),
+            [(0b1, [8 * 60]), (Schedule.EVERY_DAY, [20 * 60])],
+        )
+        self.assertFalse(MedicationStatistics.objects.filter(user=self.user).exists())
+
+    def test_batch_is_constant_number_of_queries(self):
+        lines = [json.dumps({'name': f"Lék {i}", 'dosage': 1, 'remaining_quantity': 10,
+                             'schedules': [{'day_of_week': 'Monday', 'time': '08:00'}]}) for i in range(50)]
+        # Úložný bod, tři hromadné INSERT (léky, plány, sloty plánů) a uvolnění úložného bodu
+        with self.assertNumQueries(5):
+            result = importer.import_medications(self.user, lines + ['{neplatné'], 'jsonl', batch_size=100)
+        self.assertEqual(result['medications'], 50)
+        self.assertEqual(result['errors'][0]['line'], 51)
+
+
+class ReadReplicaRouterTests(MedicineTestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('pacient', password='heslo')
+        self.factory = RequestFactory()
+        self.cookies = {}
+
+    def read_alias(self, method, write=None):
+        # Uživatelé jsou vždy v hlavní databázi, data léků mohou být ve shardech
+        aliases = []
+
+        def view(request):
+            aliases.append(router.db_for_read(User))
+            if write:
+                with sharding.use_shard('shard_1'):
+                    aliases.append(router.db_for_write(write))
+                aliases.append(router.db_for_read(User))
+            return HttpResponse()
+
+        request = getattr(self.factory, method)('/')
+        request.user = self.user
+        request.COOKIES.update(self.cookies)
+        response = ReadReplicaMiddleware(view)(request)
+        self.cookies.update({name: morsel.value for name, morsel in response.cookies.items()})
+        return aliases
+
+    @override_settings(READ_REPLICAS=['replica_1'])
+    def test_safe_reads_use_replica(self):
+        self.assertEqual(self.read_alias('get'), ['replica_1'])
+        self.assertEqual(router.db_for_read(User), 'default')
+
+    @override_settings(READ_REPLICAS=['replica_1'])
+    def test_reads_after_write_stick_to_primary(self):
+        self.assertEqual(self.read_alias('post'), ['default'])
+        self.assertEqual(self.read_alias('get', write=User), ['replica_1', 'default', 'default'])
+        # Po zápisu čte uživatel z hlavní databáze po dobu READ_AFTER_WRITE_WINDOW
+        self.assertEqual(self.read_alias('get'), ['default'])
+
+        # Cookie jiného uživatele ani prošlá cookie nepřipíná
+        self.user = User.objects.create_user('jiny', password='heslo')
+        self.assertEqual(self.read_alias('get'), ['replica_1'])
+        self.user = User.objects.get(username='pacient')
+        with override_settings(READ_AFTER_WRITE_WINDOW=10), mock.patch('django.core.signing.time') as clock:
+            clock.time.return_value = datetime.now().timestamp() + 11
+            self.assertEqual(self.read_alias('get'), ['replica_1'])
+
+
+    @override_settings(READ_REPLICAS=['replica_1'], SHARDS=['shard_1'])
+    def test_shard_write_pins_to_primary(self):
+        # Zápis léku rozhodne ShardRouter, připnout musí i tak
+        self.assertEqual(self.read_alias('get', write=Medication), ['replica_1', 'shard_1', 'default'])
+        self.assertEqual(self.read_alias('get'), ['default'])
+
+
+@skipUnless(len(settings.SHARDS) >= 2, "Spouští se s MEDICATION_SHARDS se dvěma a více shardy.")
+class ShardingTests(TestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('pacient', password='heslo')
+        self.source = sharding.shard_for_user(self.user.pk)
+        self.target = next(alias for alias in settings.SHARDS if alias != self.source)
+
+    def test_user_data_lives_in_user_shard(self):
+        with sharding.for_user(self.user):
+            medication = Medication.objects.create(user=self.user, name="Paralen", remaining_quantity=3)
+        Medication.take_dose(medication.id, self.user)
+
+        self.assertEqual(medication._state.db, self.source)
+        self.assertFalse(Medication.objects.using(self.target).exists())
+        self.assertEqual(Log.objects.using(self.source).count(), 1)
+
+        self.client.force_login(self.user)
+        self.assertContains(self.client.get(reverse('medication_list')), "Paralen")
+
+    def test_move_user(self):
+        with sharding.for_user(self.user):
+            medication = Medication.objects.create(user=self.user, name="Paralen", remaining_quantity=3)
+            Schedule.objects.create(medication=medication, times=[8 * 60])
+            RunOutForecast.objects.create(medication=medication, user=self.user, doses_per_day=1,
+                                          updated_at=timezone.now())
+        for _ in range(2):
+            Medication.take_dose(medication.id, self.user)
+
+        call_command('move_user_shard', self.user.pk, self.target, batch_size=1, stdout=StringIO())
+
+        self.assertEqual(sharding.shard_for_user(self.user.pk), self.target)
+        self.assertFalse(Medication.objects.using(self.source).exists())
+        self.assertFalse(Log.objects.using(self.source).exists())
+        self.assertFalse(RunOutForecast.objects.using(self.source).exists())
+        with sharding.for_user(self.user):
+            moved = Medication.objects.get(user=self.user)
+            self.assertEqual(moved.remaining_quantity, 1)
+            self.assertEqual(moved.schedule_set.count(), 1)
+            self.assertEqual(moved.log_set.count(), 2)
+            self.assertEqual(MedicationStatistics.objects.get(medication=moved).total_doses_taken, 2)
+            self.assertEqual(DoseDailyRollup.objects.get(medication=moved).doses, 2)
+            self.assertEqual(RunOutForecast.objects.get(medication=moved).doses_per_day, 1)
+
+    def test_move_user_keeps_archived_rollups(self):
+        with sharding.for_user(self.user):
+            medication = Medication.objects.create(user=self.user, name="Paralen", remaining_quantity=3)
+            Log.objects.create(medication=medication, created_at=timezone.now() - timedelta(days=100))
+        Medication.take_dose(medication.id, self.user)
+        with tempfile.TemporaryDirectory() as archive_dir, override_settings(MEDICINE_ARCHIVE_DIR=Path(archive_dir)):
+            with sharding.use_shard(self.source):
+                retention.archive(days=30)
+
+        sharding.move_user(self.user.pk, self.target)
+
+        with sharding.use_shard(self.target):
+            statistics.rebuild()
+            moved = Medication.objects.get(user=self.user)
+            self.assertEqual(moved.log_set.count(), 1)
+            self.assertEqual(sum(DoseDailyRollup.objects.filter(medication=moved).values_list('doses', flat=True)), 2)
+            self.assertEqual(MedicationStatistics.objects.get(medication=moved).total_doses_taken, 2)
+
+    def test_dashboard_spans_shards(self):
+        clinician = User.objects.create_user('lekar', password='heslo')
+        other = User.objects.create_user('druhy', password='heslo')
+        sharding.move_user(other.pk, self.target)
+        for patient in (self.user, other):
+            CareRelationship.objects.create(clinician=clinician, patient=patient)
+            with sharding.for_user(patient):
+                Medication.objects.create(user=patient, name="Paralen", remaining_quantity=0)
+
+        rows = dashboard.summarize(clinician, 'name')
+        self.assertEqual([(row.username, row.out_of_stock) for row in rows], [('druhy', 1), ('pacient', 1)])
+
+
+class PerformanceMiddlewareTests(MedicineTestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('pacient', password='heslo')
+        self.client.force_login(self.user)
+
+    @override_settings(MEDICINE_PERF_INSTRUMENTATION=True, MEDICINE_PERF_QUERY_BUDGET=100)
+    def test_server_timing_and_log_line(self):
+        Medication.objects.create(user=self.user, name="Paralen")
+        with self.assertLogs('medicine.perf', 'INFO') as logs:
+            response = self.client.get(reverse('medication_list'))
+        self.assertRegex(response['Server-Timing'], r'^db;desc="SQL \(\d+\)";dur=[\d.]+, tpl;dur=[\d.]+, total;dur=')
+
+        record = json.loads(logs.records[0].getMessage())
+        self.assertEqual(logs.records[0].levelname, 'INFO')
+        self.assertEqual(record['view'], 'medication_list')
+        self.assertGreater(record['queries'], 0)
+        self.assertGreater(record['template_ms'], 0)
+
+    @override_settings(MEDICINE_PERF_INSTRUMENTATION=True, MEDICINE_PERF_QUERY_BUDGET=100)
+    def test_streamed_body_is_measured(self):
+        Medication.objects.create(user=self.user, name="Paralen")
+        with self.assertLogs('medicine.perf', 'INFO') as logs:
+            response = self.client.get(reverse('export', args=['doses']))
+            # Záznam vznikne až po přečtení těla, včetně dotazů při streamování
+            self.assertEqual(logs.records, [])
+            with self.capture_queries() as streamed:
+                b''.join(response.streaming_content)
+        record = json.loads(logs.records[0].getMessage())
+        self.assertNotIn('Server-Timing', response)
+        self.assertGreater(len(streamed.captured_queries), 0)
+        self.assertGreater(record['queries'], len(streamed.captured_queries))
+
+    @override_settings(MEDICINE_PERF_INSTRUMENTATION=True, MEDICINE_PERF_QUERY_BUDGET=1)
+    def test_over_budget_lists_duplicates(self):
+        def view(request):
+            for _ in range(3):
+                list(Medication.objects.filter(id__in=[1, 2]))
+            return HttpResponse()
+
+        request = RequestFactory().get('/')
+        with self.assertLogs('medicine.perf', 'WARNING') as logs:
+            PerformanceMiddleware(view)(request)
+        record = json.loads(logs.records[0].getMessage())
+        self.assertEqual(record['duplicate_queries'], 2)
+        self.assertEqual(record['top_duplicates'][0]['count'], 3)
+        self.assertIn('IN (%s…)', record['top_duplicates'][0]['sql'])
+
+
+class SeedDemoDataTests(MedicineTestCase):
+    def seed(self, prefix):
+        call_command('seed_demo_data', users=2, medications=3, schedules=2, years=0.02, changes=4,
+                     prefix=prefix, batch_size=7, stdout=StringIO())
+        return Medication.objects.filter(user__username__startswith=prefix).order_by('id')
+
+    def test_seed_is_deterministic(self):
+        first = self.seed('a')
+        second = self.seed('b')
+
+        self.assertEqual(first.count(), 6)
+        self.assertEqual(list(first.values_list('name', 'remaining_quantity')),
+                         list(second.values_list('name', 'remaining_quantity')))
+        # bulk_create obchází save(), časy plánu musí seeder seřadit sám
+        times = list(Schedule.objects.filter(medication__in=first).values_list('times', flat=True))
+        self.assertEqual(len(times), 12)
+        self.assertTrue(all(value == sorted(set(value)) for value in times))
+        self.assertEqual(MedicationChangeHistory.objects.filter(medication__in=first).count(), 24)
+        logs = Log.objects.filter(medication__in=first).count()
+        self.assertEqual(Log.objects.filter(medication__in=second).count(), logs)
+        self.assertEqual(sum(first.values_list('medicationstatistics__total_doses_taken', flat=True)), logs)
+
+
+class ConcurrentTakeDoseTests(MedicineTransactionTestCase):
+    def test_parallel_doses_are_not_lost(self):
+        self.take_doses_in_parallel()
+
+    @override_settings(SERIALIZE_DB_WRITES=True)
+    def test_parallel_doses_with_serialized_writes(self):
+        self.take_doses_in_parallel()
+
+    def take_doses_in_parallel(self):
+        user = User.objects.create_user('pacient', password='heslo')
+        medication = Medication.objects.create(user=user, name="Paralen", remaining_quantity=30)
+        errors = []
+
+        def worker():
+            try:
+                for _ in range(5):
+                    Medication.take_dose(medication.id, user)
+            except Exception as exc:
+                errors.append(exc)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=worker) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        medication.refresh_from_db()
+        logged = Log.objects.filter(medication=medication).count()
+        self.assertEqual(logged, 30)
+        self.assertEqual(medication.remaining_quantity, 0)
+        self.assertEqual(MedicationStatistics.objects.get(medication=medication).total_doses_taken, 30)
+
+
+class CollectingSender:
+    def __init__(self):
+        self.sent = []
+
+    async def send(self, reminder):
+        await asyncio.sleep(0)
+        self.sent.append(reminder)
+
+
+class ReminderDispatcherTests(MedicineTransactionTestCase):
+    def test_dispatch_skips_taken_doses(self):
+        start = timezone.make_aware(datetime(2025, 3, 10, 8, 0))  # pondělí
+        user = User.objects.create_user('pacient', password='heslo')
+        pending = []
+        for i in range(25):
+            medication = Medication.objects.create(user=user, name=f"Lék {i}", remaining_quantity=5)
+            Schedule.objects.create(medication=medication, user=user, weekdays=0b1, times=[8 * 60])
+            if i % 5 == 0:
+                Log.objects.create(medication=medication, created_at=start - timedelta(minutes=10))
+            else:
+                pending.append(medication.id)
+        Schedule.objects.create(medication=medication, user=user, weekdays=0b1, times=[9 * 60])
+
+        sender = CollectingSender()
+        dispatcher = ReminderDispatcher(sender, batch_size=7, concurrency=3, queue_size=2)
+        sent = asyncio.run(dispatcher.dispatch_window(start, start + timedelta(minutes=1)))
+
+        self.assertEqual(sent, len(pending))
+        self.assertEqual(sorted(reminder.medication_id for reminder in sender.sent), pending)
+        self.assertTrue(all(reminder.occurs_at == start for reminder in sender.sent))
+
+    def test_each_dose_covers_one_occurrence(self):
+        start = timezone.make_aware(datetime(2025, 3, 10, 8, 0))
+        user = User.objects.create_user('pacient', password='heslo')
+        medication = Medication.objects.create(user=user, name="Paralen", remaining_quantity=5)
+        Schedule.objects.create(medication=medication, user=user, times=[8 * 60])
+        Schedule.objects.create(medication=medication, user=user, times=[8 * 60 + 15])
+        Log.objects.create(medication=medication, created_at=start + timedelta(minutes=5))
+
+        # Dávka v 8:05 patří k výskytu v 8:00, připomínka na 8:15 se pošle
+        reminders, _, _ = due_reminders(start, start + timedelta(minutes=1))
+        self.assertEqual(reminders, [])
+        reminders, _, _ = due_reminders(start + timedelta(minutes=15), start + timedelta(minutes=16))
+        self.assertEqual([reminder.occurs_at for reminder in reminders], [start + timedelta(minutes=15)])
+        reminders, _, _ = due_reminders(start, start + timedelta(minutes=20))
+        self.assertEqual(len(reminders), 1)
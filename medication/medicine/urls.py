@@ -13,6 +13,11 @@ urlpatterns = [
     path('medication/<int:med_id>/mark_as_taken/',views.mark_as_taken, name='mark_as_taken'),
     path('medication/<int:med_id>/add_dose/', views.add_dose, name='add_dose'),
     path('statistics/', views.medication_statistics, name='statistics'),
+    path('api/adherence/', views.adherence_report, name='adherence'),
+    path('patients/', views.clinician_dashboard, name='clinician_dashboard'),
     path('medication/<int:med_id>/history/', views.medication_history, name='medication_history'),
+    path('api/doses/batch/', views.ingest_doses, name='ingest_doses'),
+    path('export/<str:kind>/', views.export_history, name='export'),
+    path('import/', views.import_medications, name='medication_import'),
 
 ]
\ No newline at end of file
@@ -1,21 +1,55 @@
+import io
+import json
+from urllib.parse import urlencode
+
 from django.utils import timezone
-from datetime import timedelta
+from django.utils.dateparse import parse_date
+from datetime import datetime, timedelta
+from django.conf import settings
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.mixins import LoginRequiredMixin
+from django.core.cache import cache
+from django.core.paginator import Paginator
+from django.http import Http404, HttpResponse, HttpResponseBadRequest, JsonResponse, StreamingHttpResponse
 from django.shortcuts import redirect, get_object_or_404, render
 from django.urls import reverse_lazy
+from django.views.decorators.http import require_POST
 from django.views.generic import ListView, CreateView, UpdateView, DeleteView
 from .forms import MedicationForm, ScheduleForm
-from .models import Medication, MedicationStatistics, Schedule, Log, MedicationChangeHistory
+from .history import changed_by
+from .ingest import MAX_BATCH_SIZE, IngestBusy, IngestConflict, ingest_dose_events
+from . import adherence, caching, dashboard, export, forecasting, fragments, importer, retention, rollups, sharding
+from .models import Medication, MedicationStatistics, Schedule, MedicationChangeHistory, DoseDailyRollup
+from .pagination import InvalidCursor, KeysetPaginator
+
+HISTORY_PAGE_SIZE = 50
+STATISTICS_CACHE_TIMEOUT = 60 * 60
+MAX_ADHERENCE_DAYS = 366
+DASHBOARD_PAGE_SIZE = 50
 
 
 class MedicineListView(LoginRequiredMixin, ListView):
     model = Medication
     template_name = 'medication_list.html'
     context_object_name = 'medications'
+    paginate_by = 50
 
     def get_queryset(self):
-        return  Medication.objects.filter(user=self.request.user)
+        # Odvozené hodnoty jsou v dotazu, plány se načtou jen pro karty, které nejsou v cache
+        return fragments.with_card_data(Medication.objects.filter(user=self.request.user))
+
+    def paginate_queryset(self, queryset, page_size):
+        paginator = KeysetPaginator(queryset, ('id',), page_size)
+        try:
+            page = paginator.page(self.request.GET.get('after'))
+        except InvalidCursor:
+            raise Http404("Neplatný kurzor stránkování.")
+        return paginator, page, page.object_list, page.has_next
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['cards'] = fragments.render_cards(self.request, context['medications'])
+        return context
 
 
 
@@ -25,24 +59,32 @@ class MedicationCreateView(LoginRequiredMixin, CreateView):
     template_name = 'medication_form.html'
     success_url = reverse_lazy('medication_list')
 
+    def get_context_data(self, **kwargs):
+        kwargs.setdefault('schedule_form', ScheduleForm())
+        return super().get_context_data(**kwargs)
+
+    def post(self, request, *args, **kwargs):
+        self.schedule_form = ScheduleForm(request.POST)
+        return super().post(request, *args, **kwargs)
+
     def form_valid(self, form):
+        # Jeden kompaktní plán (dny, časy, interval, rozsah dat) se ukládá spolu s lékem
+        if not self.schedule_form.is_valid():
+            return self.form_invalid(form)
         form.instance.user = self.request.user
         response = super().form_valid(form)
 
-
-        day_of_week = form.cleaned_data.get('day_of_week')
-        time = form.cleaned_data.get('time')
-
-        if day_of_week and time:
-            Schedule.objects.create(
-                medication=self.object,
-                user=self.request.user,
-                day_of_week=day_of_week,
-                time=time
-            )
+        if not self.schedule_form.is_empty():
+            schedule = self.schedule_form.save(commit=False)
+            schedule.medication = self.object
+            schedule.user = self.request.user
+            schedule.save()
 
         return response
 
+    def form_invalid(self, form):
+        return self.render_to_response(self.get_context_data(form=form, schedule_form=self.schedule_form))
+
 
 
 class MedicationUpdateView(LoginRequiredMixin, UpdateView):
@@ -55,6 +97,10 @@ class MedicationUpdateView(LoginRequiredMixin, UpdateView):
 
         return Medication.objects.filter(user=self.request.user)
 
+    def form_valid(self, form):
+        changed_by(form.instance, self.request.user)
+        return super().form_valid(form)
+
 
 
 class MedicationDeleteView(LoginRequiredMixin, DeleteView):
@@ -70,45 +116,143 @@ class MedicationDeleteView(LoginRequiredMixin, DeleteView):
 
 
 
-@login_required
-def mark_as_taken(request, med_id):
-    medication = get_object_or_404(Medication, id=med_id)
+def _wants_json(request):
+    return 'application/json' in request.headers.get('Accept', '')
 
-    if medication.remaining_quantity > 0:
-        medication.mark_as_taken()
 
-        # Logování užité dávky
-        Log.objects.create(medication=medication)
+def _wants_partial(request):
+    # fetch/XHR klienti dostanou jen změněnou kartu, běžný formulář dál přesměrování
+    return _wants_json(request) or request.headers.get('X-Requested-With') == 'XMLHttpRequest'
 
-    return redirect('medication_list')
 
+def _dose_response(request, med_id, **extra):
+    if not _wants_partial(request):
+        return redirect('medication_list')
+
+    medications = fragments.with_card_data(Medication.objects.filter(user=request.user))
+    medication = get_object_or_404(medications, id=med_id)
+    if _wants_json(request):
+        return JsonResponse({
+            'id': medication.id,
+            'remaining_quantity': medication.remaining_quantity,
+            'remaining_doses': medication.doses_left,
+            'last_taken': medication.last_taken.isoformat() if medication.last_taken else None,
+            **extra,
+        })
+    return HttpResponse(fragments.render_card(request, medication))
 
-@login_required
-def add_dose(request, med_id):
-    medication = get_object_or_404(Medication, id=med_id, user=request.user)
 
+@login_required
+def mark_as_taken(request, med_id):
+    taken = False
     if request.method == "POST":
-        action = request.POST.get('action')
+        # Podmíněný odečet, zápis do Logu a statistiky v jedné transakci
+        taken = Medication.take_dose(med_id, request.user) is not None
+        if not taken:
+            get_object_or_404(Medication, id=med_id, user=request.user)
+
+    return _dose_response(request, med_id, taken=taken)
+
+
+@login_required
+def add_dose(request, med_id):
+    delta = {'increase': 1, 'decrease': -1}.get(request.POST.get('action')) if request.method == "POST" else None
+    # Podmíněný UPDATE jako u take_dose: souběžné užití dávky se nepřepíše
+    if delta is None or Medication.adjust_stock(med_id, request.user, delta) is None:
+        get_object_or_404(Medication, id=med_id, user=request.user)
 
-        if action == 'increase':
-            medication.remaining_quantity += 1
-        elif action == 'decrease' and medication.remaining_quantity > 0:
-            medication.remaining_quantity -= 1
+    return _dose_response(request, med_id)
 
-        medication.save()
 
-    return redirect('medication_list')
 
 
+@login_required
+@require_POST
+def ingest_doses(request):
+    try:
+        events = json.loads(request.body)
+    except ValueError:
+        return JsonResponse({'error': "Tělo požadavku není platný JSON."}, status=400)
+
+    if not isinstance(events, list):
+        return JsonResponse({'error': "Očekáváno pole událostí."}, status=400)
+    if len(events) > MAX_BATCH_SIZE:
+        return JsonResponse({'error': f"Maximálně {MAX_BATCH_SIZE} událostí v jedné dávce."}, status=413)
+
+    try:
+        results = ingest_dose_events(request.user, events)
+    except IngestConflict as exc:
+        return JsonResponse({'error': str(exc)}, status=409)
+    except IngestBusy as exc:
+        return JsonResponse({'error': str(exc)}, status=503, headers={'Retry-After': '1'})
+    return JsonResponse({
+        'accepted': sum(1 for result in results if result['status'] == 'ok'),
+        'results': results,
+    })
 
 
 @login_required
 def medication_statistics(request):
 
-    stats = MedicationStatistics.objects.filter(user=request.user)
+    # Verze klíče se zvyšuje při každé dávce a úpravě léku, obsah tak nikdy není zastaralý
+    key = caching.versioned_key(caching.STATISTICS, request.user.id, timezone.localdate())
+    context = cache.get(key)
+    if context is None:
+        stats = list(MedicationStatistics.objects.filter(user=request.user).select_related('medication'))
+
+        # Graf za 90 dní je jeden rozsahový dotaz nad denními souhrny, ne průchod Logem
+        daily_doses = rollups.daily_series(DoseDailyRollup.objects.filter(user=request.user))
+        context = {
+            'stats': stats,
+            'running_out': list(forecasting.running_out(request.user, settings.MEDICINE_RUN_OUT_WARNING_DAYS)),
+            'daily_doses': daily_doses,
+            'peak_doses': max(doses for _, doses in daily_doses) or 1,
+        }
+        cache.set(key, context, STATISTICS_CACHE_TIMEOUT)
+
+    return render(request, 'statistics.html', context)
+
+
+@login_required
+def adherence_report(request):
+    """Dodržování plánu po dnech jako JSON: ?since=&until= (výchozí posledních 30 dní, nejvýš rok)."""
+    until = parse_date(request.GET.get('until') or '') or timezone.localdate()
+    since = parse_date(request.GET.get('since') or '') or until - timedelta(days=29)
+    if since > until or (until - since).days >= MAX_ADHERENCE_DAYS:
+        return HttpResponseBadRequest(f"Rozsah musí být nejvýš {MAX_ADHERENCE_DAYS} dní.")
+
+    names = dict(Medication.objects.filter(user=request.user).values_list('id', 'name'))
+    rows = adherence.daily(names, since, until)
+    medications = {}
+    for row in rows:
+        entry = medications.setdefault(row['medication_id'], {
+            'id': row['medication_id'], 'name': names[row['medication_id']], 'days': []})
+        entry['days'].append({
+            'date': row['date'].isoformat(), **{name: row[name] for name in adherence.COUNTS}})
+    for entry in medications.values():
+        entry['totals'] = adherence.summarize(entry['days'])
+    return JsonResponse({
+        'since': since.isoformat(),
+        'until': until.isoformat(),
+        'totals': adherence.summarize(rows),
+        'medications': list(medications.values()),
+    })
 
 
-    return render(request, 'statistics.html', {'stats': stats})
+@login_required
+def clinician_dashboard(request):
+    """Sledovaní pacienti lékaře seřazení podle naléhavosti, jména nebo poslední dávky (?sort=), stránkuje databáze."""
+    sort = request.GET.get('sort', 'urgency')
+    if sort not in dashboard.SORTS:
+        return HttpResponseBadRequest("Neznámé řazení.")
+    paginator = Paginator(dashboard.SupervisedPatients(request.user, sort), DASHBOARD_PAGE_SIZE)
+    page = paginator.get_page(request.GET.get('page'))
+    return render(request, 'clinician_dashboard.html', {
+        'patients': page.object_list,
+        'page_obj': page,
+        'sort': sort,
+        'change_days': settings.MEDICINE_DASHBOARD_CHANGE_DAYS,
+    })
 
 
 @login_required
@@ -123,7 +267,7 @@ def add_medication(request):
             medication.save()
 
 
-            if schedule_form.is_valid() and schedule_form.cleaned_data['day_of_week'] and schedule_form.cleaned_data['time']:
+            if schedule_form.is_valid() and not schedule_form.is_empty():
                 schedule = schedule_form.save(commit=False)
                 schedule.medication = medication
                 schedule.user = request.user
@@ -143,42 +287,113 @@ def add_medication(request):
 
 @login_required
 def update_medication(request, med_id):
-    medication = get_object_or_404(Medication, id=med_id)
-
-    if request.method == 'POST':
-        form = MedicationForm(request.POST, instance=medication)
-        if form.is_valid():
-            # Uložení starých hodnot pro porovnání
-            old_dosage = medication.dosage
-            old_notes = medication.notes
-            old_remaining_quantity = medication.remaining_quantity
+    # Jen vlastní lék uživatele a v jeho shardu, stejně jako MedicationUpdateView
+    with sharding.for_user(request.user):
+        medication = get_object_or_404(Medication, id=med_id, user=request.user)
 
+        if request.method == 'POST':
+            form = MedicationForm(request.POST, instance=changed_by(medication, request.user))
+            if form.is_valid():
+                # Změny zapíše do historie signál po uložení, jedním INSERT
+                form.save()
 
-            medication = form.save()
+                return redirect('medication_list')
+        else:
+            form = MedicationForm(instance=medication)
 
-            # Záznam změn
-            if old_dosage != medication.dosage:
-                MedicationChangeHistory.record_change(medication, request.user, "dosage", old_dosage, medication.dosage)
-            if old_notes != medication.notes:
-                MedicationChangeHistory.record_change(medication, request.user, "notes", old_notes, medication.notes)
-            if old_remaining_quantity != medication.remaining_quantity:
-                MedicationChangeHistory.record_change(medication, request.user, "remaining_quantity", old_remaining_quantity, medication.remaining_quantity)
-
-            return redirect('medication_list')
-    else:
-        form = MedicationForm(instance=medication)
-
-    return render(request, 'medication_form.html', {'form': form})
+        return render(request, 'medication_form.html', {'form': form})
 
 
 @login_required
 def medication_history(request, med_id):
-    medication = get_object_or_404(Medication, id=med_id)
-
+    medication = get_object_or_404(Medication, id=med_id, user=request.user)
 
-    changes = MedicationChangeHistory.objects.filter(medication=medication).order_by('-change_date')
+    # Uživatel se připojí ve stejném dotazu, stránkuje se klíčem po indexu (medication, change_date)
+    changes = MedicationChangeHistory.objects.filter(medication=medication).select_related('user')
+    filters = {}
+    field = request.GET.get('field')
+    if field:
+        changes = changes.filter(field_changed=field)
+        filters['field'] = field
+    since = parse_date(request.GET.get('since') or '')
+    if since:
+        changes = changes.filter(change_date__gte=timezone.make_aware(datetime.combine(since, datetime.min.time())))
+        filters['since'] = since.isoformat()
+    until = parse_date(request.GET.get('until') or '')
+    if until:
+        changes = changes.filter(
+            change_date__lt=timezone.make_aware(datetime.combine(until + timedelta(days=1), datetime.min.time())))
+        filters['until'] = until.isoformat()
+
+    paginator = KeysetPaginator(changes, ('-change_date', '-id'), HISTORY_PAGE_SIZE)
+    try:
+        page = paginator.page(request.GET.get('after'))
+    except InvalidCursor:
+        raise Http404("Neplatný kurzor stránkování.")
+
+    daily_doses = rollups.daily_series(
+        DoseDailyRollup.objects.filter(medication=medication, user_id=medication.user_id))
 
     return render(request, 'medication_change_history.html', {
         'medication': medication,
-        'changes': changes
+        'changes': page.object_list,
+        'page_obj': page,
+        'next_query': urlencode({**filters, 'after': page.next_cursor}) if page.has_next else None,
+        'filters': filters,
+        'tracked_fields': [*Medication.tracked_fields, *(f"schedule.{name}" for name in Schedule.tracked_fields)],
+        'daily_doses': daily_doses,
+        'peak_doses': max(doses for _, doses in daily_doses) or 1,
     })
+
+
+@login_required
+def export_history(request, kind):
+    """Streamovaný export dávek nebo změn: ?format=csv|jsonl&since=&until=&medication=&gzip=1&archive=1"""
+    if kind not in export.COLUMNS:
+        raise Http404("Neznámý export.")
+    fmt = request.GET.get('format', 'csv')
+    if fmt not in export.FORMATS:
+        return HttpResponseBadRequest("Podporované formáty jsou csv a jsonl.")
+    medication_id = request.GET.get('medication')
+    if medication_id is not None and not medication_id.isdigit():
+        return HttpResponseBadRequest("Neplatné id léku.")
+
+    filters = {
+        'since': parse_date(request.GET.get('since') or ''),
+        'until': parse_date(request.GET.get('until') or ''),
+        'medication_id': int(medication_id) if medication_id else None,
+    }
+    queryset = export.export_queryset(kind, request.user, **filters)
+    # Archiv starých záznamů se čte ze souborů jen na vyžádání
+    archived = retention.read(kind, request.user.pk, **filters) if request.GET.get('archive') == '1' else ()
+    compress = request.GET.get('gzip') == '1'
+    response = StreamingHttpResponse(
+        export.stream(kind, queryset, fmt, compress, archived=archived),
+        content_type='application/gzip' if compress else f'{export.FORMATS[fmt]}; charset=utf-8',
+    )
+    response['Content-Disposition'] = f'attachment; filename="{export.filename(kind, fmt, compress)}"'
+    return response
+
+
+@login_required
+def import_medications(request):
+    """Nahrání CSV/JSONL s léky a plány; chybné řádky se vrátí, zbytek se uloží."""
+    if request.method != 'POST':
+        return render(request, 'medication_import.html')
+
+    upload = request.FILES.get('file')
+    try:
+        if upload is None:
+            raise importer.InvalidImport("Vyberte soubor k importu.")
+        fmt = importer.detect_format(upload.name)
+    except importer.InvalidImport as exc:
+        if _wants_json(request):
+            return JsonResponse({'error': str(exc)}, status=400)
+        return render(request, 'medication_import.html', {'error': str(exc)}, status=400)
+
+    # Soubor se čte po řádcích, velké nahrávky Django drží v dočasném souboru
+    lines = io.TextIOWrapper(upload.file, encoding='utf-8-sig', newline='')
+    result = importer.import_medications(request.user, lines, fmt)
+    if _wants_json(request):
+        return JsonResponse(result)
+    return render(request, 'medication_import.html', {'result': result})